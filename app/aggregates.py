@@ -0,0 +1,183 @@
+import os
+import json
+from functools import reduce
+import numpy as np
+import pandas as pd
+from utils import write_atomically, sn_write_lock
+from storage import list_sweeping_files, read_sweeping_file
+from events import event_table_path
+from file_index import write_json
+from stats import CATEGORIES, STAT_COLUMNS
+
+# Moments kept for a set of values, which combine exactly across files
+MOMENT_KEYS = {'count', 'mean', 'm2', 'min', 'max'}
+
+# Count, mean, sum of squared deviations from the mean, min and max of the values that are not nan
+def column_moments(values):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return {'count': 0, 'mean': 0.0, 'm2': 0.0, 'min': None, 'max': None}
+    mean = float(values.mean())
+    return {
+        'count': len(values),
+        'mean': mean,
+        'm2': float(((values - mean) ** 2).sum()),
+        'min': float(values.min()),
+        'max': float(values.max())
+    }
+
+# Combine the moments of two sets of values (Chan et al. parallel variant of Welford's algorithm)
+def combine_moments(a, b):
+    if a['count'] == 0:
+        return dict(b)
+    if b['count'] == 0:
+        return dict(a)
+    count = a['count'] + b['count']
+    delta = b['mean'] - a['mean']
+    return {
+        'count': count,
+        'mean': a['mean'] + delta * b['count'] / count,
+        'm2': a['m2'] + b['m2'] + delta ** 2 * a['count'] * b['count'] / count,
+        'min': min(a['min'], b['min']),
+        'max': max(a['max'], b['max'])
+    }
+
+# Combine two aggregates: moments are merged, counts and totals are added
+def combine_aggregates(a, b):
+    if isinstance(a, dict) and MOMENT_KEYS == set(a):
+        return combine_moments(a, b)
+    if isinstance(a, dict):
+        return {key: combine_aggregates(a[key], b[key]) if key in a and key in b else a.get(key, b.get(key))
+                for key in list(a) + [key for key in b if key not in a]}
+    return a + b
+
+# Aggregate of the sweeping rows and events of one file
+def file_aggregates(sweeping_df, events):
+    nozzle_open = sweeping_df['NozGapOpen'].to_numpy() == 1.0
+    masks = {'All Data': np.ones(len(sweeping_df), dtype=bool), 'Nozzle Open': nozzle_open, 'Nozzle Closed': ~nozzle_open}
+    fuel_consumed = sweeping_df['fuel_consumed'].to_numpy(dtype=np.float64)
+    categories = {}
+    for category in CATEGORIES:
+        mask = masks[category]
+        categories[category] = {
+            'rows': int(mask.sum()),
+            'fuel_consumed': float(np.nansum(fuel_consumed[mask])),
+            'columns': {column: column_moments(sweeping_df[column].to_numpy()[mask]) for column in STAT_COLUMNS if column in sweeping_df.columns}
+        }
+    return {
+        'files': 1,
+        'total_fuel_consumed': float(sweeping_df['TotalFuelConsumption'].iloc[-1] - sweeping_df['TotalFuelConsumption'].iloc[0]),
+        'categories': categories,
+        'events': {signal: column_moments(signal_events['duration_s'].to_numpy()) for signal, signal_events in events.groupby('signal')}
+    }
+
+# Path of the all-history aggregate of an SN, and of the per-file aggregates it is combined from
+def aggregate_path(cwd, sn):
+    return f'{cwd}/data/{sn}/aggregates.json'
+
+def file_aggregates_path(cwd, sn):
+    return f'{cwd}/data/{sn}/file_aggregates.json'
+
+# Write the per-file aggregates of an SN and their combination
+def save_aggregates(cwd, sn, files):
+    total = reduce(combine_aggregates, [files[file_name] for file_name in sorted(files)]) if files else {}
+    write_atomically(file_aggregates_path(cwd, sn), lambda path: write_json(path, files))
+    write_atomically(aggregate_path(cwd, sn), lambda path: write_json(path, total))
+    return total
+
+# Build the aggregates of an SN from the sweeping store and the event table
+def build_aggregates(cwd, sn):
+    table_path = event_table_path(cwd, sn)
+    events = pd.read_parquet(table_path) if os.path.exists(table_path) else pd.DataFrame(columns=['file', 'signal', 'duration_s'])
+    events_by_file = dict(list(events.groupby('file')))
+    files = {}
+    for file_path in list_sweeping_files(cwd, sn):
+        file_name = os.path.splitext(os.path.basename(file_path))[0]
+        try:
+            df = read_sweeping_file(file_path)
+            if not df.empty:
+                files[file_name] = file_aggregates(df, events_by_file.get(file_name, events.iloc[:0]))
+        except Exception as e:
+            print(f'Error aggregating sweeping file: {file_path}', e)
+    save_aggregates(cwd, sn, files)
+    print(f'Built aggregates for {sn}')
+    return files
+
+# Load the per-file aggregates of an SN, building them if the SN has none yet
+def load_file_aggregates(cwd, sn):
+    if not os.path.exists(file_aggregates_path(cwd, sn)):
+        with sn_write_lock(cwd, sn):
+            if not os.path.exists(file_aggregates_path(cwd, sn)):
+                return build_aggregates(cwd, sn)
+    with open(file_aggregates_path(cwd, sn), 'r') as f:
+        return json.load(f)
+
+# Add or replace the aggregates of newly ingested files and recombine the all-history aggregate, so a file
+# uploaded again replaces its previous contribution rather than being counted twice
+def update_aggregates(cwd, sn, entries, removed_files=()):
+    files = load_file_aggregates(cwd, sn)
+    for file_name in removed_files:
+        files.pop(file_name, None)
+    files.update(entries)
+    save_aggregates(cwd, sn, files)
+    print(f'Updated aggregates for {sn}')
+
+# Load the all-history aggregate of an SN without reading the per-file aggregates or any rows
+def load_aggregates(cwd, sn):
+    if not os.path.exists(aggregate_path(cwd, sn)):
+        load_file_aggregates(cwd, sn)
+    with open(aggregate_path(cwd, sn), 'r') as f:
+        return json.load(f)
+
+# Mean, sample standard deviation, min and max from moments
+def moments_summary(moments):
+    count = moments['count']
+    return {
+        'mean': moments['mean'] if count else float('nan'),
+        'std': float(np.sqrt(moments['m2'] / (count - 1))) if count > 1 else float('nan'),
+        'min': moments['min'] if count else float('nan'),
+        'max': moments['max'] if count else float('nan')
+    }
+
+# All-history statistics of an SN in the layout of /get_data, from its aggregate
+def aggregate_statistics(total):
+    fuel_dicts = {}
+    for category, category_total in total['categories'].items():
+        fuel_dicts[category] = {
+            'Total Time (hrs)': (category_total['rows'] * 0.1) / 3600,
+            'Total Fuel Consumed (L)': category_total['fuel_consumed']
+        }
+        for column, (name, unit, _) in STAT_COLUMNS.items():
+            if column not in category_total['columns']:
+                continue
+            summary = moments_summary(category_total['columns'][column])
+            fuel_dicts[category].update({
+                f'Mean {name} ({unit})': summary['mean'],
+                f'Stdev {name} ({unit})': summary['std'],
+                f'Max {name} ({unit})': summary['max'],
+                f'Min {name} ({unit})': summary['min']
+            })
+
+    nozgapopen_stats_dict = {}
+    durations = total['events'].get('NozGapOpen')
+    if durations is not None and durations['count'] > 0:
+        summary = moments_summary(durations)
+        total_duration = durations['mean'] * durations['count']
+        nozgapopen_stats_dict = {
+            'Total NozGapOpen Duration (hrs)': total_duration / 3600,
+            'Mean NozGapOpen Duration (s)': summary['mean'],
+            'Stdev NozGapOpen Duration (mins)': summary['std'] / 60,
+            'Max NozGapOpen Duration (mins)': summary['max'] / 60,
+            'Min NozGapOpen Duration (s)': summary['min'],
+            'NozGapOpen Event Count': durations['count'],
+            'Proportion NozGapOpen %': (total_duration / (total['categories']['All Data']['rows'] * 0.1)) * 100
+        }
+
+    return {
+        'total_fuel_consumed': total['total_fuel_consumed'],
+        'num_of_files': total['files'],
+        'nozgapopen_stats_dict': nozgapopen_stats_dict,
+        'fuel_dicts': fuel_dicts,
+        'event_counts': {signal: moments['count'] for signal, moments in total['events'].items()}
+    }
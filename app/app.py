@@ -1,36 +1,118 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, g
+import pandas as pd
 from flask_cors import CORS
 import os
+import time
+import uuid
 from stats import calculate_statistics
-from data_processing import create_df, process_data
-from plot_graphs import draw_plots
-from utils import change_cwd, extract_uploaded_files, clear_uploaded_files, clear_uploaded_videos, setup
-from video_processing import process_video
+from data_processing import create_df, process_data, ingested_sns
+from storage import export_sweeping_csv
+from events import read_event_durations
+from sketches import query_quantiles
+from aggregates import load_aggregates, aggregate_statistics
+from pyramid import query_series, series_to_dict, DEFAULT_POINTS
+from streaming import stream_statistics, should_stream
+from fleet import fleet_statistics
+from rollups import query_rollups, trend_to_dict, TREND_BUCKETS
+from plot_graphs import draw_plots, touch_graphs
+from channels import read_segment_table, build_missing_channel_stores
+from worker_pool import start_pool, pending_tasks
+from cache import ResultCache, data_version
+from utils import change_cwd, save_uploaded_files, extract_saved_files, upload_sources, clear_upload_dir, setup, chunked_upload_dir, append_upload_chunk, upload_chunk_sizes
+from jobs import JobManager
+from video_processing import process_videos
+from manifest import hash_file, check_file, record_files, manifest_entry, session_time, video_session_name
+from metrics import render_metrics, REQUEST_SECONDS, REQUESTS, CACHE_REQUESTS, VIDEOS, POOL_PENDING_TASKS, JOBS, CACHE_ENTRIES, CACHE_BYTES
 
 cwd = change_cwd()
 setup(cwd)
+# Start the worker pool once with the app rather than on every request
+start_pool()
 STATIC_DIR = os.path.join(cwd, 'app/static')
 VIDEO_DIR = os.path.join(cwd, 'app/static/videos')
 GRAPH_DIR = os.path.join(cwd, 'app/static/graphs')
 TEMPLATES_DIR = os.path.join(cwd, 'app/templates')
+EXPORT_DIR = os.path.join(cwd, 'exports')
 
 # Initialize Flask app
 app = Flask(__name__, static_folder=STATIC_DIR, static_url_path='/static')
 CORS(app)  # Enable CORS for all routes
 
+# Time every request to a route
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+# Record the latency and status of requests to routes, other than the scrapes of /metrics itself
+@app.after_request
+def record_request_metrics(response):
+    if request.endpoint is not None and request.endpoint != 'metrics' and 'request_start' in g:
+        REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint=request.endpoint)
+        REQUESTS.inc(endpoint=request.endpoint, status=response.status_code)
+    return response
+
 # Serve the main page
 @app.route('/')
 def index():
     return send_from_directory(TEMPLATES_DIR, 'index.html')
 
+# SNs with a data directory
+def list_sns():
+    if not os.path.exists(os.path.join(cwd, 'data')):
+        return []
+    return [sn for sn in os.listdir(os.path.join(cwd, 'data')) if os.path.isdir(os.path.join(cwd, 'data', sn))]
+
+# Read the sn, start and end parameters of a query over a date range, returning them with no error, or with the
+# error response for a missing or unknown SN, or a missing, invalid or reversed date range
+def range_params():
+    sn = request.args.get('sn')
+    if not sn:
+        return None, None, None, (jsonify({'error': 'sn is required'}), 400)
+    if not os.path.isdir(os.path.join(cwd, 'data', sn)):
+        return None, None, None, (jsonify({'error': 'Unknown SN'}), 404)
+    dates = []
+    for name in ('start', 'end'):
+        try:
+            date = pd.to_datetime(request.args.get(name))
+        except (ValueError, TypeError):
+            date = None
+        if date is None or pd.isna(date):
+            return None, None, None, (jsonify({'error': f'{name} must be a date'}), 400)
+        dates.append(date)
+    if dates[0] > dates[1]:
+        return None, None, None, (jsonify({'error': 'start must not be after end'}), 400)
+    return sn, dates[0], dates[1], None
+
 # Route to get the list of SNs
 @app.route('/get_sns')
 def get_sns_route():
-    if not os.path.exists(os.path.join(cwd, 'data')):
-        sn_list = []
-    else:
-        sn_list = [sn for sn in os.listdir(os.path.join(cwd, 'data')) if os.path.isdir(os.path.join(cwd, 'data', sn))]
-    return jsonify({'sns': sn_list})
+    return jsonify({'sns': list_sns()})
+
+# Cache of /get_data results, keyed by SN, date range and data version
+result_cache = ResultCache()
+
+# Background jobs for uploads and video processing
+job_manager = JobManager()
+
+# Gauges read from the state of the app when /metrics is scraped
+POOL_PENDING_TASKS.set_function(pending_tasks)
+JOBS.set_function(job_manager.status_counts)
+CACHE_ENTRIES.set_function(lambda: len(result_cache.entries))
+CACHE_BYTES.set_function(lambda: result_cache.total_bytes)
+
+# Build the channel stores of SNs ingested before the store existed in the background, rather than in the first
+# request that reads them, which reads the sweeping store until then
+def build_channel_stores(job, sns):
+    return {'sns': build_missing_channel_stores(cwd, sns, job.set_progress)}
+
+missing_channel_stores = [sn for sn in list_sns() if read_segment_table(cwd, sn) is None]
+if missing_channel_stores:
+    job_manager.submit('build_channel_stores', build_channel_stores, missing_channel_stores)
+
+# Route to expose the pipeline metrics in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    return Response(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
 
 # Route to get data based on SN and date range
 @app.route('/get_data')
@@ -38,33 +120,185 @@ def get_data():
     sn = request.args.get('sn')
     start_date = request.args.get('start')
     end_date = request.args.get('end')
+    # 'memory' loads the rows of the range, 'stream' reduces them in batches, 'auto' streams large ranges
+    mode = request.args.get('mode', 'auto')
 
-    # Create dataframe with the data
-    combined_df, total_fuel_consumed, num_of_files = create_df(cwd, sn, start_date, end_date)
+    # Serve the statistics and graphs from the cache if this view was computed for the current data
+    key = (sn, start_date, end_date, data_version(cwd, sn))
+    data = result_cache.get(key)
+    # A result whose figures were pruned from the graph cache since is computed again, rendering them anew
+    if data is not None and not touch_graphs(os.path.join(GRAPH_DIR, sn), [graph.split('/')[-1] for graph in data['graphs']]):
+        data = None
+    CACHE_REQUESTS.inc(result='hit' if data is not None else 'miss')
+    if data is not None:
+        return jsonify(data)
 
-    if combined_df.empty:
-        return jsonify({'error': 'No sweeping data for this SN'})
+    event_durations = read_event_durations(cwd, sn, 'NozGapOpen', pd.to_datetime(start_date), pd.to_datetime(end_date))
+
+    # Stream ranges too large to hold in memory through accumulators, with the same results as loading them
+    if mode == 'stream' or (mode == 'auto' and should_stream(cwd, sn, start_date, end_date)):
+        streamed = stream_statistics(cwd, sn, start_date, end_date, event_durations)
+        if streamed is None:
+            return jsonify({'error': 'No sweeping data for this SN'})
+        total_fuel_consumed, num_of_files, nozgapopen_stats_dict, fuel_dicts, binned = streamed
+    else:
+        # Create dataframe with the data
+        combined_df, total_fuel_consumed, num_of_files = create_df(cwd, sn, start_date, end_date)
+
+        if combined_df.empty:
+            return jsonify({'error': 'No sweeping data for this SN'})
 
-    # Calculate statistics and draw plots
-    nozgap_event_durations, nozgapopen_stats_dict, fuel_dicts, dfs = calculate_statistics(combined_df)
-    draw_plots(cwd, sn, dfs, nozgap_event_durations)
+        # Calculate statistics from the data and the stored NozGapOpen events
+        nozgap_event_durations, nozgapopen_stats_dict, fuel_dicts, binned = calculate_statistics(combined_df, event_durations)
+
+    # Draw plots
+    graph_dir = os.path.join(GRAPH_DIR, sn)
+    graphs = draw_plots(graph_dir, binned)
 
     data = {
         "total_fuel_consumed": total_fuel_consumed,
         "num_of_files": num_of_files,
         "nozgapopen_stats_dict": nozgapopen_stats_dict,
         "fuel_dicts": fuel_dicts,
-        "graphs": [f'/graphs/{sn}/{graph}' for graph in os.listdir(f'{cwd}/app/static/graphs/{sn}') if graph.endswith('.png')]
+        "graphs": [f'/graphs/{sn}/{graph}' for graph in graphs]
     }
+    result_cache.put(key, data)
+
+    return jsonify(data)
 
+# Route to get the statistics of every SN, or of the comma separated sns, and of the whole fleet over a date range,
+# with the SNs ranked by NozGapOpen proportion, fuel and engine use
+@app.route('/get_fleet')
+def get_fleet():
+    start_date = request.args.get('start')
+    end_date = request.args.get('end')
+    limit = request.args.get('limit', type=int)
+    available = list_sns()
+    sns = [sn for sn in request.args.get('sns', '').split(',') if sn] or available
+    unknown = [sn for sn in sns if sn not in available]
+    if unknown:
+        return jsonify({'error': f"Unknown SNs: {', '.join(unknown)}"}), 404
+
+    # Cached under the data version of every SN, so new data for any of them computes the fleet again
+    key = (None, start_date, end_date, limit, tuple((sn, data_version(cwd, sn)) for sn in sorted(sns)))
+    data = result_cache.get(key)
+    CACHE_REQUESTS.inc(result='hit' if data is not None else 'miss')
+    if data is not None:
+        return jsonify(data)
+
+    data = fleet_statistics(cwd, sns, start_date, end_date, limit)
+    if data is None:
+        return jsonify({'error': 'No sweeping data for these SNs'})
+    if data['fleet'] is None:
+        return jsonify({'error': 'Every SN failed to aggregate', 'errors': data['errors']}), 500
+    # A fleet missing SNs that failed is not cached, so they are tried again on the next request
+    if data['errors'] == {}:
+        result_cache.put(key, data)
     return jsonify(data)
 
+# Route to get percentiles of the sensor signals and NozGapOpen durations from the quantile sketches
+@app.route('/get_percentiles')
+def get_percentiles():
+    sn, start_date, end_date, error = range_params()
+    if error is not None:
+        return error
+    try:
+        quantiles = [float(q) for q in request.args.get('q', '0.5').split(',')]
+    except ValueError:
+        quantiles = None
+    if quantiles is None or not all(0 <= q <= 1 for q in quantiles):
+        return jsonify({'error': 'q must be comma separated quantiles between 0 and 1'}), 400
+
+    percentiles = query_quantiles(cwd, sn, start_date, end_date, quantiles)
+    if percentiles == {}:
+        return jsonify({'error': 'No sweeping data for this SN'})
+    return jsonify({column: {category: {str(q): v for q, v in values.items()} for category, values in categories.items()}
+                    for column, categories in percentiles.items()})
+
+# Route to get the all-history statistics of an SN from its aggregate, without reading any rows
+@app.route('/get_summary')
+def get_summary():
+    sn = request.args.get('sn')
+    if not sn or not os.path.isdir(os.path.join(cwd, 'data', sn)):
+        return jsonify({'error': 'Unknown SN'}), 404
+
+    aggregates = load_aggregates(cwd, sn)
+    if aggregates == {}:
+        return jsonify({'error': 'No sweeping data for this SN'})
+    return jsonify(aggregate_statistics(aggregates))
+
+# Route to get a fixed number of min/max/mean points of the signals of an SN over any time window,
+# read from the downsampled level that matches the window
+@app.route('/get_series')
+def get_series():
+    sn, start_date, end_date, error = range_params()
+    if error is not None:
+        return error
+    points = request.args.get('points', DEFAULT_POINTS, type=int)
+
+    series = query_series(cwd, sn, start_date, end_date, points)
+    if series is None:
+        return jsonify({'error': 'No data for this SN'})
+    return jsonify(series_to_dict(*series))
+
+# Route to get the trend of an SN over a date range in hourly, daily, weekly or monthly buckets, read from the
+# rollups materialized at ingest rather than from the rows
+@app.route('/get_trend')
+def get_trend():
+    sn, start_date, end_date, error = range_params()
+    if error is not None:
+        return error
+    bucket = request.args.get('bucket', 'day')
+    if bucket not in TREND_BUCKETS:
+        return jsonify({'error': f"Unknown bucket '{bucket}'. Use one of: {', '.join(TREND_BUCKETS)}"}), 400
+
+    rollups = query_rollups(cwd, sn, start_date, end_date, bucket)
+    if rollups.empty:
+        return jsonify({'error': 'No sweeping data for this SN'})
+    return jsonify(trend_to_dict(bucket, rollups))
+
+# Route to export the sweeping data of an SN and date range as CSV
+@app.route('/export_csv')
+def export_csv():
+    sn, start_date, end_date, error = range_params()
+    if error is not None:
+        return error
+
+    export_name = f'{sn}_{start_date:%Y_%m_%d}_{end_date:%Y_%m_%d}.csv'
+    if export_sweeping_csv(cwd, sn, start_date, end_date, os.path.join(EXPORT_DIR, export_name)) == 0:
+        return jsonify({'error': 'No sweeping data for this SN'})
+    return send_from_directory(EXPORT_DIR, export_name, as_attachment=True)
+
 # Route to serve graph images
 @app.route('/graphs/<sn>/<filename>')
 def get_graph(sn, filename):
     return app.send_static_file(f'graphs/{sn}/{filename}')
 
-# Route to upload files
+# Ingest the log files saved for an upload job, reading those inside zips straight from the archive
+def ingest_uploaded_files(job, upload_dir):
+    try:
+        job.set_progress('extract', 0.0)
+        files_to_process = upload_sources(upload_dir, 'log')
+        job.set_progress('extract', 1.0)
+        results = process_data(cwd, files_to_process, job.set_progress)
+    finally:
+        clear_upload_dir(upload_dir)
+
+    # Only the SNs that received new files have stale cached results
+    sns = ingested_sns(results)
+    for sn in sns:
+        result_cache.invalidate_sn(sn)
+
+    # A failed file is reported in the result without failing the files ingested alongside it
+    errors = [{'file': r['file'], 'sn': r['sn'], 'error': r['error']} for r in results if r['status'] == 'failed']
+    if sns:
+        return {'message': 'Files successfully uploaded and processed', 'sns': sns, 'files': results, 'errors': errors}
+    elif errors:
+        raise ValueError(f"No files could be processed: {'; '.join(e['file'] + ': ' + e['error'] for e in errors)}")
+    else:
+        raise ValueError('No new files to process')
+
+# Route to upload files, which are ingested in a background job
 @app.route('/upload_files', methods=['POST'])
 def upload_files():
     if 'files' not in request.files:
@@ -72,16 +306,92 @@ def upload_files():
 
     uploaded_files = request.files.getlist('files')
 
-    files_to_process = extract_uploaded_files(cwd, uploaded_files, 'log')
-    data_processed = process_data(cwd, files_to_process)
-    clear_uploaded_files(cwd)
+    # Save the upload to a directory of its own before the request ends, then process it in the background
+    upload_dir = save_uploaded_files(cwd, uploaded_files, 'log', os.path.join(cwd, 'uploads/files', uuid.uuid4().hex))
+    job_id = job_manager.submit('upload_files', ingest_uploaded_files, upload_dir)
+    return jsonify({'job_id': job_id}), 202
 
-    if data_processed:
-        return jsonify({'message': 'Files successfully uploaded and processed'}), 200
-    else:
-        return jsonify({'error': 'No new files to process'}), 400
+# Route to append a chunk of a file to a resumable upload. The chunk is streamed from the request body to disk;
+# a chunk not starting where the file ends is refused with the size received so far, to resume from
+@app.route('/upload_chunk', methods=['PUT'])
+def upload_chunk():
+    upload_id = request.args.get('upload_id', '')
+    filename = request.args.get('filename', '')
+    offset = request.args.get('offset', type=int)
+    if not filename.endswith('.log') and not filename.endswith('.zip'):
+        return jsonify({'error': f'Unsupported file type: {filename}'}), 400
+    if offset is None:
+        return jsonify({'error': 'Missing chunk offset'}), 400
+    try:
+        upload_dir = chunked_upload_dir(cwd, upload_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        size = append_upload_chunk(upload_dir, filename, offset, request.stream)
+    except ValueError as e:
+        return jsonify({'error': str(e), 'size': upload_chunk_sizes(upload_dir).get(os.path.basename(filename), 0)}), 409
+    return jsonify({'size': size})
+
+# Route to get the sizes of the files received so far by a resumable upload
+@app.route('/upload_chunk/<upload_id>')
+def get_upload_chunks(upload_id):
+    try:
+        return jsonify({'files': upload_chunk_sizes(chunked_upload_dir(cwd, upload_id))})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+# Route to finish a resumable upload, whose files are ingested in a background job
+@app.route('/upload_complete', methods=['POST'])
+def upload_complete():
+    upload_id = (request.get_json(silent=True) or {}).get('upload_id', '')
+    try:
+        upload_dir = chunked_upload_dir(cwd, upload_id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if not os.path.exists(upload_dir):
+        return jsonify({'error': 'Unknown upload'}), 404
+
+    job_id = job_manager.submit('upload_files', ingest_uploaded_files, upload_dir)
+    return jsonify({'job_id': job_id}), 202
 
-# Route to upload videos
+# Process the videos saved for an upload job in parallel, publishing each video as soon as it is ready. Videos whose
+# content was already processed, under any name, are served from their earlier output instead
+def process_uploaded_videos(job, upload_dir):
+    processed_vids = []
+    try:
+        video_paths = []
+        entries = {}
+        for vid_path in extract_saved_files(upload_dir, 'video'):
+            vidname = os.path.basename(vid_path)
+            sha256, size = hash_file(vid_path)
+            status, existing_name = check_file(cwd, 'video', vidname, sha256)
+            if status == 'duplicate' and os.path.exists(os.path.join(VIDEO_DIR, existing_name.split('_')[1], existing_name)):
+                print(f'{vidname} was already processed as {existing_name}')
+                VIDEOS.inc(result='duplicate')
+                if existing_name not in processed_vids:
+                    processed_vids.append(existing_name)
+                continue
+            video_paths.append(vid_path)
+            entries[vid_path] = manifest_entry('video', vidname, sha256, size, vidname.split('_')[1], session_time(video_session_name(vidname)))
+        if processed_vids:
+            job.set_result({'video_urls': processed_video_urls(processed_vids)})
+
+        for vid_path, output_path in process_videos(cwd, video_paths, job.set_progress):
+            VIDEOS.inc(result='merged' if output_path else 'failed')
+            if output_path:
+                record_files(cwd, [entries[vid_path]])
+                processed_vids.append(os.path.basename(vid_path))
+                job.set_result({'video_urls': processed_video_urls(processed_vids)})
+    finally:
+        clear_upload_dir(upload_dir)
+    return {'video_urls': processed_video_urls(processed_vids)}
+
+# URLs of processed videos
+def processed_video_urls(vidnames):
+    return [f"/videos/{vidname.split('_')[1]}/{vidname}" for vidname in vidnames]
+
+# Route to upload videos, which are processed in a background job
 @app.route('/upload_video', methods=['POST'])
 def upload_video():
     if 'video' not in request.files:
@@ -89,20 +399,25 @@ def upload_video():
     
     dropped_vids = request.files.getlist('video')
     valid_vids = [v for v in dropped_vids if v.filename.endswith('.mp4') or v.filename.endswith('.h264')]
-    vids_to_upload = [v for v in valid_vids if v.filename not in os.listdir(os.path.join(VIDEO_DIR, v.filename.split('_')[1]))]
-    processed_vids = [v.filename for v in valid_vids if v.filename in os.listdir(os.path.join(VIDEO_DIR, v.filename.split('_')[1]))]
-    uploaded_vidnames = [os.path.basename(vid_path) for vid_path in extract_uploaded_files(cwd, vids_to_upload, 'video')]
-    for vid_name in uploaded_vidnames:
-        sn = vid_name.split('_')[1]
-        if vid_name not in os.listdir(os.path.join(VIDEO_DIR, sn)):
-            if process_video(cwd, os.path.join('uploads/videos', vid_name)) == True:
-                processed_vids.append(vid_name)
-    clear_uploaded_videos(cwd)
-    processed_urls =[f'/videos/{vidname.split('_')[1]}/{vidname}' for vidname in processed_vids] 
-    clear_uploaded_videos(cwd)
-    print(processed_urls)
-    return jsonify({'video_urls': processed_urls}), 200        
-            
+
+    # Save the upload to a directory of its own before the request ends, then check it against the manifest and
+    # process it in the background
+    upload_dir = save_uploaded_files(cwd, valid_vids, 'video', os.path.join(cwd, 'uploads/videos', uuid.uuid4().hex))
+    job_id = job_manager.submit('upload_video', process_uploaded_videos, upload_dir)
+    return jsonify({'job_id': job_id}), 202
+
+# Route to get the status and per-stage progress of a background job
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(job)
+
+# Route to list the status of recent background jobs
+@app.route('/jobs')
+def get_jobs():
+    return jsonify({'jobs': job_manager.list()})
 
 # Route to serve processed videos
 @app.route('/videos/<sn>/<filename>')
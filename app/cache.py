@@ -0,0 +1,61 @@
+import os
+import json
+import threading
+from collections import OrderedDict
+
+# Limits of the /get_data result cache, configurable through the environment
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get('RESULT_CACHE_MAX_ENTRIES', 128))
+RESULT_CACHE_MAX_BYTES = int(os.environ.get('RESULT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# Version of the data of an SN, which changes whenever new files are ingested for it
+def data_version(cwd, sn):
+    index_path = f'{cwd}/data/{sn}/file_index.json'
+    return os.stat(index_path).st_mtime_ns if os.path.exists(index_path) else 0
+
+# Least recently used cache of results keyed by (sn, ...), bounded by entry count and total size
+class ResultCache:
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES, max_bytes=RESULT_CACHE_MAX_BYTES, on_evict=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+
+    # Get a cached value, marking it as most recently used, or None if it is not cached
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    # Cache a value, evicting the least recently used entries to stay within the limits
+    def put(self, key, value):
+        size = len(json.dumps(value, default=str))
+        evicted = []
+        with self.lock:
+            if key in self.entries:
+                self.total_bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.total_bytes += size
+            while len(self.entries) > self.max_entries or (self.total_bytes > self.max_bytes and len(self.entries) > 1):
+                evicted.append(self._pop(next(iter(self.entries))))
+        self._evicted(evicted)
+
+    # Drop every entry of an SN
+    def invalidate_sn(self, sn):
+        with self.lock:
+            evicted = [self._pop(key) for key in list(self.entries) if key[0] == sn]
+        self._evicted(evicted)
+        print(f'Invalidated {len(evicted)} cached results for {sn}')
+
+    def _pop(self, key):
+        value, size = self.entries.pop(key)
+        self.total_bytes -= size
+        return key, value
+
+    def _evicted(self, evicted):
+        if self.on_evict is not None:
+            for key, value in evicted:
+                self.on_evict(key, value)
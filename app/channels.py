@@ -0,0 +1,246 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from utils import write_atomically, no_progress, sn_write_lock
+from file_index import write_json
+from log_parser import schema_array, apply_schema, sweeping_mask, FLAG_COLUMNS, FLOAT64_COLUMNS
+from storage import list_sweeping_files, read_sweeping_file
+
+# Binary channel store of every row of each ingested log of an SN: append-only fixed-width arrays, one raw file per
+# channel, beside an int64 array of timestamps (ns since the epoch). Each log is one segment of the arrays, sorted by
+# time, and the segment table maps file names to their rows, so a date range resolves by binary search to a slice of
+# the memory-mapped arrays. Reads cost the pages they touch, shared by every process through the OS page cache.
+# A log ingested again is appended as a new segment, and the arrays are rewritten once most of their rows are replaced
+CHANNEL_DIR = 'channels'
+TIME_CHANNEL = 'datetime'
+# Channels stored besides time: those read by queries and graph videos, and whether each row is sweeping
+CHANNELS = ['TotalFuelConsumption', 'fuel_consumed', 'EngineFuelRateTMSCS', 'EngineSpeed', 'FanSpeed', 'NozGapOpen', 'sweeping']
+# Fraction of replaced rows above which the arrays are compacted to the live segments
+COMPACT_FRACTION = 0.5
+
+# Directory holding the channel store of an SN
+def channel_dir(cwd, sn):
+    return f'{cwd}/data/{sn}/{CHANNEL_DIR}'
+
+# Path of the segment table of an SN
+def segment_table_path(cwd, sn):
+    return f'{channel_dir(cwd, sn)}/segments.json'
+
+# Path of the array of one channel. Compaction writes a new generation of the arrays, so readers holding the previous
+# table keep reading the previous files
+def channel_path(cwd, sn, channel, generation):
+    return f'{channel_dir(cwd, sn)}/{channel}.{generation}.bin'
+
+# Path of the segment of a log staged by the worker that parsed it, until the parent appends it
+def staged_segment_path(cwd, sn, file_name):
+    return f'{channel_dir(cwd, sn)}/staged/{os.path.splitext(os.path.basename(file_name))[0]}.npz'
+
+# Fixed-width dtype of a channel, the compact dtype of its log column
+def channel_dtype(channel):
+    if channel == TIME_CHANNEL:
+        return np.dtype(np.int64)
+    if channel == 'sweeping' or channel in FLAG_COLUMNS:
+        return np.dtype(np.uint8)
+    if channel in FLOAT64_COLUMNS:
+        return np.dtype(np.float64)
+    return np.dtype(np.float32)
+
+# Timestamp of a datetime in ns since the epoch, as stored in the time channel
+def timestamp_ns(datetime):
+    return pd.Timestamp(datetime).value
+
+# Arrays of every channel of one log, sorted by time. Channels missing from the log are stored as NaN, or 0 for flags
+def segment_arrays(df, sweeping):
+    arrays = {TIME_CHANNEL: df['datetime'].to_numpy(dtype='datetime64[ns]').astype(np.int64)}
+    for channel in CHANNELS:
+        dtype = channel_dtype(channel)
+        if channel == 'sweeping':
+            arrays[channel] = np.asarray(sweeping, dtype=dtype)
+        elif channel in df.columns:
+            arrays[channel] = schema_array(channel, df[channel].to_numpy()).astype(dtype, copy=False)
+        else:
+            arrays[channel] = np.zeros(len(df), dtype=dtype) if dtype.kind == 'u' else np.full(len(df), np.nan, dtype=dtype)
+
+    times = arrays[TIME_CHANNEL]
+    if np.any(times[1:] < times[:-1]):
+        order = np.argsort(times, kind='stable')
+        arrays = {channel: values[order] for channel, values in arrays.items()}
+    return arrays
+
+# Stage the segment of a parsed log for the parent to append, returning its path
+def stage_segment(cwd, sn, file_name, df, sweeping):
+    arrays = segment_arrays(df, sweeping)
+    path = staged_segment_path(cwd, sn, file_name)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def write(tmp_path):
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+    write_atomically(path, write)
+    return path
+
+# Read a staged segment back into its arrays
+def load_staged_segment(path):
+    with np.load(path) as staged:
+        return {channel: staged[channel] for channel in [TIME_CHANNEL] + CHANNELS}
+
+# Segment table of an SN: the generation of the arrays, the rows written to them and the offset, rows and first and
+# last timestamps of the segment of each file. None if the SN has no channel store yet. Read without the SN write
+# lock: the table is replaced atomically and only ever refers to rows already written
+def read_segment_table(cwd, sn):
+    if not os.path.exists(segment_table_path(cwd, sn)):
+        return None
+    with open(segment_table_path(cwd, sn), 'r') as f:
+        return json.load(f)
+
+# Append segments to the arrays after the rows of the table, replacing the segments of files already in it. Bytes
+# past the rows of the table, left by an append that never reached the table, are overwritten
+def append_segments(cwd, sn, table, segments):
+    os.makedirs(channel_dir(cwd, sn), exist_ok=True)
+    for channel in [TIME_CHANNEL] + CHANNELS:
+        dtype = channel_dtype(channel)
+        path = channel_path(cwd, sn, channel, table['generation'])
+        with open(path, 'ab'):
+            pass
+        with open(path, 'r+b') as f:
+            f.seek(table['rows'] * dtype.itemsize)
+            for arrays in segments.values():
+                np.ascontiguousarray(arrays[channel], dtype=dtype).tofile(f)
+            f.truncate()
+
+    for file_name, arrays in segments.items():
+        times = arrays[TIME_CHANNEL]
+        table['segments'][file_name] = {
+            'offset': table['rows'],
+            'rows': len(times),
+            'start': int(times[0]) if len(times) else None,
+            'end': int(times[-1]) if len(times) else None
+        }
+        table['rows'] += len(times)
+    return table
+
+# Rewrite the arrays with only the live segments as the next generation, and remove the previous one
+def compact_channel_store(cwd, sn, table):
+    arrays = open_channels(cwd, sn, table, [TIME_CHANNEL] + CHANNELS)
+    compacted = {'generation': table['generation'] + 1, 'rows': 0, 'segments': {}}
+    for file_name, segment in sorted(table['segments'].items(), key=lambda item: item[1]['offset']):
+        rows = slice(segment['offset'], segment['offset'] + segment['rows'])
+        append_segments(cwd, sn, compacted, {file_name: {channel: values[rows] for channel, values in arrays.items()}})
+    del arrays
+    write_atomically(segment_table_path(cwd, sn), lambda path: write_json(path, compacted))
+    for channel in [TIME_CHANNEL] + CHANNELS:
+        path = channel_path(cwd, sn, channel, table['generation'])
+        if os.path.exists(path):
+            os.remove(path)
+    print(f'Compacted channel store for {sn}: {table["rows"]} to {compacted["rows"]} rows')
+    return compacted
+
+# Build the channel store of an SN from its CSV files, which hold every row of each ingested log, and the sweeping
+# files of logs ingested before the CSVs were kept, skipping the files in skip_files
+def build_channel_store(cwd, sn, skip_files=()):
+    table = {'generation': 0, 'rows': 0, 'segments': {}}
+    csv_dir = f'{cwd}/data/{sn}/csv_files'
+    for csv_file in sorted(os.listdir(csv_dir)) if os.path.exists(csv_dir) else []:
+        file_name = os.path.splitext(csv_file)[0]
+        if not csv_file.endswith('.csv') or file_name in skip_files:
+            continue
+        try:
+            columns = set(CHANNELS + ['datetime', 'Nozzle1downTMSCS', 'Nozzle2downTMS'])
+            df = apply_schema(pd.read_csv(f'{csv_dir}/{csv_file}', usecols=lambda column: column in columns))
+            append_segments(cwd, sn, table, {file_name: segment_arrays(df, sweeping_mask(df))})
+        except Exception as e:
+            print(f'Error adding to channel store: {csv_file}', e)
+
+    for file_path in list_sweeping_files(cwd, sn):
+        file_name = os.path.splitext(os.path.basename(file_path))[0]
+        if file_name in table['segments'] or file_name in skip_files:
+            continue
+        try:
+            df = read_sweeping_file(file_path)
+            append_segments(cwd, sn, table, {file_name: segment_arrays(df, np.ones(len(df), dtype=bool))})
+        except Exception as e:
+            print(f'Error adding to channel store: {file_path}', e)
+    write_atomically(segment_table_path(cwd, sn), lambda path: write_json(path, table))
+    print(f'Built channel store for {sn}')
+    return table
+
+# Build the channel stores of the given SNs that have none yet, ingested before the store existed. Run in a background
+# job, so queries of these SNs read the sweeping store until their channel store is ready
+def build_missing_channel_stores(cwd, sns, progress=no_progress):
+    built = []
+    for i, sn in enumerate(sorted(sns)):
+        with sn_write_lock(cwd, sn):
+            if read_segment_table(cwd, sn) is None:
+                build_channel_store(cwd, sn)
+                built.append(sn)
+        progress('build channel stores', (i + 1) / len(sns))
+    return built
+
+# Append the staged segments of newly ingested files to the channel store of an SN, replacing the segments of files
+# with the same name, then remove the staged files, and drop the segments of removed_files. Run at ingest, which
+# builds the store of an SN that has none
+def update_channel_store(cwd, sn, staged_paths, removed_files=()):
+    if staged_paths == {} and not removed_files:
+        return
+    with sn_write_lock(cwd, sn):
+        table = read_segment_table(cwd, sn)
+        if table is None and staged_paths == {}:
+            return
+        if table is None:
+            table = build_channel_store(cwd, sn, set(staged_paths))
+        for file_name in removed_files:
+            table['segments'].pop(file_name, None)
+        for file_name, path in staged_paths.items():
+            append_segments(cwd, sn, table, {file_name: load_staged_segment(path)})
+        write_atomically(segment_table_path(cwd, sn), lambda path: write_json(path, table))
+        for path in staged_paths.values():
+            os.remove(path)
+
+        live_rows = sum(segment['rows'] for segment in table['segments'].values())
+        if table['rows'] - live_rows > COMPACT_FRACTION * table['rows']:
+            compact_channel_store(cwd, sn, table)
+    print(f'Updated channel store for {sn}')
+
+# Memory-map the given channels of the store, over the rows of the table
+def open_channels(cwd, sn, table, channels):
+    if table['rows'] == 0:
+        return {channel: np.zeros(0, dtype=channel_dtype(channel)) for channel in channels}
+    return {channel: np.memmap(channel_path(cwd, sn, channel, table['generation']), dtype=channel_dtype(channel), mode='r', shape=(table['rows'],))
+            for channel in channels}
+
+# Read the rows of each file between its start and end dates, None for either meaning no bound, as slices of the
+# memory-mapped channels, without copying. ranges maps file names to (start_date, end_date); files without a segment,
+# or of an SN whose store is not built yet, are left out
+def read_segments(cwd, sn, ranges, channels=CHANNELS):
+    channels = [TIME_CHANNEL] + [channel for channel in channels if channel != TIME_CHANNEL]
+    table = read_segment_table(cwd, sn)
+    if table is None:
+        return {}
+    try:
+        arrays = open_channels(cwd, sn, table, channels)
+    except FileNotFoundError:
+        # Compacted since the table was read
+        table = read_segment_table(cwd, sn)
+        arrays = open_channels(cwd, sn, table, channels)
+
+    segments = {}
+    for file_name, (start_date, end_date) in ranges.items():
+        segment = table['segments'].get(file_name)
+        if segment is None:
+            continue
+        first = segment['offset']
+        times = arrays[TIME_CHANNEL][first:first + segment['rows']]
+        start = np.searchsorted(times, timestamp_ns(start_date), side='left') if start_date is not None else 0
+        end = np.searchsorted(times, timestamp_ns(end_date), side='right') if end_date is not None else len(times)
+        segments[file_name] = {channel: values[first + start:first + end] for channel, values in arrays.items()}
+    return segments
+
+# DataFrame of the given columns of the rows of a segment, or of its sweeping rows only
+def segment_frame(arrays, columns, sweeping_only=False):
+    rows = arrays['sweeping'] == 1 if sweeping_only else slice(None)
+    data = {}
+    for column in columns:
+        values = np.asarray(arrays[column])[rows]
+        data[column] = values.view('datetime64[ns]') if column == TIME_CHANNEL else values
+    return pd.DataFrame(data)
@@ -1,148 +1,288 @@
 import os
-import sys
-import shutil
-import csv
+import time
+from zipfile import ZipFile
+import numpy as np
 import pandas as pd
-from utils import validate_files, get_sn_numbers, setup_sn_directories
-from concurrent.futures import ProcessPoolExecutor
+from utils import validate_files, get_sn_numbers, setup_sn_directories, no_progress, write_atomically, copy_upload_source, close_zip_files, sn_write_lock
+from log_parser import parse_log_file, DATETIME_FORMAT
+from storage import write_sweeping_file, remove_sweeping_file, sweeping_file_path, read_sweeping_file, import_sweeping_csvs
+from events import file_events, update_event_table
+from file_index import file_index_entry, load_file_index, update_file_index, prune_files
+from sketches import file_sketches, update_sketch_files
+from aggregates import file_aggregates, update_aggregates
+from pyramid import write_pyramid_files, update_pyramid_index, pyramid_file_path, PYRAMID_LEVELS
+from rollups import file_rollups, update_rollup_tables
+from channels import stage_segment, update_channel_store, read_segment_table, read_segments, segment_frame
+from manifest import check_file, record_files, manifest_entry, session_time, hash_file, hash_stream
+from concurrent.futures import as_completed
+from worker_pool import submit_task
+from metrics import timed_stage, stage_timer, STAGE_SECONDS, FILES_INGESTED, ROWS_PARSED, QUERY_FILES, ROWS_QUERIED
 
-# Extract log files from target directory and copy them to data/sn_number/log_files
-def extract_log_files(cwd, files, sn_numbers):
-    all_files_already_exist = True
+# Hash an uploaded source, reading zip members straight from their archive
+def hash_upload_source(source, zip_files):
+    name, path, member = source
+    if member is None:
+        return hash_file(path)
+    if path not in zip_files:
+        zip_files[path] = ZipFile(path, 'r')
+    with zip_files[path].open(member) as f:
+        return hash_stream(f)
+
+# Write the uploaded log sources whose content is not in the manifest to data/sn_number/log_files, streaming zip
+# members straight out of their archive. Returns the names of the written logs per SN and their manifest entries
+@timed_stage('extract')
+def extract_log_files(cwd, sources, sn_numbers):
     # Dictionary to store log file names for each SN number
     log_file_names = {}
+    entries = {}
+    upload_hashes = set()
+    zip_files = {}
     try:
         # Iterate over each SN number to find corresponding log files
         for sn in sn_numbers:
-            log_files = [f.split('/')[-1] for f in files if f.split('/')[-1].startswith(sn) and f.endswith('.log')]
-            log_file_names[sn] = log_files
+            log_file_names[sn] = []
+            for source in [source for source in sources if source[0].startswith(sn) and source[0].endswith('.log')]:
+                name = source[0]
+                sha256, size = hash_upload_source(source, zip_files)
+                # A file or content repeated within the upload is written once
+                if name in entries or sha256 in upload_hashes:
+                    print(f'{name} is repeated in the upload')
+                    continue
+                status, existing_name = check_file(cwd, 'log', name, sha256)
+                if status == 'duplicate':
+                    print(f'{name} was already ingested as {existing_name}')
+                    continue
 
-            # Copy log files to their respective directories if they don't already exist
-            for log_file_name in log_file_names[sn]:
-                if not os.path.exists(f'{cwd}/data/{sn}/log_files/{log_file_name}'):
-                    shutil.copy(f'{cwd}/uploads/files/{log_file_name}', f'{cwd}/data/{sn}/log_files')
-                    all_files_already_exist = False
+                # New content under a known name replaces the log, and its CSV, which marks the old content as ingested
+                destination = f'{cwd}/data/{sn}/log_files/{name}'
+                copy_upload_source(source, destination, zip_files)
+                if status == 'changed':
+                    print(f'{name} changed since it was ingested, replacing it')
+                    csv_path = f'{cwd}/data/{sn}/csv_files/{name[:-4]}.csv'
+                    if os.path.exists(csv_path):
+                        os.remove(csv_path)
+                log_file_names[sn].append(name)
+                entries[name] = manifest_entry('log', name, sha256, size, sn, session_time(name[:-4]))
+                upload_hashes.add(sha256)
 
         # Return a message if all files already exist
-        if all_files_already_exist:
+        if entries == {}:
             print('All log files already exist in data directory')
-            return []
+            return {}, {}
         else:
-            print(f'Copied log files for {sn}')
-            return log_file_names
+            print(f'Copied log files for {", ".join(sn for sn in sn_numbers if log_file_names[sn])}')
+            return log_file_names, entries
     except Exception as e:
         print('Error copying log files:', e)
-        return []
+        return {}, {}
+    finally:
+        close_zip_files(zip_files)
 
-# Create csv files from the extracted log files copied to data/sn_number/log_files
-def create_csv_files(cwd, sn_numbers, log_file_names):
-    # Iterate over each SN number to process its log files
-    for sn in sn_numbers:
-        log_files = log_file_names[sn]
-        for log_file in log_files:
-            try:
-                with open(f'{cwd}/data/{sn}/log_files/{log_file}', 'r') as f:
-                    lines = f.readlines()
-                    csv_file = log_file.replace('.log', '.csv')
-                    # Create CSV files if they don't already exist
-                    if not os.path.exists(f'{cwd}/data/{sn}/csv_files/{csv_file}'):
-                        with open(f'{cwd}/data/{sn}/csv_files/{csv_file}', 'w') as c:
-                            writer = csv.writer(c)
-                            prev_line = ''
-                            start_of_data = False
-                            for line in lines:
-                                if prev_line.startswith('[data]'):
-                                    start_of_data = True
-                                if start_of_data:
-                                    writer.writerow(line.split(' '))
-                                elif prev_line.startswith('[column names]'):
-                                    writer.writerow(line.split(' '))
-                                prev_line = line
-                        print(f'Created {csv_file} for {sn}')
-                        # Create sweeping CSV if the created CSV is not empty
-                        if not os.path.getsize(f'{cwd}/data/{sn}/csv_files/{csv_file}') == 0:
-                            create_sweeping_csv(cwd, sn, csv_file)
-            except Exception as e:
-                print(f'Error creating csv file from: {log_file}', e)
-                continue
-
-# Create new csvs consisting of only rows where the truck is sweeping
-def create_sweeping_csv(cwd, sn, csv_file):
+# Ingest one log file in a worker: parse it, store its sweeping rows and CSV, and summarize it.
+# Outputs are written through temporary files, so a failed file leaves nothing half-written behind, and the outputs
+# written before a failure are removed, so no store picks up a file that was not ingested.
+# The time of each step is returned in the result, for the parent to record
+def ingest_log_file(cwd, sn, log_file):
+    csv_file = log_file.replace('.log', '.csv')
+    result = {'sn': sn, 'file': log_file, 'status': 'skipped', 'error': None, 'rows': 0, 'summary': None, 'timings': {}}
+    written_paths = []
     try:
-        df = pd.read_csv(f'{cwd}/data/{sn}/csv_files/{csv_file}')
+        # Create CSV files if they don't already exist
+        if os.path.exists(f'{cwd}/data/{sn}/csv_files/{csv_file}'):
+            return result
 
-        time_interval_hours = 0.1 / 3600
-        df['fuel_consumed'] = df['EngineFuelRateTMSCS'] * time_interval_hours
-        df['cumulative_fuel_consumed'] = df['fuel_consumed'].cumsum()
-        df['datetime'] = pd.to_datetime('-'.join(csv_file.split('_')[1:4]) + ' ' + df['time'], format='%Y-%m-%d %H:%M:%S.%f')
-        df.to_csv(f'{cwd}/data/{sn}/csv_files/{csv_file}', index=False)
+        # Parse the log once into column arrays with the derived columns and sweeping mask
+        start = time.perf_counter()
+        columns, sweeping = parse_log_file(f'{cwd}/data/{sn}/log_files/{log_file}')
+        result['timings']['parse'] = time.perf_counter() - start
+        if columns == {}:
+            print(f'No data in {log_file}')
+            result['status'] = 'empty'
+            return result
+        df = pd.DataFrame(columns)
+        result['rows'] = len(df)
 
-        # Create new CSV with only rows that have Nozzle1downTMSCS or Nozzle2downTMSCS == 1.0
-        df = df[((df['Nozzle1downTMSCS'] == 1.0) | (df['Nozzle2downTMS'] == 1.0))]
-        if df.empty:
-            print(f'No sweeping data in {csv_file}')
-            return ''
-        
-        df.to_csv(f'{cwd}/data/{sn}/sweeping_csvs/{csv_file}', index=False)
-        print(f'Created sweeping csv file for {csv_file} in {sn}')
-        return csv_file
+        # Store the sweeping rows of the parsed log, then the CSV, whose presence marks the file as ingested
+        start = time.perf_counter()
+        sweeping_path = create_sweeping_data(cwd, sn, csv_file, df, sweeping)
+        if sweeping_path is not None:
+            written_paths.append(sweeping_path)
+        pyramid_range = write_pyramid_files(cwd, sn, csv_file, df)
+        written_paths.extend(pyramid_file_path(cwd, sn, level, csv_file) for level in PYRAMID_LEVELS)
+        staged_segment = stage_segment(cwd, sn, csv_file, df, sweeping)
+        written_paths.append(staged_segment)
+        write_atomically(f'{cwd}/data/{sn}/csv_files/{csv_file}', lambda path: df.to_csv(path, index=False, date_format=DATETIME_FORMAT))
+        written_paths.append(f'{cwd}/data/{sn}/csv_files/{csv_file}')
+        result['timings']['store'] = time.perf_counter() - start
+        print(f'Created {csv_file} for {sn}')
+
+        start = time.perf_counter()
+        result['summary'] = summarize_file(csv_file, df, sweeping)
+        result['summary']['pyramid'] = pyramid_range
+        result['summary']['channels'] = staged_segment
+        result['timings']['summarize'] = time.perf_counter() - start
+        result['status'] = 'ingested'
+        return result
     except Exception as e:
-        print(f'Error writing sweeping csv file: {csv_file}', e)
-        sys.exit(1)
+        print(f'Error creating csv file from: {log_file}', e)
+        for path in written_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        result['status'] = 'failed'
+        result['error'] = str(e)
+        return result
 
-# Filter files based on dates in the file name format 'SN213390_YYYY_MM_DD_HHMM.csv'
-def filter_file_dates(file_name, start_date, end_date):
-    try:
-        # Extract the date part from the file name
-        date_str = file_name.split('_')[1:4]  # ['YYYY', 'MM', 'DD']
-        file_date = pd.to_datetime('-'.join(date_str), format='%Y-%m-%d')
-        return start_date <= file_date <= end_date
-    except (ValueError, IndexError):
-        return False
-
-# Process a single file by reading it and filtering by date range
-def process_file(file_path, start_date, end_date):
+# Create csv files from the extracted log files copied to data/sn_number/log_files, one file per worker,
+# and return the result of every file
+@timed_stage('ingest')
+def create_csv_files(cwd, sn_numbers, log_file_names, progress=no_progress):
+    futures = [submit_task(ingest_log_file, cwd, sn, log_file) for sn in sn_numbers for log_file in log_file_names[sn]]
+
+    results = []
+    for future in as_completed(futures):
+        result = future.result()
+        results.append(result)
+        for stage, seconds in result['timings'].items():
+            STAGE_SECONDS.observe(seconds, stage=stage)
+        FILES_INGESTED.inc(status=result['status'])
+        ROWS_PARSED.inc(result['rows'])
+        progress('parse', len(results) / len(futures))
+
+    # Update the per-SN stores from the parent only, under the write lock of each SN
+    with stage_timer('update_stores'):
+        for i, sn in enumerate(sn_numbers):
+            update_sn_stores(cwd, sn, [r['summary'] for r in results if r['sn'] == sn and r['status'] == 'ingested'],
+                             [os.path.splitext(r['file'])[0] for r in results if r['sn'] == sn and r['status'] == 'empty'])
+            progress('update stores', (i + 1) / len(sn_numbers))
+
+    results.sort(key=lambda r: (r['sn'], r['file']))
+    for r in results:
+        r.pop('summary')
+        r.pop('timings')
+    failed = [r for r in results if r['status'] == 'failed']
+    print(f"Ingested {sum(r['status'] == 'ingested' for r in results)} of {len(results)} files, {len(failed)} failed")
+    return results
+
+# Compute the per-file data kept alongside the sweeping data: its events, index entry, quantile sketches, aggregates
+# and hourly rollups. The pyramid and channel store segment are written by the caller
+def summarize_file(file_name, df, sweeping):
+    sweeping_df = df[sweeping]
+    events = file_events(file_name, df, sweeping)
+    return {
+        'file': os.path.splitext(os.path.basename(file_name))[0],
+        'events': events,
+        'index': file_index_entry(sweeping_df) if not sweeping_df.empty else None,
+        'sketches': file_sketches(sweeping_df, events[events['signal'] == 'NozGapOpen']),
+        'aggregates': file_aggregates(sweeping_df, events) if not sweeping_df.empty else None,
+        'rollups': file_rollups(sweeping_df, events[events['signal'] == 'NozGapOpen']) if not sweeping_df.empty else None,
+        'pyramid': None,
+        'channels': None
+    }
+
+# Update the per-SN stores with the summaries of newly ingested files. A log ingested again under the same name
+# replaces its old content in every store: files whose new content has no sweeping rows are removed from the sweeping
+# stores, and empty_files, whose new content has no rows at all, from every store. Concurrent upload jobs and queries
+# importing legacy files both update the stores, so the whole update holds the write lock of the SN
+def update_sn_stores(cwd, sn, summaries, empty_files=()):
+    empty_files = list(empty_files)
+    if summaries == [] and empty_files == []:
+        return
+    no_sweeping_files = [summary['file'] for summary in summaries if summary['index'] is None] + empty_files
+    with sn_write_lock(cwd, sn):
+        for file_name in no_sweeping_files:
+            remove_sweeping_file(cwd, sn, file_name)
+        update_event_table(cwd, sn, [summary['events'] for summary in summaries], [summary['file'] for summary in summaries] + empty_files)
+        update_file_index(cwd, sn, {summary['file']: summary['index'] for summary in summaries if summary['index'] is not None}, no_sweeping_files)
+        update_sketch_files(cwd, sn, {summary['file']: summary['sketches'] for summary in summaries}, empty_files)
+        update_aggregates(cwd, sn, {summary['file']: summary['aggregates'] for summary in summaries if summary['aggregates'] is not None}, no_sweeping_files)
+        update_pyramid_index(cwd, sn, {summary['file']: summary['pyramid'] for summary in summaries if summary['pyramid'] is not None}, empty_files)
+        update_rollup_tables(cwd, sn, {summary['file']: summary['rollups'] for summary in summaries if summary['rollups'] is not None}, no_sweeping_files)
+        update_channel_store(cwd, sn, {summary['file']: summary['channels'] for summary in summaries if summary['channels'] is not None}, empty_files)
+
+# Summarize sweeping CSVs imported into the store, whose logs were ingested before it existed
+def summarize_imported_files(cwd, sn, imported_files):
+    summaries = []
+    for file_name in imported_files:
+        df = read_sweeping_file(sweeping_file_path(cwd, sn, file_name))
+        sweeping = np.ones(len(df), dtype=bool)
+        summaries.append(summarize_file(file_name, df, sweeping))
+        # An SN without a channel store has it built in the background, including these files
+        if read_segment_table(cwd, sn) is not None:
+            summaries[-1]['channels'] = stage_segment(cwd, sn, file_name, df, sweeping)
+    update_sn_stores(cwd, sn, summaries)
+
+# Store only the rows where the truck is sweeping in the columnar sweeping store, returning the path written, or None
+# if there are no sweeping rows
+def create_sweeping_data(cwd, sn, csv_file, df, sweeping):
     try:
-        df = pd.read_csv(file_path)
-        # Convert datetime column to pandas datetime
-        df['datetime'] = pd.to_datetime(df['datetime'])
-        # Filter by date range
-        df = df[(df['datetime'] >= start_date) & (df['datetime'] <= end_date)]
+        # Keep only rows that have Nozzle1downTMSCS or Nozzle2downTMSCS == 1.0
+        df = df[sweeping]
         if df.empty:
-            return pd.DataFrame(), 0
-        csv_fuel_consumed = df['TotalFuelConsumption'].iloc[-1] - df['TotalFuelConsumption'].iloc[0]
-        csv_fuel_consumed = csv_fuel_consumed if csv_fuel_consumed is not None else 0
-        return df, csv_fuel_consumed
+            print(f'No sweeping data in {csv_file}')
+            return None
+
+        file_path = write_sweeping_file(cwd, sn, csv_file, df)
+        print(f'Created sweeping data for {csv_file} in {sn}')
+        return file_path
     except Exception as e:
-        print(f'Error reading sweeping csv file: {file_path}', e)
-        return pd.DataFrame(), 0
+        # Report the failure to the caller, which records it against this file only
+        print(f'Error writing sweeping data: {csv_file}', e)
+        raise
+
+# Columns read by calculate_statistics and draw_plots, plus those needed to compute fuel consumed
+QUERY_COLUMNS = ['datetime', 'TotalFuelConsumption', 'fuel_consumed', 'EngineFuelRateTMSCS', 'EngineSpeed', 'FanSpeed', 'NozGapOpen']
+
+# Index of the sweeping files of an SN, split into the files fully inside and partly overlapping the date range
+def query_files(cwd, sn, start_date, end_date):
+    # Bring any sweeping CSVs that predate the columnar store into it, under the write lock of the SN so two
+    # queries or a query and an upload don't import the same files at once
+    with sn_write_lock(cwd, sn):
+        imported_files = import_sweeping_csvs(cwd, sn)
+        if imported_files != []:
+            summarize_imported_files(cwd, sn, imported_files)
+
+    # Skip files outside the date range using the index, without opening them
+    index = load_file_index(cwd, sn)
+    inside_files, partial_files = prune_files(index, start_date, end_date)
+    QUERY_FILES.inc(len(index) - len(inside_files) - len(partial_files), result='pruned')
+    QUERY_FILES.inc(len(inside_files), result='inside')
+    QUERY_FILES.inc(len(partial_files), result='partial')
+    return index, inside_files, partial_files
 
 # Create a dataframe for a specific SN number and date range
+@timed_stage('create_df')
 def create_df(cwd, sn, start_date, end_date):
-    data_dir = f'{cwd}/data/{sn}/sweeping_csvs'
-    data_files = os.listdir(data_dir)
-
     # Convert start_date and end_date to datetime
     start_date = pd.to_datetime(start_date)
     end_date = pd.to_datetime(end_date)
 
-    # Filter files by date range
-    data_files = [f for f in data_files if filter_file_dates(f, start_date, end_date)]
+    index, inside_files, partial_files = query_files(cwd, sn, start_date, end_date)
 
     print(f'Creating dataframe for {sn}, between {start_date} and {end_date}...')
-    total_fuel_consumption = []
-    combined_df = pd.DataFrame()
-    num_of_files = 0
-
-    # Use ProcessPoolExecutor to process files in parallel
-    with ProcessPoolExecutor() as executor:
-        futures = [executor.submit(process_file, f'{data_dir}/{csv_file}', start_date, end_date) for csv_file in data_files]
-        for future in futures:
-            df, fuel_consumed = future.result()
-            if not df.empty:
-                combined_df = pd.concat([combined_df, df])
-                total_fuel_consumption.append(fuel_consumed)
-                num_of_files += 1
+    total_fuel_consumption = [index[f]['fuel_last'] - index[f]['fuel_first'] for f in inside_files]
+    dfs = []
+    num_of_files = len(inside_files)
+
+    # Resolve the range of each file to a slice of the memory-mapped channel store, only searching the timestamps of
+    # files that partly overlap the range, and keep the sweeping rows
+    ranges = {f: (start_date, end_date) if f in partial_files else (None, None) for f in sorted(inside_files + partial_files)}
+    segments = read_segments(cwd, sn, ranges, QUERY_COLUMNS + ['sweeping'])
+    for file_name, (file_start, file_end) in ranges.items():
+        if file_name in segments:
+            df = segment_frame(segments[file_name], QUERY_COLUMNS, sweeping_only=True)
+        else:
+            df = read_sweeping_file(sweeping_file_path(cwd, sn, file_name), file_start, file_end, QUERY_COLUMNS)
+        if df.empty:
+            continue
+        dfs.append(df)
+        if file_name in partial_files:
+            fuel = df['TotalFuelConsumption']
+            total_fuel_consumption.append(fuel.iloc[-1] - fuel.iloc[0])
+            num_of_files += 1
+
+    # Assemble the dataframe with a single concatenation
+    combined_df = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+    ROWS_QUERIED.inc(len(combined_df), mode='memory')
 
     # Total Fuel Consumed
     total_fuel_consumed = sum(total_fuel_consumption)
@@ -151,20 +291,20 @@ def create_df(cwd, sn, start_date, end_date):
     return combined_df, total_fuel_consumed, num_of_files
 
 
-# Main function to process data
-def process_data(cwd, files_to_process):
+# Main function to process data from uploaded (name, path, zip member) sources, returning the result of every new log file
+def process_data(cwd, files_to_process, progress=no_progress):
     # Validate and select files to process
     validated_files_to_process = validate_files(files_to_process)
     if validated_files_to_process == []:
         print('No new files to process')
-        return False
-    print('Uploaded files validated:', validated_files_to_process)
+        return []
+    print('Uploaded files validated:', [source[0] for source in validated_files_to_process])
 
     # Retrieve SN numbers from the validated files
     sn_numbers = get_sn_numbers(validated_files_to_process)
     if sn_numbers == []:
         print('No SN numbers in data')
-        return False
+        return []
     print('SN numbers in data retrived:', sn_numbers)
 
     # Setup directories for the SN numbers
@@ -172,14 +312,21 @@ def process_data(cwd, files_to_process):
     print("Directories setup")
 
     # Extract log files
-    log_file_names = extract_log_files(cwd, validated_files_to_process, sn_numbers)
-    if log_file_names == []:
+    log_file_names, manifest_entries = extract_log_files(cwd, validated_files_to_process, sn_numbers)
+    if log_file_names == {}:
         print('No new log files to process')
-        return False
+        return []
     print("Log files extracted")
 
-    # Create CSV files from log files
-    create_csv_files(cwd, sn_numbers, log_file_names)
+    # Create CSV files from log files in parallel
+    results = create_csv_files(cwd, sn_numbers, log_file_names, progress)
     print("CSV files created")
 
-    return True
+    # Record the content of the logs that no longer need ingesting, so it is skipped under any name from now on
+    record_files(cwd, [manifest_entries[r['file']] for r in results if r['status'] != 'failed'])
+
+    return results
+
+# SN numbers that received new data in the results of process_data
+def ingested_sns(results):
+    return sorted({r['sn'] for r in results if r['status'] == 'ingested'})
@@ -0,0 +1,154 @@
+import os
+import numpy as np
+import pandas as pd
+from utils import write_atomically
+from log_parser import SAMPLE_INTERVAL_S
+
+# Scaled median absolute deviations above the median fuel rate at which the engine is considered to be spiking,
+# configurable through the environment
+FUEL_SPIKE_MADS = float(os.environ.get('FUEL_SPIKE_MADS', 3.0))
+# Factor scaling the median absolute deviation to the standard deviation of normally distributed values
+MAD_SCALE = 1.4826
+# Samples further apart than this belong to different sessions and never share an event (seconds)
+MAX_SAMPLE_GAP_S = 1.0
+
+# Fuel rate above which the engine is spiking in one log (L/hr). A fixed rate either sits inside the normal range of
+# a truck or above every sample of another, so spikes are outliers of the log itself, by the Hampel rule: rates more
+# than FUEL_SPIKE_MADS scaled median absolute deviations above the median rate while the engine burns fuel
+def fuel_spike_threshold(values):
+    values = np.asarray(values, dtype=np.float64)
+    values = values[values > 0]
+    if len(values) == 0:
+        return np.inf
+    median = np.median(values)
+    mad = np.median(np.abs(values - median))
+    # A rate steady in most samples makes any rate above it a spike
+    if mad == 0:
+        return np.nextafter(median, np.inf)
+    return median + FUEL_SPIKE_MADS * MAD_SCALE * mad
+
+# Event signals: name -> (column, threshold, or a function of the values giving it, computed on sweeping rows only)
+EVENT_SIGNALS = {
+    'NozGapOpen': ('NozGapOpen', 1.0, True),
+    'Nozzle1downTMSCS': ('Nozzle1downTMSCS', 1.0, False),
+    'Nozzle2downTMS': ('Nozzle2downTMS', 1.0, False),
+    'FuelRateSpike': ('EngineFuelRateTMSCS', fuel_spike_threshold, False),
+}
+
+EVENT_COLUMNS = ['file', 'signal', 'start', 'end', 'samples', 'duration_s']
+
+# Find runs of consecutive active samples that do not cross a boundary, returning start indices and exclusive end indices
+def find_runs(active, boundaries=None):
+    active = np.asarray(active, dtype=bool)
+    if len(active) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    # A run starts where the previous sample is inactive or a new segment begins
+    starts = active.copy()
+    starts[1:] &= ~active[:-1] | (boundaries[1:] if boundaries is not None else False)
+    # A run ends where the next sample is inactive or starts a new segment
+    ends = active.copy()
+    ends[:-1] &= ~active[1:] | (boundaries[1:] if boundaries is not None else False)
+    return np.flatnonzero(starts), np.flatnonzero(ends) + 1
+
+# Mark the samples that start a new session, where the time since the previous sample exceeds max_gap_s
+def session_boundaries(timestamps, max_gap_s=MAX_SAMPLE_GAP_S):
+    timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+    boundaries = np.zeros(len(timestamps), dtype=bool)
+    if len(timestamps) > 1:
+        boundaries[1:] = np.diff(timestamps) > np.timedelta64(int(max_gap_s * 1e9), 'ns')
+    return boundaries
+
+# Extract the events where values reach the threshold, split at session boundaries
+def extract_events(timestamps, values, threshold=1.0, boundaries=None):
+    timestamps = np.asarray(timestamps, dtype='datetime64[ns]')
+    if boundaries is None:
+        boundaries = session_boundaries(timestamps)
+    starts, ends = find_runs(np.asarray(values) >= threshold, boundaries)
+    samples = ends - starts
+    return pd.DataFrame({
+        'start': timestamps[starts],
+        'end': timestamps[ends - 1],
+        'samples': samples,
+        'duration_s': samples * SAMPLE_INTERVAL_S
+    })
+
+# Extract the events of every signal in one parsed log file
+def file_events(file_name, df, sweeping):
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    sweeping_df = df[sweeping]
+    events = []
+    for signal, (column, threshold, sweeping_only) in EVENT_SIGNALS.items():
+        source = sweeping_df if sweeping_only else df
+        if column not in source.columns:
+            continue
+        values = source[column].to_numpy()
+        if callable(threshold):
+            threshold = threshold(values)
+        signal_events = extract_events(source['datetime'].to_numpy(), values, threshold)
+        signal_events.insert(0, 'signal', signal)
+        signal_events.insert(0, 'file', stem)
+        events.append(signal_events)
+    return pd.concat(events, ignore_index=True) if events else pd.DataFrame(columns=EVENT_COLUMNS)
+
+# Path of the event table of an SN
+def event_table_path(cwd, sn):
+    return f'{cwd}/data/{sn}/events.parquet'
+
+# Replace the events of the given files in the event table of an SN. Every event of replaced_files is dropped first,
+# so a file whose new content has fewer or no events keeps none of its old ones
+def update_event_table(cwd, sn, events, replaced_files=()):
+    events = [e for e in events if not e.empty]
+    table_path = event_table_path(cwd, sn)
+    if events == [] and not (replaced_files and os.path.exists(table_path)):
+        return
+    new_events = pd.concat(events, ignore_index=True) if events else pd.DataFrame(columns=EVENT_COLUMNS)
+
+    if os.path.exists(table_path):
+        old_events = pd.read_parquet(table_path)
+        old_events = old_events[~old_events['file'].isin(set(new_events['file'].unique()) | set(replaced_files))]
+        new_events = pd.concat([old_events, new_events], ignore_index=True) if events else old_events
+
+    new_events = new_events.sort_values(['signal', 'start'], kind='stable')
+    write_atomically(table_path, lambda path: new_events.to_parquet(path, engine='pyarrow', compression='zstd', index=False))
+    print(f'Updated event table for {sn}')
+
+# Clip events to the date range: an event running past either edge keeps only its 10 Hz samples inside the range,
+# with its start, end, samples and duration moved to match. Events with no samples in the range are dropped
+def clip_events(events, start_date=None, end_date=None):
+    if events.empty:
+        return events
+    interval = int(round(SAMPLE_INTERVAL_S * 1e9))
+    starts = events['start'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    samples = events['samples'].to_numpy(dtype=np.int64)
+    first = np.zeros(len(events), dtype=np.int64)
+    last = samples - 1
+    if start_date is not None:
+        first = np.maximum(first, -((starts - pd.Timestamp(start_date).value) // interval))
+    if end_date is not None:
+        last = np.minimum(last, (pd.Timestamp(end_date).value - starts) // interval)
+    clipped_samples = last - first + 1
+    events = events.assign(
+        start=(starts + first * interval).astype('datetime64[ns]'),
+        end=(starts + last * interval).astype('datetime64[ns]'),
+        samples=clipped_samples,
+        duration_s=clipped_samples * SAMPLE_INTERVAL_S
+    )
+    return events[clipped_samples > 0].reset_index(drop=True)
+
+# Read the events of a signal that overlap the date range, clipped to it
+def read_events(cwd, sn, signal, start_date=None, end_date=None):
+    table_path = event_table_path(cwd, sn)
+    if not os.path.exists(table_path):
+        return pd.DataFrame(columns=EVENT_COLUMNS)
+
+    filters = [('signal', '==', signal)]
+    if start_date is not None:
+        filters.append(('end', '>=', start_date))
+    if end_date is not None:
+        filters.append(('start', '<=', end_date))
+    return clip_events(pd.read_parquet(table_path, engine='pyarrow', filters=filters), start_date, end_date)
+
+# Durations in seconds of the events of a signal within the date range, clipped to it
+def read_event_durations(cwd, sn, signal, start_date=None, end_date=None):
+    return read_events(cwd, sn, signal, start_date, end_date)['duration_s'].tolist()
@@ -0,0 +1,75 @@
+import os
+import json
+from storage import list_sweeping_files, read_sweeping_file
+from utils import write_atomically, sn_write_lock
+
+# Path of the index of the sweeping files of an SN
+def file_index_path(cwd, sn):
+    return f'{cwd}/data/{sn}/file_index.json'
+
+# Summarize the sweeping rows of one file: exact datetime range, row count, TotalFuelConsumption endpoints and columns
+def file_index_entry(sweeping_df):
+    datetimes = sweeping_df['datetime'].to_numpy(dtype='datetime64[ns]').astype('int64')
+    return {
+        'min_datetime_ns': int(datetimes.min()),
+        'max_datetime_ns': int(datetimes.max()),
+        'rows': len(sweeping_df),
+        'fuel_first': float(sweeping_df['TotalFuelConsumption'].iloc[0]),
+        'fuel_last': float(sweeping_df['TotalFuelConsumption'].iloc[-1]),
+        'columns': list(sweeping_df.columns)
+    }
+
+# Write a dictionary to a JSON file
+def write_json(path, data):
+    with open(path, 'w') as f:
+        json.dump(data, f)
+
+# Write the index of an SN, replacing the previous one only once it is complete
+def save_file_index(cwd, sn, index):
+    write_atomically(file_index_path(cwd, sn), lambda path: write_json(path, index))
+
+# Build the index of an SN from the files in the sweeping store
+def build_file_index(cwd, sn):
+    index = {}
+    for file_path in list_sweeping_files(cwd, sn):
+        try:
+            df = read_sweeping_file(file_path)
+            if not df.empty:
+                index[os.path.splitext(os.path.basename(file_path))[0]] = file_index_entry(df)
+        except Exception as e:
+            print(f'Error indexing sweeping file: {file_path}', e)
+    save_file_index(cwd, sn, index)
+    print(f'Built file index for {sn}')
+    return index
+
+# Load the index of an SN, building it if the SN has none yet
+def load_file_index(cwd, sn):
+    index_path = file_index_path(cwd, sn)
+    if not os.path.exists(index_path):
+        with sn_write_lock(cwd, sn):
+            if not os.path.exists(index_path):
+                return build_file_index(cwd, sn)
+    with open(index_path, 'r') as f:
+        return json.load(f)
+
+# Add or replace the entries of newly ingested files in the index of an SN, and remove those of removed_files
+def update_file_index(cwd, sn, entries, removed_files=()):
+    index = load_file_index(cwd, sn)
+    for file_name in removed_files:
+        index.pop(file_name, None)
+    index.update(entries)
+    save_file_index(cwd, sn, index)
+    print(f'Updated file index for {sn}')
+
+# Split the indexed files into those fully inside the date range and those that only partly overlap it
+def prune_files(index, start_date, end_date):
+    start_ns, end_ns = start_date.value, end_date.value
+    inside, partial = [], []
+    for file_name, entry in sorted(index.items()):
+        if entry['max_datetime_ns'] < start_ns or entry['min_datetime_ns'] > end_ns:
+            continue
+        if start_ns <= entry['min_datetime_ns'] and entry['max_datetime_ns'] <= end_ns:
+            inside.append(file_name)
+        else:
+            partial.append(file_name)
+    return inside, partial
@@ -0,0 +1,116 @@
+import os
+import json
+from functools import reduce
+import numpy as np
+import pandas as pd
+from data_processing import query_files
+from storage import read_sweeping_file, sweeping_file_path
+from events import read_events
+from aggregates import file_aggregates, combine_aggregates, column_moments, load_file_aggregates, file_aggregates_path, aggregate_statistics
+from sketches import file_sketches, sketch_dir, table_quantiles, DURATION_COLUMN, SKETCH_TABLE_COLUMNS
+from stats import STAT_COLUMNS
+from worker_pool import submit_task
+from metrics import timed_stage
+
+# Statistics the SNs of a fleet are ranked by, highest first: ranking name -> function of the statistics of an SN
+FLEET_RANKINGS = {
+    'Proportion NozGapOpen %': lambda stats: stats['nozgapopen_stats_dict'].get('Proportion NozGapOpen %'),
+    'Total Fuel Consumed (L)': lambda stats: stats['total_fuel_consumed'],
+    'Fuel per Sweeping Hour (L/hr)': lambda stats: stats['fuel_per_hour'],
+    'Mean Fuel Rate (L/hr)': lambda stats: stats['fuel_dicts']['All Data'].get('Mean Fuel Rate (L/hr)'),
+    'Mean Engine Speed (rpm)': lambda stats: stats['fuel_dicts']['All Data'].get('Mean Engine Speed (rpm)'),
+    'Mean Fan Speed (rpm)': lambda stats: stats['fuel_dicts']['All Data'].get('Mean Fan Speed (rpm)'),
+    'Total Time (hrs)': lambda stats: stats['fuel_dicts']['All Data']['Total Time (hrs)']
+}
+
+# Statistics of an SN between start_date and end_date, with the aggregate of its sweeping rows and its sketches merged
+# over the range they are computed from, for the fleet to combine. Runs in a worker, and raises errors for the parent
+# to report against the SN. Files inside the range contribute their stored aggregate and sketches; only the rows of
+# files that partly overlap it are read, and aggregated and sketched. NozGapOpen events are those overlapping the
+# range, clipped to it, as in /get_data
+def sn_range_aggregate(cwd, sn, start_date, end_date, inside_files, partial_files):
+    with open(file_aggregates_path(cwd, sn), 'r') as f:
+        files = json.load(f)
+    events = read_events(cwd, sn, 'NozGapOpen', start_date, end_date)
+    parts = [files[file_name] for file_name in inside_files if file_name in files]
+    sketches = [pd.read_parquet(f'{sketch_dir(cwd, sn)}/{file_name}.parquet', engine='pyarrow') for file_name in inside_files
+                if os.path.exists(f'{sketch_dir(cwd, sn)}/{file_name}.parquet')]
+    for file_name in partial_files:
+        df = read_sweeping_file(sweeping_file_path(cwd, sn, file_name), start_date, end_date)
+        if not df.empty:
+            file_events = events[events['file'] == file_name]
+            parts.append(file_aggregates(df, file_events))
+            sketches.append(file_sketches(df, file_events))
+    if parts == []:
+        return None, None, None
+
+    total = reduce(combine_aggregates, parts)
+    total['events'] = {'NozGapOpen': column_moments(events['duration_s'].to_numpy())}
+    sketches = pd.concat(sketches, ignore_index=True) if sketches else pd.DataFrame(columns=SKETCH_TABLE_COLUMNS)
+    sketch = sketches.groupby(['column', 'category', 'sign', 'bucket'], as_index=False)['count'].sum()
+    return range_statistics(total, sketch), total, sketch
+
+# Statistics in the layout of /get_data from an aggregate, with medians estimated from the merged sketches
+def range_statistics(total, sketch):
+    statistics = aggregate_statistics(total)
+    medians = table_quantiles(sketch) if sketch is not None and not sketch.empty else {}
+    for column, (name, unit, _) in STAT_COLUMNS.items():
+        for category, quantiles in medians.get(column, {}).items():
+            if category in statistics['fuel_dicts']:
+                statistics['fuel_dicts'][category][f'Median {name} ({unit})'] = quantiles[0.5]
+    if statistics['nozgapopen_stats_dict'] and DURATION_COLUMN in medians:
+        statistics['nozgapopen_stats_dict']['Median NozGapOpen Duration (s)'] = medians[DURATION_COLUMN]['All Data'][0.5]
+    hours = statistics['fuel_dicts']['All Data']['Total Time (hrs)']
+    statistics['fuel_per_hour'] = statistics['total_fuel_consumed'] / hours if hours > 0 else float('nan')
+    return statistics
+
+# SNs ranked by each of FLEET_RANKINGS, highest first, as [sn, value] pairs, keeping the first limit of each
+def fleet_rankings(sn_statistics, limit=None):
+    rankings = {}
+    for name, value_of in FLEET_RANKINGS.items():
+        values = [(sn, value_of(statistics)) for sn, statistics in sn_statistics.items()]
+        values = [(sn, float(value)) for sn, value in values if value is not None and not np.isnan(value)]
+        values.sort(key=lambda item: (-item[1], item[0]))
+        rankings[name] = [list(item) for item in values[:limit]]
+    return rankings
+
+# Statistics of every SN and of the whole fleet between start_date and end_date, and the SNs ranked by each of
+# FLEET_RANKINGS. SNs are aggregated in parallel on the worker pool from their per-file aggregates, so no rows are
+# loaded beyond those of the files that partly overlap the range, one file at a time. SNs that fail to aggregate are
+# left out of the fleet and reported with their error in 'errors'; the fleet is None if every SN with data failed
+@timed_stage('fleet_statistics')
+def fleet_statistics(cwd, sns, start_date, end_date, limit=None):
+    start_date = pd.to_datetime(start_date)
+    end_date = pd.to_datetime(end_date)
+
+    # Stores are only written from the parent: legacy imports, the file index and missing per-file aggregates
+    # are brought up to date here before the workers read them
+    futures = {}
+    for sn in sorted(sns):
+        _, inside_files, partial_files = query_files(cwd, sn, start_date, end_date)
+        if inside_files + partial_files == []:
+            continue
+        if not os.path.exists(file_aggregates_path(cwd, sn)):
+            load_file_aggregates(cwd, sn)
+        futures[sn] = submit_task(sn_range_aggregate, cwd, sn, start_date, end_date, inside_files, partial_files)
+
+    sn_statistics, totals, sketches, errors = {}, [], [], {}
+    for sn, future in futures.items():
+        try:
+            statistics, total, sketch = future.result()
+        except Exception as e:
+            print(f'Error aggregating {sn} for the fleet:', e)
+            errors[sn] = str(e)
+            continue
+        if statistics is None:
+            continue
+        sn_statistics[sn] = statistics
+        totals.append(total)
+        sketches.append(sketch)
+    if totals == []:
+        return {'fleet': None, 'sns': {}, 'rankings': {}, 'errors': errors} if errors else None
+
+    # The fleet is the combination of its SNs: moments merge exactly, sketches merge by adding bucket counts
+    fleet = range_statistics(reduce(combine_aggregates, totals), pd.concat(sketches, ignore_index=True))
+    fleet['num_of_sns'] = len(sn_statistics)
+    return {'fleet': fleet, 'sns': sn_statistics, 'rankings': fleet_rankings(sn_statistics, limit), 'errors': errors}
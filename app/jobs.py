@@ -0,0 +1,117 @@
+import os
+import time
+import uuid
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from metrics import JOB_SECONDS
+
+# Number of jobs run at once and number of finished jobs kept for status polling, configurable through the environment.
+# Jobs ingesting the same SN at once are safe, as every write to the stores of an SN holds its write lock
+# (utils.sn_write_lock), and video jobs share one cap on the encoders they run (video_processing.VIDEO_SLOTS)
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+MAX_FINISHED_JOBS = int(os.environ.get('MAX_FINISHED_JOBS', 200))
+
+# A background job and its per-stage progress
+class Job:
+    def __init__(self, kind):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.status = 'queued'
+        self.stage = None
+        self.stages = OrderedDict()
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.updated = self.created
+        self.lock = threading.Lock()
+
+    # Record the progress of a stage, as a fraction between 0 and 1
+    def set_progress(self, stage, fraction):
+        with self.lock:
+            self.stage = stage
+            self.stages[stage] = round(min(max(fraction, 0.0), 1.0), 3)
+            self.updated = time.time()
+
+    # Publish the result so far while the job is still running
+    def set_result(self, result):
+        with self.lock:
+            self.result = result
+            self.updated = time.time()
+
+    # Status of the job as a JSON serializable dictionary
+    def to_dict(self):
+        with self.lock:
+            return {
+                'job_id': self.id,
+                'kind': self.kind,
+                'status': self.status,
+                'stage': self.stage,
+                'stages': dict(self.stages),
+                'result': self.result,
+                'error': self.error,
+                'created': self.created,
+                'updated': self.updated
+            }
+
+# Runs jobs on a bounded thread pool and keeps their status for polling
+class JobManager:
+    def __init__(self, max_workers=JOB_WORKERS, max_finished_jobs=MAX_FINISHED_JOBS):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='job')
+        self.max_finished_jobs = max_finished_jobs
+        self.jobs = OrderedDict()
+        self.lock = threading.Lock()
+
+    # Queue fn(job, *args) to run in the background and return the job id straight away
+    def submit(self, kind, fn, *args):
+        job = Job(kind)
+        with self.lock:
+            self.jobs[job.id] = job
+            self._forget_finished_jobs()
+        self.executor.submit(self._run, job, fn, *args)
+        return job.id
+
+    # Get the status of a job, or None if it is unknown
+    def get(self, job_id):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        return job.to_dict() if job is not None else None
+
+    # Get the status of every known job, most recent first
+    def list(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return [job.to_dict() for job in reversed(jobs)]
+
+    # Count the known jobs by status
+    def status_counts(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        counts = {(status,): 0 for status in ('queued', 'running', 'done', 'failed')}
+        for job in jobs:
+            counts[(job.status,)] += 1
+        return counts
+
+    def _run(self, job, fn, *args):
+        with job.lock:
+            job.status = 'running'
+            job.updated = time.time()
+        started = time.perf_counter()
+        try:
+            result = fn(job, *args)
+            with job.lock:
+                job.result = result
+                job.status = 'done'
+        except Exception as e:
+            print(f'Error running {job.kind} job {job.id}:', e)
+            with job.lock:
+                job.error = str(e)
+                job.status = 'failed'
+        with job.lock:
+            job.updated = time.time()
+        JOB_SECONDS.observe(time.perf_counter() - started, kind=job.kind, status=job.status)
+
+    def _forget_finished_jobs(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status in ('done', 'failed')]
+        for job_id in finished[:max(len(finished) - self.max_finished_jobs, 0)]:
+            del self.jobs[job_id]
@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+# Logs are sampled at 10 Hz
+SAMPLE_INTERVAL_S = 0.1
+# Number of data rows parsed per chunk
+CHUNK_ROWS = 100000
+# Format of the datetime column wherever it is written as text
+DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Compact dtypes of the log columns, applied once as a log is parsed and kept through storage and queries: 0/1 flags
+# as uint8, fuel totals and the fuel derived from them as float64, which keeps their resolution over a whole log,
+# and every other sensor as float32. datetime stays datetime64, stored as int64 epoch timestamps, and time as text
+FLAG_COLUMNS = ['Nozzle1downTMSCS', 'Nozzle2downTMS', 'NozGapOpen']
+FLOAT64_COLUMNS = ['TotalFuelConsumption', 'fuel_consumed', 'cumulative_fuel_consumed']
+TEXT_COLUMNS = ['time', 'datetime']
+
+# Cast the values of a parsed column to its compact dtype. A missing flag reading is stored as 0, which is how
+# every comparison with 1.0 already read it
+def schema_array(column, values):
+    if column in TEXT_COLUMNS or values.dtype.kind not in 'fiub':
+        return values
+    if column in FLAG_COLUMNS:
+        return np.nan_to_num(values.astype(np.float64), nan=0.0).astype(np.uint8)
+    if column in FLOAT64_COLUMNS:
+        return values.astype(np.float64)
+    return values.astype(np.float32)
+
+# Get the date of a log from its file name format 'SN213390_YYYY_MM_DD_HHMM.log'
+def log_date(file_name):
+    return '-'.join(file_name.split('/')[-1].split('_')[1:4])
+
+# Read the header of a log file up to the start of the [data] section and return the column names
+def read_log_header(f):
+    columns = []
+    prev_line = ''
+    while True:
+        line = f.readline()
+        if line == '':
+            return columns
+        if prev_line.startswith('[column names]'):
+            columns = [c for c in line.strip().split(' ') if c != '']
+        if line.startswith('[data]'):
+            return columns
+        prev_line = line
+
+# Parse the [data] section of an open log file in chunks, adding the derived columns to each chunk
+def iter_log_chunks(f, date, chunk_rows=CHUNK_ROWS):
+    columns = read_log_header(f)
+    if columns == []:
+        return
+
+    cumulative_fuel = 0.0
+    reader = pd.read_csv(f, sep=' ', names=columns, header=None, index_col=False, skip_blank_lines=True,
+                         dtype={'time': str}, chunksize=chunk_rows)
+    for chunk in reader:
+        if chunk.empty:
+            continue
+        chunk['fuel_consumed'] = chunk['EngineFuelRateTMSCS'] * (SAMPLE_INTERVAL_S / 3600)
+        chunk['cumulative_fuel_consumed'] = chunk['fuel_consumed'].cumsum() + cumulative_fuel
+        cumulative_fuel = chunk['cumulative_fuel_consumed'].iloc[-1]
+        chunk['datetime'] = pd.to_datetime(date + ' ' + chunk['time'], format=DATETIME_FORMAT)
+        yield chunk
+
+# Parse text datetimes with their format. Text written by older versions may leave out the fractional seconds, and is
+# parsed as any ISO 8601 datetime where pandas supports it, or inferred otherwise
+def parse_datetimes(values):
+    for datetime_format in [DATETIME_FORMAT, 'ISO8601']:
+        try:
+            return pd.to_datetime(values, format=datetime_format)
+        except ValueError:
+            pass
+    return pd.to_datetime(values)
+
+# Cast the columns of a DataFrame read back from text to their compact dtypes, parsing datetime once
+def apply_schema(df):
+    for column in df.columns:
+        if column == 'datetime':
+            df['datetime'] = parse_datetimes(df['datetime'])
+        else:
+            df[column] = schema_array(column, df[column].to_numpy())
+    return df
+
+# Rows where the truck is sweeping, Nozzle1downTMSCS or Nozzle2downTMS == 1.0
+def sweeping_mask(chunk):
+    return ((chunk['Nozzle1downTMSCS'] == 1.0) | (chunk['Nozzle2downTMS'] == 1.0)).to_numpy()
+
+# Parse an open log file in a single pass into column arrays of the compact dtypes and the sweeping mask
+def parse_log(f, date, chunk_rows=CHUNK_ROWS):
+    parts = {}
+    masks = []
+    for chunk in iter_log_chunks(f, date, chunk_rows):
+        for column in chunk.columns:
+            parts.setdefault(column, []).append(schema_array(column, chunk[column].to_numpy()))
+        masks.append(sweeping_mask(chunk))
+
+    columns = {column: np.concatenate(arrays) for column, arrays in parts.items()}
+    sweeping = np.concatenate(masks) if masks else np.zeros(0, dtype=bool)
+    return columns, sweeping
+
+# Parse a log file on disk into column arrays and the sweeping mask
+def parse_log_file(log_path, chunk_rows=CHUNK_ROWS):
+    with open(log_path, 'r') as f:
+        return parse_log(f, log_date(log_path), chunk_rows)
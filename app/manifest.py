@@ -0,0 +1,128 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from contextlib import closing
+from datetime import datetime, timezone
+from utils import UPLOAD_CHUNK_SIZE
+
+# Manifest of every ingested log and processed video: kind, name, content hash, size, SN and session time. A name
+# maps to the content last ingested under it, and content is looked up by hash whatever name it arrives under
+MANIFEST_COLUMNS = ['kind', 'name', 'sha256', 'size', 'sn', 'session', 'ingested_at']
+MANIFEST_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS files (
+    kind TEXT NOT NULL,
+    name TEXT NOT NULL,
+    sha256 TEXT,
+    size INTEGER,
+    sn TEXT,
+    session TEXT,
+    ingested_at TEXT,
+    PRIMARY KEY (kind, name)
+);
+CREATE INDEX IF NOT EXISTS files_by_hash ON files (kind, sha256);
+'''
+# Serializes building the manifest of files ingested before it existed
+MANIFEST_BUILD_LOCK = threading.Lock()
+
+# Path of the manifest database
+def manifest_path(cwd):
+    return f'{cwd}/data/manifest.db'
+
+# Open the manifest, building it from the ingested logs and processed videos if there is none yet
+def connect_manifest(cwd):
+    with MANIFEST_BUILD_LOCK:
+        exists = os.path.exists(manifest_path(cwd))
+        os.makedirs(os.path.dirname(manifest_path(cwd)), exist_ok=True)
+        connection = sqlite3.connect(manifest_path(cwd), timeout=30)
+        connection.executescript(MANIFEST_SCHEMA)
+        if not exists:
+            build_manifest(cwd, connection)
+    return connection
+
+# SHA-256 and size of the content read from a binary file object, in chunks
+def hash_stream(stream):
+    sha256 = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(UPLOAD_CHUNK_SIZE), b''):
+        sha256.update(chunk)
+        size += len(chunk)
+    return sha256.hexdigest(), size
+
+def hash_file(path):
+    with open(path, 'rb') as f:
+        return hash_stream(f)
+
+# Session start time of a file from its SN_YYYY_MM_DD_HHMM session name, as ISO 8601, or None if it has none
+def session_time(session_name):
+    try:
+        return datetime.strptime('_'.join(session_name.split('_')[1:5]), '%Y_%m_%d_%H%M').isoformat()
+    except ValueError:
+        return None
+
+# Session name (SN_YYYY_MM_DD_HHMM) of a video, which is named <camera>_<session name>_<part>.<ext>
+def video_session_name(video_name):
+    return '_'.join(video_name.split('_')[-6:-1])
+
+# Manifest row of a file
+def manifest_entry(kind, name, sha256, size, sn, session):
+    return {
+        'kind': kind,
+        'name': name,
+        'sha256': sha256,
+        'size': size,
+        'sn': sn,
+        'session': session,
+        'ingested_at': datetime.now(timezone.utc).isoformat()
+    }
+
+# Add or replace the rows of files in the manifest, through the given connection or one of its own
+def record_files(cwd, entries, connection=None):
+    if entries == []:
+        return
+    conn = connection or connect_manifest(cwd)
+    try:
+        with conn:
+            conn.executemany(f"INSERT OR REPLACE INTO files ({', '.join(MANIFEST_COLUMNS)}) VALUES ({', '.join('?' * len(MANIFEST_COLUMNS))})",
+                             [[entry[column] for column in MANIFEST_COLUMNS] for entry in entries])
+    finally:
+        if connection is None:
+            conn.close()
+    print(f'Recorded {len(entries)} files in manifest')
+
+# Check an uploaded file against the manifest through its indexes, without listing any directory:
+#   ('duplicate', name) - the same content was already ingested, under that name
+#   ('changed', name)   - different content was already ingested under this name
+#   ('new', None)       - neither the content nor the name is known
+# Rows without a hash, recorded for videos processed before the manifest existed, match by name only
+def check_file(cwd, kind, name, sha256):
+    with closing(connect_manifest(cwd)) as conn:
+        row = conn.execute('SELECT name FROM files WHERE kind = ? AND sha256 = ? LIMIT 1', (kind, sha256)).fetchone()
+        if row is not None:
+            return 'duplicate', row[0]
+        row = conn.execute('SELECT sha256 FROM files WHERE kind = ? AND name = ?', (kind, name)).fetchone()
+    if row is None:
+        return 'new', None
+    return ('duplicate', name) if row[0] is None else ('changed', name)
+
+# Record the logs whose CSVs exist and the processed videos, which were ingested before the manifest existed
+def build_manifest(cwd, connection):
+    entries = []
+    data_dir = f'{cwd}/data'
+    for sn in sorted(os.listdir(data_dir)):
+        log_dir = f'{data_dir}/{sn}/log_files'
+        for log_file in sorted(os.listdir(log_dir)) if os.path.isdir(log_dir) else []:
+            if log_file.endswith('.log') and os.path.exists(f'{data_dir}/{sn}/csv_files/{log_file[:-4]}.csv'):
+                try:
+                    sha256, size = hash_file(f'{log_dir}/{log_file}')
+                    entries.append(manifest_entry('log', log_file, sha256, size, sn, session_time(log_file[:-4])))
+                except Exception as e:
+                    print(f'Error hashing log file: {log_file}', e)
+
+    # The uploads of processed videos are not kept, so their content is unknown and they match by name
+    video_dir = f'{cwd}/app/static/videos'
+    for sn in sorted(os.listdir(video_dir)) if os.path.isdir(video_dir) else []:
+        for video in sorted(os.listdir(f'{video_dir}/{sn}')) if os.path.isdir(f'{video_dir}/{sn}') else []:
+            entries.append(manifest_entry('video', video, None, None, sn, session_time(video_session_name(video))))
+    record_files(cwd, entries, connection)
+    print('Built manifest')
@@ -0,0 +1,168 @@
+import time
+import bisect
+import threading
+from functools import wraps
+
+# Upper bounds (seconds) of the latency histogram buckets, from a cached request to a long video merge
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Metrics in the order they are exposed
+_registry = []
+
+# Escape a label value for the Prometheus text format
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+# Format a sample line with its labels
+def format_sample(name, label_names, label_values, value, extra_labels=()):
+    labels = [f'{n}="{escape_label(v)}"' for n, v in list(zip(label_names, label_values)) + list(extra_labels)]
+    label_text = '{' + ','.join(labels) + '}' if labels else ''
+    return f'{name}{label_text} {format_value(value)}'
+
+# Format a sample value, writing whole numbers without a fraction
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    value = float(value)
+    if value != value:
+        return 'NaN'
+    if value in (float('inf'), float('-inf')):
+        return '+Inf' if value > 0 else '-Inf'
+    return str(int(value)) if value.is_integer() else repr(value)
+
+# Base of the metric types: a name, help text and label names, with values kept per tuple of label values
+class Metric:
+    type = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help_text = help_text
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    # Sample lines of the metric
+    def samples(self):
+        with self.lock:
+            values = dict(self.values)
+        return [format_sample(self.name, self.labels, key, value) for key, value in sorted(values.items())]
+
+# A count that only goes up
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+# A value that is set, or read from a function when the metrics are collected. The function returns a number, or a
+# dictionary of numbers keyed by tuples of label values
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name, help_text, labels=(), function=None):
+        super().__init__(name, help_text, labels)
+        self.function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        self.function = function
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                value = self.function()
+                with self.lock:
+                    self.values = dict(value) if isinstance(value, dict) else {(): value}
+            except Exception as e:
+                print(f'Error collecting {self.name}:', e)
+        return super().samples()
+
+# Counts of observations in cumulative buckets, with their sum and count
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        with self.lock:
+            values = {key: (list(counts), total) for key, (counts, total) in self.values.items()}
+        lines = []
+        for key, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                lines.append(format_sample(f'{self.name}_bucket', self.labels, key, cumulative, [('le', format_value(bound))]))
+            lines.append(format_sample(f'{self.name}_sum', self.labels, key, total))
+            lines.append(format_sample(f'{self.name}_count', self.labels, key, cumulative))
+        return lines
+
+# Every metric in the Prometheus text exposition format
+def render_metrics():
+    lines = []
+    for metric in _registry:
+        lines.append(f'# HELP {metric.name} {metric.help_text}')
+        lines.append(f'# TYPE {metric.name} {metric.type}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+# Pipeline metrics. Stages running in worker processes report their timings back with their results, and are
+# recorded by the parent, as workers do not share these values
+STAGE_SECONDS = Histogram('sweep_stage_duration_seconds', 'Time spent in each stage of the ingest, query, plot and video pipelines', ['stage'])
+REQUEST_SECONDS = Histogram('sweep_http_request_duration_seconds', 'Latency of HTTP requests by endpoint', ['endpoint'])
+REQUESTS = Counter('sweep_http_requests_total', 'HTTP requests by endpoint and status code', ['endpoint', 'status'])
+JOB_SECONDS = Histogram('sweep_job_duration_seconds', 'Run time of background jobs by kind and final status', ['kind', 'status'])
+UPLOAD_BYTES = Counter('sweep_upload_bytes_total', 'Bytes received by uploads by file type', ['kind'])
+FILES_INGESTED = Counter('sweep_files_ingested_total', 'Log files processed at ingest by result', ['status'])
+ROWS_PARSED = Counter('sweep_rows_parsed_total', 'Rows parsed from log files')
+QUERY_FILES = Counter('sweep_query_files_total', 'Sweeping files considered by queries: pruned by the file index, read whole, or filtered by date', ['result'])
+ROWS_QUERIED = Counter('sweep_rows_queried_total', 'Sweeping rows loaded or streamed to compute statistics', ['mode'])
+CACHE_REQUESTS = Counter('sweep_result_cache_requests_total', 'Lookups in the /get_data result cache by result', ['result'])
+PLOTS_DRAWN = Counter('sweep_plots_total', 'Figures returned by draw_plots, rendered or served from the graph cache', ['result'])
+VIDEOS = Counter('sweep_videos_total', 'Uploaded videos by result: merged, failed, or a duplicate of one already merged', ['result'])
+FRAMES_ENCODED = Counter('sweep_video_frames_encoded_total', 'Graph frames piped to video encoders')
+POOL_PENDING_TASKS = Gauge('sweep_worker_pool_pending_tasks', 'Tasks submitted to the worker pool that have not finished, queued or running')
+JOBS = Gauge('sweep_jobs', 'Known background jobs by status', ['status'])
+CACHE_ENTRIES = Gauge('sweep_result_cache_entries', 'Entries in the /get_data result cache')
+CACHE_BYTES = Gauge('sweep_result_cache_bytes', 'Size of the entries in the /get_data result cache')
+
+# Time a stage, observing its duration whether it succeeds or fails
+class stage_timer:
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, stage=self.stage)
+        return False
+
+# Decorate a function to time each call as a stage
+def timed_stage(stage):
+    def decorate(function):
+        @wraps(function)
+        def timed(*args, **kwargs):
+            with stage_timer(stage):
+                return function(*args, **kwargs)
+        return timed
+    return decorate
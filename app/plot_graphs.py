@@ -1,43 +1,44 @@
+import os
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
+import pandas as pd
+import hashlib
+from utils import write_atomically
+from worker_pool import submit_task
+from metrics import timed_stage, PLOTS_DRAWN
 
 # Set backend for matplotlib to 'Agg' to support non-interactive environments
 plt.switch_backend('Agg')
 
+# Draw a histogram from precomputed bin edges and counts
+def plot_binned_hist(edges, counts, **kwargs):
+    plt.hist(edges[:-1], bins=edges, weights=counts, **kwargs)
+
 # Plot the distribution of NozGapOpen event durations
-def plot_nozgapopen_durations_dist(cwd, sn, nozgap_event_durations):
+def plot_nozgapopen_durations_dist(path, durations):
     plt.figure(figsize=(12, 6))
-    plt.hist(nozgap_event_durations, bins=30, alpha=0.7)
-    plt.xticks(np.arange(0, max(nozgap_event_durations), step=100))
-    plt.xlim(0, max(nozgap_event_durations))  # Limit x-axis range
+    plot_binned_hist(durations['edges'], durations['counts'], alpha=0.7)
+    plt.xticks(np.arange(0, durations['edges'][-1], step=100))
+    plt.xlim(0, durations['edges'][-1])  # Limit x-axis range
     plt.title('Distribution of NozGapOpen Events Duration')
     plt.xlabel('Duration (seconds)')
     plt.ylabel('Frequency')
-    plt.savefig(f'{cwd}/app/static/graphs/{sn}/nozgapopen_durations_dist_plot.png')  # Save plot
+    plt.savefig(path, format='png')  # Save plot
     plt.close()
 
 # Plot the correlation matrix for selected columns
-def plot_corr_matrix(cwd, sn, df):
+def plot_corr_matrix(path, correlation_matrix):
     plt.figure(figsize=(12, 6))
-    correlation_matrix = df[['EngineSpeed', 'FanSpeed', 'EngineFuelRateTMSCS', 'NozGapOpen']].corr()
     sns.heatmap(correlation_matrix, annot=True, cmap='coolwarm')  # Create heatmap
     plt.title('Correlation Matrix')
-    plt.savefig(f'{cwd}/app/static/graphs/{sn}/correlation_matrix.png')  # Save plot
+    plt.savefig(path, format='png')  # Save plot
     plt.close()
 
 # Plot the total NozGapOpen duration per bin
-def plot_total_nozgapopen_duration_per_bin(cwd, sn, nozgap_event_durations):
-    nozgap_event_durations = np.array(nozgap_event_durations)  # Convert to NumPy array
-
-    # Create histogram to get bin edges
-    counts, bin_edges = np.histogram(nozgap_event_durations, bins=30)
-
-    # Calculate total duration for each bin
-    total_durations = np.zeros_like(counts, dtype=float)
-    for i in range(len(bin_edges) - 1):
-        bin_mask = (nozgap_event_durations >= bin_edges[i]) & (nozgap_event_durations < bin_edges[i+1])
-        total_durations[i] = nozgap_event_durations[bin_mask].sum() / 3600  # Convert to hours
+def plot_total_nozgapopen_duration_per_bin(path, durations):
+    bin_edges = durations['edges']
+    total_durations = durations['totals'] / 3600  # Convert to hours
 
     # Plotting
     plt.figure(figsize=(12, 6))
@@ -52,57 +53,144 @@ def plot_total_nozgapopen_duration_per_bin(cwd, sn, nozgap_event_durations):
     plt.title('Total Duration of NozGapOpen Events per Bin')
     plt.xlabel('Duration (minutes)')
     plt.ylabel('Total Duration (hours)')
-    plt.savefig(f'{cwd}/app/static/graphs/{sn}/total_nozgapopen_durations_plot.png')  # Save plot
+    plt.savefig(path, format='png')  # Save plot
     plt.close()
 
 # Plot the distribution of fuel rate
-def plot_fuel_rate_dist(cwd, sn, dfs):
+def plot_fuel_rate_dist(path, binned):
     plt.figure(figsize=(12, 6))
-    for key in dfs.keys():
-        plt.hist(dfs[key]['EngineFuelRateTMSCS'], bins=50, alpha=0.7, label=key)
+    histogram = binned['columns']['EngineFuelRateTMSCS']
+    for key in binned['categories']:
+        plot_binned_hist(histogram['edges'], histogram['counts'][key], alpha=0.7, label=key)
     plt.title('Distribution of Fuel Rate')
     plt.xlabel('Fuel Rate (L/h)')
     plt.ylabel('Frequency')
     plt.legend()
     plt.yticks([])  # Hide y-axis numbers
     plt.xticks(np.arange(0, 25, step=1))
-    plt.savefig(f'{cwd}/app/static/graphs/{sn}/fuel_rate_dist_plot.png')  # Save plot
+    plt.savefig(path, format='png')  # Save plot
     plt.close()
 
 # Plot the distribution of fan speed
-def plot_fan_speed_dist(cwd, sn, dfs):
+def plot_fan_speed_dist(path, binned):
     plt.figure(figsize=(12, 6))
-    for key in dfs.keys():
-        plt.hist(dfs[key]['FanSpeed'], bins=30, alpha=0.7, label=key)
+    histogram = binned['columns']['FanSpeed']
+    for key in binned['categories']:
+        plot_binned_hist(histogram['edges'], histogram['counts'][key], alpha=0.7, label=key)
     plt.yticks([])  # Hide y-axis numbers
     plt.xticks(np.arange(0, 3600, step=200))
     plt.title('Distribution of Fan Speed')
     plt.xlabel('Fan Speed (rpm)')
     plt.ylabel('Frequency')
     plt.legend()
-    plt.savefig(f'{cwd}/app/static/graphs/{sn}/fan_speed_dist_plot.png')  # Save plot
+    plt.savefig(path, format='png')  # Save plot
     plt.close()
 
 # Plot the distribution of engine speed
-def plot_engine_speed_dist(cwd, sn, dfs):
+def plot_engine_speed_dist(path, binned):
     plt.figure(figsize=(12, 6))
-    for key in dfs.keys():
-        plt.hist(dfs[key]['EngineSpeed'], bins=30, alpha=0.7, label=key)
+    histogram = binned['columns']['EngineSpeed']
+    for key in binned['categories']:
+        plot_binned_hist(histogram['edges'], histogram['counts'][key], alpha=0.7, label=key)
     plt.yticks([])  # Hide y-axis numbers
     plt.xticks(np.arange(800, 2200, step=100))
     plt.title('Distribution of Engine Speed')
     plt.xlabel('Engine Speed (rpm)')
     plt.ylabel('Frequency')
     plt.legend()
-    plt.savefig(f'{cwd}/app/static/graphs/{sn}/engine_speed_dist_plot.png')  # Save plot
+    plt.savefig(path, format='png')  # Save plot
     plt.close()
 
-# Generate all plots
-def draw_plots(cwd, sn, dfs, nozgap_event_durations):
-    print("Drawing plots...")
-    plot_nozgapopen_durations_dist(cwd, sn, nozgap_event_durations)
-    plot_total_nozgapopen_duration_per_bin(cwd, sn, nozgap_event_durations)
-    plot_fuel_rate_dist(cwd, sn, dfs)
-    plot_engine_speed_dist(cwd, sn, dfs)
-    plot_fan_speed_dist(cwd, sn, dfs)
-    plot_corr_matrix(cwd, sn, dfs['All Data'])
+# Selector of the binned data of one column, the only input of its distribution plot
+def column_inputs(column):
+    return lambda binned: {'categories': binned['categories'], 'columns': {column: binned['columns'][column]}}
+
+# Plots drawn for a result: file name prefix -> (plot function, selector of its inputs from the binned data)
+PLOTS = {
+    'nozgapopen_durations_dist_plot': (plot_nozgapopen_durations_dist, lambda binned: binned['durations']),
+    'total_nozgapopen_durations_plot': (plot_total_nozgapopen_duration_per_bin, lambda binned: binned['durations']),
+    'fuel_rate_dist_plot': (plot_fuel_rate_dist, column_inputs('EngineFuelRateTMSCS')),
+    'engine_speed_dist_plot': (plot_engine_speed_dist, column_inputs('EngineSpeed')),
+    'fan_speed_dist_plot': (plot_fan_speed_dist, column_inputs('FanSpeed')),
+    'correlation_matrix': (plot_corr_matrix, lambda binned: binned['correlation'])
+}
+# Bump when the look of the plots changes, so figures cached under the old style are not reused
+PLOT_STYLE_VERSION = 1
+# Rendered figures kept per SN; the least recently used beyond this are removed
+GRAPH_CACHE_MAX_FILES = int(os.environ.get('GRAPH_CACHE_MAX_FILES', 600))
+
+# Feed the contents of plot inputs (arrays, DataFrames, dictionaries, lists and scalars) to a hash
+def hash_plot_inputs(digest, value):
+    if isinstance(value, dict):
+        for key in sorted(value, key=str):
+            digest.update(repr(key).encode())
+            hash_plot_inputs(digest, value[key])
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            hash_plot_inputs(digest, item)
+    elif isinstance(value, pd.DataFrame):
+        hash_plot_inputs(digest, [list(value.columns), list(value.index), value.to_numpy()])
+    elif isinstance(value, np.ndarray):
+        digest.update(f'{value.dtype}{value.shape}'.encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    else:
+        digest.update(repr(value).encode())
+
+# File name of a plot, addressed by a hash of its inputs and the plot style
+def plot_file_name(name, inputs):
+    digest = hashlib.sha1(f'{name}:{PLOT_STYLE_VERSION}'.encode())
+    hash_plot_inputs(digest, inputs)
+    return f'{name}_{digest.hexdigest()[:20]}.png'
+
+# Render one plot in a worker process, moving it into place only once it is complete
+def render_plot(function, path, inputs):
+    write_atomically(path, lambda tmp_path: function(tmp_path, inputs))
+    return path
+
+# Mark the figures of a graph directory as recently used, returning False if any was pruned from the graph cache
+def touch_graphs(graph_dir, file_names):
+    try:
+        for file_name in file_names:
+            os.utime(f'{graph_dir}/{file_name}')
+        return True
+    except FileNotFoundError:
+        return False
+
+# Remove the least recently used figures of a graph directory beyond max_files
+def prune_graph_cache(graph_dir, max_files=GRAPH_CACHE_MAX_FILES):
+    try:
+        files = [entry for entry in os.scandir(graph_dir) if entry.is_file() and entry.name.endswith('.png')]
+        if len(files) <= max_files:
+            return
+        files.sort(key=lambda entry: entry.stat().st_mtime)
+        for entry in files[:len(files) - max_files]:
+            os.remove(entry.path)
+    except Exception as e:
+        print(f'Error pruning graph cache {graph_dir}:', e)
+
+# Generate all plots into graph_dir from the binned data of calculate_statistics, rendering the missing ones in
+# parallel on the worker pool, and return their file names. Each figure is stored under a hash of its inputs,
+# so different date ranges never overwrite each other and a figure already rendered is reused
+@timed_stage('draw_plots')
+def draw_plots(graph_dir, binned):
+    os.makedirs(graph_dir, exist_ok=True)
+    file_names, futures = [], []
+    for name, (function, select_inputs) in PLOTS.items():
+        inputs = select_inputs(binned)
+        if inputs is None:
+            continue
+        file_name = plot_file_name(name, inputs)
+        path = f'{graph_dir}/{file_name}'
+        file_names.append(file_name)
+        if os.path.exists(path):
+            # Mark cached figures as recently used
+            os.utime(path)
+        else:
+            futures.append(submit_task(render_plot, function, path, inputs))
+    for future in futures:
+        future.result()
+    PLOTS_DRAWN.inc(len(futures), result='rendered')
+    PLOTS_DRAWN.inc(len(file_names) - len(futures), result='cached')
+
+    prune_graph_cache(graph_dir)
+    return file_names
@@ -0,0 +1,177 @@
+import os
+import json
+import numpy as np
+import pandas as pd
+from utils import write_atomically, sn_write_lock
+from file_index import write_json
+from log_parser import apply_schema
+
+# Downsampled levels of the signals of each log file: level name -> bucket width in seconds. The raw level keeps
+# the 10 Hz samples, every other level keeps the min, max and mean of each signal per bucket
+PYRAMID_SIGNALS = ['EngineSpeed', 'FanSpeed', 'EngineFuelRateTMSCS', 'NozGapOpen']
+PYRAMID_LEVELS = {'raw': 0.1, '1s': 1, '10s': 10, '1min': 60, '10min': 600, '1h': 3600}
+# Points returned by a series query when the request does not say, and the most a request can ask for
+DEFAULT_POINTS = 1000
+MAX_POINTS = 10000
+
+# Directory holding the pyramid of an SN, and the path of one level of one file in it
+def pyramid_dir(cwd, sn):
+    return f'{cwd}/data/{sn}/pyramid'
+
+def pyramid_file_path(cwd, sn, level, file_name):
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    return f'{pyramid_dir(cwd, sn)}/{level}/{stem}.parquet'
+
+# Path of the index of the time range of every file in the pyramid of an SN
+def pyramid_index_path(cwd, sn):
+    return f'{pyramid_dir(cwd, sn)}/index.json'
+
+# Samples or buckets as buckets: time, count, and the min, max and mean of each signal
+def as_buckets(frame):
+    if 'count' in frame.columns:
+        return frame
+    buckets = {'time': frame['time'].to_numpy(), 'count': np.ones(len(frame), dtype=np.int64)}
+    for signal in PYRAMID_SIGNALS:
+        values = frame[signal].to_numpy(dtype=np.float64)
+        buckets.update({f'{signal}_min': values, f'{signal}_max': values, f'{signal}_mean': values})
+    return pd.DataFrame(buckets)
+
+# Merge time-sorted buckets into buckets of width_ns aligned to origin_ns: min of the mins, max of the maxes
+# and the count-weighted mean of the means, skipping nan
+def aggregate_buckets(frame, width_ns, origin_ns=0):
+    frame = as_buckets(frame)
+    if frame.empty:
+        return frame
+    times = frame['time'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    keys = (times - origin_ns) // width_ns * width_ns + origin_ns
+    starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+    counts = frame['count'].to_numpy(dtype=np.int64)
+
+    buckets = {'time': keys[starts].astype('datetime64[ns]'), 'count': np.add.reduceat(counts, starts)}
+    for signal in PYRAMID_SIGNALS:
+        means = frame[f'{signal}_mean'].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(means)
+        weights = np.add.reduceat(np.where(valid, counts, 0), starts)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            buckets[f'{signal}_mean'] = np.add.reduceat(np.where(valid, means * counts, 0.0), starts) / weights
+        buckets[f'{signal}_min'] = np.fmin.reduceat(frame[f'{signal}_min'].to_numpy(dtype=np.float64), starts)
+        buckets[f'{signal}_max'] = np.fmax.reduceat(frame[f'{signal}_max'].to_numpy(dtype=np.float64), starts)
+    return pd.DataFrame(buckets)
+
+# Build every level of the pyramid of one parsed log file, each level from the one below it
+def file_pyramid(df):
+    raw = pd.DataFrame({'time': df['datetime'].to_numpy(dtype='datetime64[ns]')})
+    for signal in PYRAMID_SIGNALS:
+        raw[signal] = df[signal].to_numpy(dtype=np.float32) if signal in df.columns else np.float32('nan')
+    raw = raw.sort_values('time', kind='stable', ignore_index=True)
+
+    levels = {'raw': raw}
+    previous = raw
+    for level, width_s in PYRAMID_LEVELS.items():
+        if level != 'raw':
+            previous = aggregate_buckets(previous, int(width_s * 1e9))
+            levels[level] = previous
+    return levels
+
+# Store the levels of the pyramid of one parsed log file, returning the time range it covers in nanoseconds
+def write_pyramid_files(cwd, sn, file_name, df):
+    for level, frame in file_pyramid(df).items():
+        file_path = pyramid_file_path(cwd, sn, level, file_name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        if level != 'raw':
+            frame = frame.astype({column: np.float32 for column in frame.columns if column not in ('time', 'count')})
+        write_atomically(file_path, lambda path: frame.to_parquet(path, engine='pyarrow', compression='zstd', index=False))
+    times = df['datetime'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    return [int(times.min()), int(times.max())]
+
+# Build the pyramid of an SN from its CSV files, which hold every row of each ingested log, skipping the files
+# whose time ranges are already known
+def build_pyramid(cwd, sn, known_ranges=None):
+    index = dict(known_ranges or {})
+    csv_dir = f'{cwd}/data/{sn}/csv_files'
+    for csv_file in sorted(os.listdir(csv_dir)) if os.path.exists(csv_dir) else []:
+        if os.path.splitext(csv_file)[0] in index:
+            continue
+        try:
+            df = apply_schema(pd.read_csv(f'{csv_dir}/{csv_file}', usecols=lambda column: column in PYRAMID_SIGNALS + ['datetime']))
+            if not df.empty:
+                index[os.path.splitext(csv_file)[0]] = write_pyramid_files(cwd, sn, csv_file, df)
+        except Exception as e:
+            print(f'Error building pyramid for: {csv_file}', e)
+    os.makedirs(pyramid_dir(cwd, sn), exist_ok=True)
+    write_atomically(pyramid_index_path(cwd, sn), lambda path: write_json(path, index))
+    print(f'Built pyramid for {sn}')
+    return index
+
+# Load the pyramid index of an SN, building the pyramid if the SN has none yet
+def load_pyramid_index(cwd, sn):
+    if not os.path.exists(pyramid_index_path(cwd, sn)):
+        with sn_write_lock(cwd, sn):
+            if not os.path.exists(pyramid_index_path(cwd, sn)):
+                return build_pyramid(cwd, sn)
+    with open(pyramid_index_path(cwd, sn), 'r') as f:
+        return json.load(f)
+
+# Add or replace the time ranges of newly ingested files in the pyramid index of an SN, and remove removed_files from
+# the pyramid
+def update_pyramid_index(cwd, sn, ranges, removed_files=()):
+    for file_name in removed_files:
+        for level in PYRAMID_LEVELS:
+            if os.path.exists(pyramid_file_path(cwd, sn, level, file_name)):
+                os.remove(pyramid_file_path(cwd, sn, level, file_name))
+    if not os.path.exists(pyramid_index_path(cwd, sn)):
+        build_pyramid(cwd, sn, ranges)
+        return
+    index = load_pyramid_index(cwd, sn)
+    for file_name in removed_files:
+        index.pop(file_name, None)
+    index.update(ranges)
+    write_atomically(pyramid_index_path(cwd, sn), lambda path: write_json(path, index))
+    print(f'Updated pyramid index for {sn}')
+
+# Coarsest level still giving at least `points` buckets over the window, or the finest if none does
+def choose_level(window_ns, points):
+    chosen = 'raw'
+    for level, width_s in PYRAMID_LEVELS.items():
+        if window_ns / (width_s * 1e9) >= points:
+            chosen = level
+    return chosen
+
+# At most `points` buckets of the signals of an SN between start_date and end_date, read from the pyramid level
+# that matches the window, so the cost of a query does not grow with the length of the window
+def query_series(cwd, sn, start_date, end_date, points=DEFAULT_POINTS):
+    points = max(1, min(int(points), MAX_POINTS))
+    start_ns, end_ns = start_date.value, end_date.value
+    window_ns = max(end_ns - start_ns, 1)
+    level = choose_level(window_ns, points)
+
+    frames = []
+    for file_name, (min_ns, max_ns) in sorted(load_pyramid_index(cwd, sn).items()):
+        if max_ns < start_ns or min_ns > end_ns:
+            continue
+        frames.append(pd.read_parquet(pyramid_file_path(cwd, sn, level, file_name), engine='pyarrow',
+                                      filters=[('time', '>=', start_date), ('time', '<=', end_date)]))
+    if frames == []:
+        return None
+    frame = pd.concat(frames, ignore_index=True).sort_values('time', kind='stable', ignore_index=True)
+
+    # Merge the level down to the requested number of buckets, aligned to the start of the window
+    width_ns = max(int(PYRAMID_LEVELS[level] * 1e9), -(-window_ns // points))
+    buckets = aggregate_buckets(frame, width_ns, start_ns)
+    return level, width_ns, buckets
+
+# Series buckets as JSON serializable lists, with times in epoch milliseconds and nan as None
+def series_to_dict(level, width_ns, buckets):
+    def values(column):
+        array = buckets[column].to_numpy(dtype=np.float64)
+        return [None if np.isnan(v) else v for v in array.tolist()]
+
+    series = {
+        'level': level,
+        'bucket_s': width_ns / 1e9,
+        'time': (buckets['time'].to_numpy(dtype='datetime64[ns]').astype(np.int64) // 1000000).tolist(),
+        'count': buckets['count'].astype(int).tolist()
+    }
+    for signal in PYRAMID_SIGNALS:
+        series[signal] = {stat: values(f'{signal}_{stat}') for stat in ['min', 'max', 'mean']}
+    return series
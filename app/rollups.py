@@ -0,0 +1,163 @@
+import os
+import numpy as np
+import pandas as pd
+from utils import write_atomically, sn_write_lock
+from storage import list_sweeping_files, read_sweeping_file
+from events import event_table_path
+from log_parser import SAMPLE_INTERVAL_S
+from stats import STAT_COLUMNS
+
+# Rollups of the sweeping rows of each SN, materialized per hour and per day at ingest so trends over long ranges read
+# one row per bucket instead of every sample. Each row holds the rows of one file in one bucket, so a file ingested
+# again replaces its own rows. Sums, sums of squares, counts, min and max combine exactly across files and buckets
+ROLLUP_LEVELS = {'hourly': 'hour', 'daily': 'day'}
+# Buckets trends can be queried by, and the rollup level each is read from
+TREND_BUCKETS = {'hour': 'hourly', 'day': 'daily', 'week': 'daily', 'month': 'daily'}
+# Columns added up when rollups are combined, and those combined by their min or max
+SUM_COLUMNS = ['rows', 'nozgap_open_rows', 'fuel_consumed', 'nozgap_events', 'nozgap_event_s'] + \
+    [f'{column}_{stat}' for column in STAT_COLUMNS for stat in ['count', 'sum', 'sumsq']]
+MIN_COLUMNS = [f'{column}_min' for column in STAT_COLUMNS]
+MAX_COLUMNS = [f'{column}_max' for column in STAT_COLUMNS]
+ROLLUP_COLUMNS = ['bucket'] + SUM_COLUMNS + MIN_COLUMNS + MAX_COLUMNS
+
+# Start of the bucket holding each datetime: hours and days are floored, weeks start on Monday and months on the 1st
+def bucket_start(datetimes, bucket):
+    datetimes = pd.Series(pd.to_datetime(datetimes))
+    if bucket == 'hour':
+        return datetimes.dt.floor('h')
+    if bucket == 'day':
+        return datetimes.dt.floor('D')
+    return datetimes.dt.to_period('W' if bucket == 'week' else 'M').dt.start_time
+
+# Combine rollups into buckets of the given size: sums are added, mins and maxes are taken
+def resample_rollups(rollups, bucket):
+    if rollups.empty:
+        return pd.DataFrame(columns=ROLLUP_COLUMNS)
+    grouped = rollups[ROLLUP_COLUMNS].assign(bucket=bucket_start(rollups['bucket'], bucket).to_numpy()).groupby('bucket', sort=True)
+    combined = pd.concat([grouped[SUM_COLUMNS].sum(), grouped[MIN_COLUMNS].min(), grouped[MAX_COLUMNS].max()], axis=1)
+    return combined.reset_index()[ROLLUP_COLUMNS]
+
+# Hourly rollups of the sweeping rows and NozGapOpen events of one file, events counted in the hour they start
+def file_rollups(sweeping_df, nozgap_events):
+    nozzle_open = sweeping_df['NozGapOpen'].to_numpy() == 1.0
+    rows = {
+        'bucket': sweeping_df['datetime'].dt.floor('h').to_numpy(),
+        'rows': np.ones(len(sweeping_df), dtype=np.int64),
+        'nozgap_open_rows': nozzle_open.astype(np.int64),
+        'fuel_consumed': sweeping_df['fuel_consumed'].to_numpy(dtype=np.float64)
+    }
+    for column in STAT_COLUMNS:
+        values = sweeping_df[column].to_numpy(dtype=np.float64)
+        rows.update({f'{column}_count': (~np.isnan(values)).astype(np.int64), f'{column}_sum': values, f'{column}_sumsq': values ** 2,
+                     f'{column}_min': values, f'{column}_max': values})
+    rows['nozgap_events'] = np.zeros(len(sweeping_df), dtype=np.int64)
+    rows['nozgap_event_s'] = np.zeros(len(sweeping_df))
+    grouped = pd.DataFrame(rows).groupby('bucket', sort=True)
+    rollups = pd.concat([grouped[SUM_COLUMNS].sum(), grouped[MIN_COLUMNS].min(), grouped[MAX_COLUMNS].max()], axis=1)
+
+    if not nozgap_events.empty:
+        event_hours = pd.to_datetime(nozgap_events['start']).dt.floor('h')
+        events = nozgap_events.assign(bucket=event_hours.to_numpy()).groupby('bucket')['duration_s']
+        rollups['nozgap_events'] = events.size().reindex(rollups.index, fill_value=0).astype(np.int64)
+        rollups['nozgap_event_s'] = events.sum().reindex(rollups.index, fill_value=0.0)
+    return rollups.reset_index()[ROLLUP_COLUMNS]
+
+# Path of a rollup table of an SN
+def rollup_table_path(cwd, sn, level):
+    return f'{cwd}/data/{sn}/rollups/{level}.parquet'
+
+# Write the rollup tables of an SN from the hourly rollups of its files, keyed by file
+def save_rollup_tables(cwd, sn, hourly):
+    os.makedirs(os.path.dirname(rollup_table_path(cwd, sn, 'hourly')), exist_ok=True)
+    tables = {'hourly': hourly}
+    tables['daily'] = pd.concat([resample_rollups(file_hourly, 'day').assign(file=file_name) for file_name, file_hourly in hourly.groupby('file')],
+                                ignore_index=True) if not hourly.empty else hourly
+    for level, table in tables.items():
+        table = table[['file'] + ROLLUP_COLUMNS].sort_values(['bucket', 'file'], kind='stable')
+        write_atomically(rollup_table_path(cwd, sn, level), lambda path: table.to_parquet(path, engine='pyarrow', compression='zstd', index=False))
+
+# Build the rollup tables of an SN from the sweeping store and the event table
+def build_rollup_tables(cwd, sn):
+    table_path = event_table_path(cwd, sn)
+    events = pd.read_parquet(table_path, filters=[('signal', '==', 'NozGapOpen')]) if os.path.exists(table_path) else pd.DataFrame(columns=['file', 'start', 'duration_s'])
+    events_by_file = dict(list(events.groupby('file')))
+    hourly = []
+    for file_path in list_sweeping_files(cwd, sn):
+        file_name = os.path.splitext(os.path.basename(file_path))[0]
+        try:
+            df = read_sweeping_file(file_path)
+            if not df.empty:
+                hourly.append(file_rollups(df, events_by_file.get(file_name, events.iloc[:0])).assign(file=file_name))
+        except Exception as e:
+            print(f'Error rolling up sweeping file: {file_path}', e)
+    hourly = pd.concat(hourly, ignore_index=True) if hourly else pd.DataFrame(columns=['file'] + ROLLUP_COLUMNS)
+    save_rollup_tables(cwd, sn, hourly)
+    print(f'Built rollups for {sn}')
+    return hourly
+
+# Load the hourly rollups of every file of an SN, building the tables if the SN has none yet
+def load_hourly_rollups(cwd, sn):
+    if not os.path.exists(rollup_table_path(cwd, sn, 'hourly')) or not os.path.exists(rollup_table_path(cwd, sn, 'daily')):
+        with sn_write_lock(cwd, sn):
+            if not os.path.exists(rollup_table_path(cwd, sn, 'hourly')) or not os.path.exists(rollup_table_path(cwd, sn, 'daily')):
+                return build_rollup_tables(cwd, sn)
+    return pd.read_parquet(rollup_table_path(cwd, sn, 'hourly'), engine='pyarrow')
+
+# Add or replace the rollups of newly ingested files, remove those of removed_files, and rewrite the hourly and daily
+# tables
+def update_rollup_tables(cwd, sn, rollups, removed_files=()):
+    if rollups == {} and not removed_files:
+        return
+    hourly = load_hourly_rollups(cwd, sn)
+    hourly = hourly[~hourly['file'].isin(list(rollups) + list(removed_files))]
+    hourly = pd.concat([hourly] + [file_hourly.assign(file=file_name) for file_name, file_hourly in rollups.items()], ignore_index=True)
+    save_rollup_tables(cwd, sn, hourly)
+    print(f'Updated rollups for {sn}')
+
+# Rollups of an SN in buckets of the given size whose start is between start_date and end_date, combined across
+# files. Buckets at the edges of the range hold the whole hours or days of the rollups they are made of
+def query_rollups(cwd, sn, start_date, end_date, bucket='day'):
+    level = TREND_BUCKETS[bucket]
+    if not os.path.exists(rollup_table_path(cwd, sn, level)):
+        load_hourly_rollups(cwd, sn)
+    first_bucket = bucket_start([start_date], ROLLUP_LEVELS[level])[0]
+    rollups = pd.read_parquet(rollup_table_path(cwd, sn, level), engine='pyarrow', columns=ROLLUP_COLUMNS,
+                              filters=[('bucket', '>=', first_bucket), ('bucket', '<=', end_date)])
+    return resample_rollups(rollups, bucket)
+
+# Trend statistics of each bucket of rollups: sweeping and NozGapOpen time, fuel, NozGapOpen events and the mean,
+# sample standard deviation, min and max of each sensor
+def trend_statistics(rollups):
+    def column(name):
+        return rollups[name].to_numpy(dtype=np.float64)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        hours = column('rows') * SAMPLE_INTERVAL_S / 3600
+        statistics = {
+            'Sweeping Time (hrs)': hours,
+            'Fuel Consumed (L)': column('fuel_consumed'),
+            'Fuel per Sweeping Hour (L/hr)': column('fuel_consumed') / hours,
+            'NozGapOpen Time (hrs)': column('nozgap_open_rows') * SAMPLE_INTERVAL_S / 3600,
+            'Proportion NozGapOpen %': column('nozgap_open_rows') / column('rows') * 100,
+            'NozGapOpen Event Count': column('nozgap_events'),
+            'Mean NozGapOpen Duration (s)': column('nozgap_event_s') / column('nozgap_events')
+        }
+        for stat_column, (name, unit, _) in STAT_COLUMNS.items():
+            count, total = column(f'{stat_column}_count'), column(f'{stat_column}_sum')
+            mean = total / count
+            variance = np.maximum(column(f'{stat_column}_sumsq') - total * mean, 0) / (count - 1)
+            statistics.update({
+                f'Mean {name} ({unit})': mean,
+                f'Stdev {name} ({unit})': np.where(count > 1, np.sqrt(variance), np.nan),
+                f'Max {name} ({unit})': column(f'{stat_column}_max'),
+                f'Min {name} ({unit})': column(f'{stat_column}_min')
+            })
+    return statistics
+
+# Trend of an SN as JSON: bucket start times in milliseconds since the epoch and a series per statistic, nan as null
+def trend_to_dict(bucket, rollups):
+    return {
+        'bucket': bucket,
+        'time': (rollups['bucket'].to_numpy(dtype='datetime64[ns]').astype(np.int64) // 1000000).tolist(),
+        'series': {name: [None if np.isnan(v) else v for v in values.tolist()] for name, values in trend_statistics(rollups).items()}
+    }
@@ -0,0 +1,116 @@
+import os
+import numpy as np
+import pandas as pd
+from utils import write_atomically
+from file_index import load_file_index, prune_files
+
+# Mergeable quantile sketches with bounded relative error (DDSketch). A value v is counted in the
+# logarithmic bucket ceil(log(|v|) / log(GAMMA)), so any quantile read back is within RELATIVE_ACCURACY of
+# a true value of that rank, and sketches merge by adding the counts of equal buckets
+RELATIVE_ACCURACY = 0.01
+GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+LOG_GAMMA = np.log(GAMMA)
+# Magnitudes below this are counted as zero
+MIN_MAGNITUDE = 1e-9
+
+# Columns sketched per nozzle category, and the NozGapOpen duration sketch
+SKETCH_COLUMNS = ['EngineFuelRateTMSCS', 'EngineSpeed', 'FanSpeed']
+DURATION_COLUMN = 'NozGapOpen Duration (s)'
+SKETCH_TABLE_COLUMNS = ['hour', 'column', 'category', 'sign', 'bucket', 'count']
+
+# Map values to their sketch buckets as (sign, bucket) arrays
+def bucket_values(values):
+    values = np.asarray(values, dtype=np.float64)
+    magnitudes = np.abs(values)
+    nonzero = magnitudes > MIN_MAGNITUDE
+    signs = np.where(nonzero, np.sign(values), 0).astype(np.int8)
+    buckets = np.zeros(len(values), dtype=np.int32)
+    buckets[nonzero] = np.ceil(np.log(magnitudes[nonzero]) / LOG_GAMMA)
+    return signs, buckets
+
+# Build the sketches of a column, one per hour and category, as rows of bucket counts
+def sketch_column(column, values, hours, categories):
+    values = np.asarray(values, dtype=np.float64)
+    valid = ~np.isnan(values)
+    signs, buckets = bucket_values(values[valid])
+    counts = pd.DataFrame({
+        'hour': hours[valid],
+        'category': categories[valid],
+        'sign': signs,
+        'bucket': buckets
+    }).groupby(['hour', 'category', 'sign', 'bucket']).size().rename('count').reset_index()
+    counts.insert(1, 'column', column)
+    return counts[SKETCH_TABLE_COLUMNS]
+
+# Build the hourly sketches of the sweeping rows and NozGapOpen events of one file
+def file_sketches(sweeping_df, nozgap_events):
+    hours = sweeping_df['datetime'].dt.floor('h').to_numpy()
+    categories = np.where(sweeping_df['NozGapOpen'].to_numpy() == 1.0, 'Nozzle Open', 'Nozzle Closed')
+    sketches = [sketch_column(column, sweeping_df[column].to_numpy(), hours, categories) for column in SKETCH_COLUMNS if column in sweeping_df.columns]
+
+    # NozGapOpen durations are counted in the hour their event starts
+    if not nozgap_events.empty:
+        event_hours = pd.to_datetime(nozgap_events['start']).dt.floor('h').to_numpy()
+        sketches.append(sketch_column(DURATION_COLUMN, nozgap_events['duration_s'].to_numpy(), event_hours, np.full(len(nozgap_events), 'All Data')))
+    return pd.concat(sketches, ignore_index=True) if sketches else pd.DataFrame(columns=SKETCH_TABLE_COLUMNS)
+
+# Merge sketches by adding the counts of equal buckets
+def merge_sketches(sketches):
+    return sketches.groupby(['sign', 'bucket'], as_index=False)['count'].sum()
+
+# Estimate quantiles from a merged sketch
+def sketch_quantiles(sketch, quantiles):
+    if sketch.empty:
+        return [None for _ in quantiles]
+    # Order buckets by value: negatives from the largest magnitude down, then zero, then positives
+    sketch = sketch.assign(order=sketch['sign'] * sketch['bucket']).sort_values(['sign', 'order'])
+    cumulative_counts = sketch['count'].cumsum().to_numpy()
+    total = cumulative_counts[-1]
+
+    values = []
+    for q in quantiles:
+        i = np.searchsorted(cumulative_counts, q * (total - 1), side='right')
+        sign, bucket = sketch['sign'].iloc[i], sketch['bucket'].iloc[i]
+        values.append(float(sign * 2 * GAMMA ** bucket / (GAMMA + 1)))
+    return values
+
+# Directory holding the sketch files of an SN
+def sketch_dir(cwd, sn):
+    return f'{cwd}/data/{sn}/sketches'
+
+# Write the sketches of newly ingested files, replacing those of files with the same name, and remove those of
+# removed_files
+def update_sketch_files(cwd, sn, sketches, removed_files=()):
+    os.makedirs(sketch_dir(cwd, sn), exist_ok=True)
+    for file_name in removed_files:
+        if os.path.exists(f'{sketch_dir(cwd, sn)}/{file_name}.parquet'):
+            os.remove(f'{sketch_dir(cwd, sn)}/{file_name}.parquet')
+    for file_name, file_sketch in sketches.items():
+        write_atomically(f'{sketch_dir(cwd, sn)}/{file_name}.parquet', lambda path: file_sketch.to_parquet(path, engine='pyarrow', compression='zstd', index=False))
+    print(f'Updated sketches for {sn}')
+
+# Merge the hourly sketches of an SN for the hours starting between start_date and end_date
+def read_sketches(cwd, sn, start_date, end_date):
+    start_hour = start_date.floor('h')
+    inside_files, partial_files = prune_files(load_file_index(cwd, sn), start_hour, end_date)
+    sketches = []
+    for file_name in inside_files + partial_files:
+        sketch_path = f'{sketch_dir(cwd, sn)}/{file_name}.parquet'
+        if os.path.exists(sketch_path):
+            sketches.append(pd.read_parquet(sketch_path, engine='pyarrow', filters=[('hour', '>=', start_hour), ('hour', '<', end_date)]))
+    return pd.concat(sketches, ignore_index=True) if sketches else pd.DataFrame(columns=SKETCH_TABLE_COLUMNS)
+
+# Quantiles of every sketched column in a table of sketches, per nozzle category
+def table_quantiles(sketches, quantiles=(0.5,)):
+    results = {}
+    for column, column_sketches in sketches.groupby('column'):
+        categories = dict(list(column_sketches.groupby('category')))
+        if column != DURATION_COLUMN:
+            categories['All Data'] = column_sketches
+        results[column] = {category: dict(zip(quantiles, sketch_quantiles(merge_sketches(category_sketches), quantiles)))
+                           for category, category_sketches in categories.items()}
+    return results
+
+# Quantiles of the sketched columns of an SN over a date range, per nozzle category, without reading any rows
+def query_quantiles(cwd, sn, start_date, end_date, quantiles=(0.5,)):
+    return table_quantiles(read_sketches(cwd, sn, start_date, end_date), quantiles)
@@ -1,112 +1,164 @@
 import os
+import numpy as np
 import pandas as pd
+from events import extract_events
+from metrics import timed_stage
 
-# Record the duration of each NozGapOpen event
+# Record the duration of each NozGapOpen event, splitting events at file and session boundaries
 def count_nozgapopen_events(combined_df):
-    nozgap_event_durations = []  # List to store durations of NozGapOpen events
-    event_count = 0  # Counter for the duration of the current NozGapOpen event
-    nozgap_event = False  # Flag to indicate if a NozGapOpen event is ongoing
-
     try:
-        for index, row in combined_df.iterrows():
-            current_nozgap = row['NozGapOpen']
-            
-            if current_nozgap == 1.0:
-                if not nozgap_event:
-                    nozgap_event = True  # Start a new NozGapOpen event
-                    event_count = 1  # Initialize the event counter
-                else:
-                    event_count += 1  # Continue counting the current event
-            else:  # current_nozgap == 0.0
-                if nozgap_event:
-                    nozgap_event = False  # End the current NozGapOpen event
-                    nozgap_event_duration = event_count * 0.1  # Calculate the duration in seconds
-                    nozgap_event_durations.append(nozgap_event_duration)  # Store the duration
-                    event_count = 0  # Reset the counter
-
-        # If the dataframe ends with an open event, record its duration
-        if nozgap_event:
-            nozgap_event_duration = event_count * 0.1
-            nozgap_event_durations.append(nozgap_event_duration)
-
-        return nozgap_event_durations
+        events = extract_events(combined_df['datetime'].to_numpy(), combined_df['NozGapOpen'].to_numpy(), 1.0)
+        return events['duration_s'].tolist()
     except Exception as e:
         print('Error counting nozgapopen events:', e)
         return []
 
-# Calculate statistics for fuel rate, engine speed, and fan speed
-def calculate_fuel_statistics(df):
-    try:
-        fuel_stats_dict = {
-            'Total Time (hrs)': (len(df) * 0.1) / 3600,  # Convert total time from seconds to hours
-            'Total Fuel Consumed (L)': df['fuel_consumed'].sum(),
-            'Mean Fuel Rate (L/hr)': df['EngineFuelRateTMSCS'].mean(),
-            'Median Fuel Rate (L/hr)': df['EngineFuelRateTMSCS'].median(),
-            'Stdev Fuel Rate (L/hr)': df['EngineFuelRateTMSCS'].std(),
-            'Max Fuel Rate (L/hr)': df['EngineFuelRateTMSCS'].max(),
-            'Min Fuel Rate (L/hr)': df['EngineFuelRateTMSCS'].min(),
-
-            'Mean Engine Speed (rpm)': df['EngineSpeed'].mean(),
-            'Median Engine Speed (rpm)': df['EngineSpeed'].median(),
-            'Stdev Engine Speed (rpm)': df['EngineSpeed'].std(),
-            'Max Engine Speed (rpm)': df['EngineSpeed'].max(),
-            'Min Engine Speed (rpm)': df['EngineSpeed'].min(),
-
-            'Mean Fan Speed (rpm)': df['FanSpeed'].mean(),
-            'Median Fan Speed (rpm)': df['FanSpeed'].median(),
-            'Stdev Fan Speed (rpm)': df['FanSpeed'].std(),
-            'Max Fan Speed (rpm)': df['FanSpeed'].max(),
-            'Min Fan Speed (rpm)': df['FanSpeed'].min()
-        }
-        return fuel_stats_dict
-    except Exception as e:
-        print('Error calculating fuel statistics:', e)
-        return {}
+# Categories of rows: every row, and the rows with the nozzle gap open or closed
+CATEGORIES = ['All Data', 'Nozzle Open', 'Nozzle Closed']
+# Columns summarized per category: column -> (name in the statistics, unit, histogram bins)
+STAT_COLUMNS = {
+    'EngineFuelRateTMSCS': ('Fuel Rate', 'L/hr', 50),
+    'EngineSpeed': ('Engine Speed', 'rpm', 30),
+    'FanSpeed': ('Fan Speed', 'rpm', 30)
+}
+CORRELATION_COLUMNS = ['EngineSpeed', 'FanSpeed', 'EngineFuelRateTMSCS', 'NozGapOpen']
+DURATION_BINS = 30
+
+# Quantile of a sorted array with linear interpolation, as pandas computes it, or nan if it is empty
+def sorted_quantile(sorted_values, q):
+    if len(sorted_values) == 0:
+        return float('nan')
+    position = q * (len(sorted_values) - 1)
+    lower = int(np.floor(position))
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return float(sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower))
+
+# Count, sum, mean, sample standard deviation, min, max and median of a sorted array
+def sorted_summary(sorted_values):
+    count = len(sorted_values)
+    total = float(sorted_values.sum()) if count else 0.0
+    mean = total / count if count else float('nan')
+    std = float(np.sqrt(((sorted_values - mean) ** 2).sum() / (count - 1))) if count > 1 else float('nan')
+    return {
+        'count': count,
+        'sum': total,
+        'mean': mean,
+        'std': std,
+        'min': float(sorted_values[0]) if count else float('nan'),
+        'max': float(sorted_values[-1]) if count else float('nan'),
+        'median': sorted_quantile(sorted_values, 0.5)
+    }
+
+# Summaries and common-edge histograms of one column for every category in a single grouped pass.
+# Values are sorted once by (category, value), so each category is a contiguous slice of the sorted array
+# rather than a copied subset, and the whole column is the merge of the two sorted slices
+def grouped_column(values, nozzle_open, bins):
+    valid = ~np.isnan(values)
+    if not valid.all():
+        values, nozzle_open = values[valid], nozzle_open[valid]
+    order = np.lexsort((values, ~nozzle_open))
+    sorted_values = values[order]
+    open_count = int(nozzle_open.sum())
+    slices = {
+        'Nozzle Open': sorted_values[:open_count],
+        'Nozzle Closed': sorted_values[open_count:]
+    }
+    # Merging two sorted runs is linear with a stable sort
+    slices['All Data'] = np.sort(sorted_values, kind='stable')
+
+    edges = np.histogram_bin_edges(slices['All Data'], bins=bins) if len(values) else np.linspace(0, 1, bins + 1)
+    counts = {category: np.histogram(slices[category], bins=edges)[0] for category in CATEGORIES}
+    return {category: sorted_summary(slices[category]) for category in CATEGORIES}, {'edges': edges, 'counts': counts}
+
+# Histogram of NozGapOpen event durations with the total duration in each bin, or None if there are no events
+def duration_histogram(nozgap_event_durations, bins=DURATION_BINS):
+    if len(nozgap_event_durations) == 0:
+        return None
+    durations = np.asarray(nozgap_event_durations, dtype=np.float64)
+    counts, edges = np.histogram(durations, bins=bins)
+    totals, _ = np.histogram(durations, bins=edges, weights=durations)
+    return {'edges': edges, 'counts': counts, 'totals': totals}
+
+# Statistics of every category in the layout of /get_data, from its row count, fuel total and column summaries
+def fuel_statistics(rows, fuel_totals, summaries):
+    fuel_dicts = {category: {
+        'Total Time (hrs)': (rows[category] * 0.1) / 3600,  # Convert total time from seconds to hours
+        'Total Fuel Consumed (L)': fuel_totals[category]
+    } for category in CATEGORIES}
+    for column, (name, unit, _) in STAT_COLUMNS.items():
+        for category in CATEGORIES:
+            summary = summaries[column][category]
+            fuel_dicts[category].update({
+                f'Mean {name} ({unit})': summary['mean'],
+                f'Median {name} ({unit})': summary['median'],
+                f'Stdev {name} ({unit})': summary['std'],
+                f'Max {name} ({unit})': summary['max'],
+                f'Min {name} ({unit})': summary['min']
+            })
+    return fuel_dicts
+
+# Statistics for fuel rate, engine speed and fan speed for every category, and the binned data the plots draw,
+# computed from the column arrays of the combined DataFrame without materializing per-category DataFrames
+def grouped_statistics(df, nozgap_event_durations=()):
+    nozzle_open = df['NozGapOpen'].to_numpy() == 1.0
+    rows = {'All Data': len(df), 'Nozzle Open': int(nozzle_open.sum())}
+    rows['Nozzle Closed'] = rows['All Data'] - rows['Nozzle Open']
+
+    fuel = df['fuel_consumed'].to_numpy(dtype=np.float64)
+    fuel_valid = ~np.isnan(fuel)
+    closed_fuel, open_fuel = np.bincount(nozzle_open[fuel_valid], weights=fuel[fuel_valid], minlength=2)
+    fuel_totals = {'All Data': float(closed_fuel + open_fuel), 'Nozzle Open': float(open_fuel), 'Nozzle Closed': float(closed_fuel)}
+
+    binned = {'categories': CATEGORIES, 'columns': {}}
+    summaries = {}
+    for column, (name, unit, bins) in STAT_COLUMNS.items():
+        summaries[column], binned['columns'][column] = grouped_column(df[column].to_numpy(dtype=np.float64), nozzle_open, bins)
+    fuel_dicts = fuel_statistics(rows, fuel_totals, summaries)
+
+    binned['correlation'] = df[CORRELATION_COLUMNS].corr()
+    binned['durations'] = duration_histogram(nozgap_event_durations)
+    return fuel_dicts, binned
+
+# Statistics of NozGapOpen event durations over a range of the given number of rows
+def nozgapopen_summary(nozgap_event_durations, rows):
+    return {
+        'Total NozGapOpen Duration (hrs)': sum(nozgap_event_durations) / 3600,
+        'Mean NozGapOpen Duration (s)': sum(nozgap_event_durations) / len(nozgap_event_durations),
+        'Median NozGapOpen Duration (s)': sorted(nozgap_event_durations)[len(nozgap_event_durations) // 2],
+        'Stdev NozGapOpen Duration (mins)': pd.Series(nozgap_event_durations).std() / 60,
+        'Max NozGapOpen Duration (mins)': max(nozgap_event_durations) / 60,
+        'Min NozGapOpen Duration (s)': min(nozgap_event_durations),
+        'NozGapOpen Event Count': len(nozgap_event_durations),
+        'Proportion NozGapOpen %': (sum(nozgap_event_durations) / (rows * 0.1)) * 100
+    }
 
-# Calculate statistics for NozGapOpen events
-def nozgapopen_statistics(df):
-    nozgap_event_durations = count_nozgapopen_events(df)
-    if nozgap_event_durations == []:
+# Calculate statistics for NozGapOpen events, using the stored event durations when given
+def nozgapopen_statistics(df, nozgap_event_durations=None):
+    if nozgap_event_durations is None:
+        nozgap_event_durations = count_nozgapopen_events(df)
+    if len(nozgap_event_durations) == 0:
         print('No NozGapOpen events')
-        return {}
+        return [], {}
     try:
-        nozgapopen_stats_dict = {
-            'Total NozGapOpen Duration (hrs)': sum(nozgap_event_durations) / 3600,
-            'Mean NozGapOpen Duration (s)': sum(nozgap_event_durations) / len(nozgap_event_durations),
-            'Median NozGapOpen Duration (s)': sorted(nozgap_event_durations)[len(nozgap_event_durations) // 2],
-            'Stdev NozGapOpen Duration (mins)': pd.Series(nozgap_event_durations).std() / 60,
-            'Max NozGapOpen Duration (mins)': max(nozgap_event_durations) / 60,
-            'Min NozGapOpen Duration (s)': min(nozgap_event_durations),
-            'NozGapOpen Event Count': len(nozgap_event_durations),
-            'Proportion NozGapOpen %': (sum(nozgap_event_durations) / (len(df) * 0.1)) * 100
-        }
-        return nozgap_event_durations, nozgapopen_stats_dict
+        return nozgap_event_durations, nozgapopen_summary(nozgap_event_durations, len(df))
     except Exception as e:
         print('Error calculating nozgapopen statistics:', e)
-        return {}
+        return nozgap_event_durations, {}
 
-# Calculate overall statistics
-def calculate_statistics(combined_df):
+# Calculate overall statistics in a single grouped pass, returning the binned data drawn by the plots
+@timed_stage('calculate_statistics')
+def calculate_statistics(combined_df, nozgap_event_durations=None):
     print("Calculating statistics...")
     try:
-        fuel_dicts = {}  # Dictionary to store fuel statistics
-        dfs = {
-            'All Data': combined_df,
-            'Nozzle Open': combined_df[combined_df['NozGapOpen'] == 1.0],
-            'Nozzle Closed': combined_df[combined_df['NozGapOpen'] != 1.0]
-        }
-        for key in dfs.keys():
-            if key == 'All Data':
-                nozgap_event_durations, nozgapopen_stats_dict = nozgapopen_statistics(dfs[key])
-            fuel_dicts[key] = calculate_fuel_statistics(dfs[key])
-        
-        return nozgap_event_durations, nozgapopen_stats_dict, fuel_dicts, dfs
+        nozgap_event_durations, nozgapopen_stats_dict = nozgapopen_statistics(combined_df, nozgap_event_durations)
+        fuel_dicts, binned = grouped_statistics(combined_df, nozgap_event_durations)
+        return nozgap_event_durations, nozgapopen_stats_dict, fuel_dicts, binned
     except Exception as e:
         print('Error calculating statistics:', e)
         return [], {}, {}, {}
 
 # Write statistics to files
-def write_statistics(cwd, sn, total_fuel_consumed, num_of_files, nozgapopen_stats_dict, fuel_dicts, dfs, nozgap_event_durations, current_datetime):
+def write_statistics(cwd, sn, total_fuel_consumed, num_of_files, nozgapopen_stats_dict, fuel_dicts, binned, nozgap_event_durations, current_datetime):
     print("Writing statistics...")
     try:
         # Create directories if they do not exist
@@ -0,0 +1,115 @@
+import os
+import pandas as pd
+import pyarrow.parquet as pq
+from utils import write_atomically
+from log_parser import apply_schema, DATETIME_FORMAT
+
+# Sweeping data is stored as Parquet, partitioned by SN and date: data/<sn>/sweeping_parquet/date=YYYY-MM-DD/<file>.parquet
+SWEEPING_DIR = 'sweeping_parquet'
+COMPRESSION = 'zstd'
+# Rows per row group, the granularity at which datetime filters skip data
+ROW_GROUP_SIZE = 36000
+
+# Directory holding the sweeping data of an SN
+def sweeping_dir(cwd, sn):
+    return f'{cwd}/data/{sn}/{SWEEPING_DIR}'
+
+# Path of the Parquet file for a sweeping file name format 'SN213390_YYYY_MM_DD_HHMM'
+def sweeping_file_path(cwd, sn, file_name):
+    stem = os.path.splitext(os.path.basename(file_name))[0]
+    date = '-'.join(stem.split('_')[1:4])
+    return f'{sweeping_dir(cwd, sn)}/date={date}/{stem}.parquet'
+
+# Write the sweeping rows of one log file to the store
+def write_sweeping_file(cwd, sn, file_name, df):
+    file_path = sweeping_file_path(cwd, sn, file_name)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    write_atomically(file_path, lambda path: df.to_parquet(path, engine='pyarrow', compression=COMPRESSION, index=False, row_group_size=ROW_GROUP_SIZE))
+    return file_path
+
+# Remove the sweeping rows of one log file from the store
+def remove_sweeping_file(cwd, sn, file_name):
+    file_path = sweeping_file_path(cwd, sn, file_name)
+    if os.path.exists(file_path):
+        os.remove(file_path)
+
+# List the sweeping files of an SN whose date partition can hold rows between start_date and end_date
+def list_sweeping_files(cwd, sn, start_date=None, end_date=None):
+    data_dir = sweeping_dir(cwd, sn)
+    if not os.path.exists(data_dir):
+        return []
+
+    # Sessions can run past midnight, so include the partition of the day before start_date
+    first_day = (start_date.normalize() - pd.Timedelta(days=1)).strftime('%Y-%m-%d') if start_date is not None else ''
+    last_day = end_date.strftime('%Y-%m-%d') if end_date is not None else '9999-12-31'
+
+    file_paths = []
+    for partition in sorted(os.listdir(data_dir)):
+        if not partition.startswith('date=') or not first_day <= partition[5:] <= last_day:
+            continue
+        partition_dir = f'{data_dir}/{partition}'
+        file_paths.extend(f'{partition_dir}/{f}' for f in sorted(os.listdir(partition_dir)) if f.endswith('.parquet'))
+    return file_paths
+
+# Filters selecting the rows between start_date and end_date
+def datetime_filters(start_date=None, end_date=None):
+    filters = []
+    if start_date is not None:
+        filters.append(('datetime', '>=', start_date))
+    if end_date is not None:
+        filters.append(('datetime', '<=', end_date))
+    return filters or None
+
+# Read the given columns of a sweeping file, pushing the datetime range filter down to the row groups
+def read_sweeping_file(file_path, start_date=None, end_date=None, columns=None):
+    return pd.read_parquet(file_path, engine='pyarrow', columns=columns, filters=datetime_filters(start_date, end_date))
+
+# Read the given columns of a sweeping file in order as DataFrames of at most batch_rows rows, skipping the row groups
+# outside the datetime range, so memory is bounded by the batch size rather than the file
+def read_sweeping_batches(file_path, start_date=None, end_date=None, columns=None, batch_rows=ROW_GROUP_SIZE):
+    parquet_file = pq.ParquetFile(file_path)
+    datetime_index = parquet_file.schema_arrow.get_field_index('datetime')
+    row_groups = []
+    for i in range(parquet_file.metadata.num_row_groups):
+        statistics = parquet_file.metadata.row_group(i).column(datetime_index).statistics
+        if statistics is not None and statistics.has_min_max:
+            if (start_date is not None and pd.Timestamp(statistics.max) < start_date) or (end_date is not None and pd.Timestamp(statistics.min) > end_date):
+                continue
+        row_groups.append(i)
+    if row_groups == []:
+        return
+
+    for batch in parquet_file.iter_batches(batch_size=batch_rows, row_groups=row_groups, columns=columns):
+        df = batch.to_pandas()
+        if start_date is not None or end_date is not None:
+            datetimes = df['datetime']
+            df = df[((datetimes >= start_date) if start_date is not None else True) & ((datetimes <= end_date) if end_date is not None else True)]
+        if not df.empty:
+            yield df
+
+# Import sweeping CSVs in data/<sn>/sweeping_csvs that are not yet in the store
+def import_sweeping_csvs(cwd, sn):
+    csv_dir = f'{cwd}/data/{sn}/sweeping_csvs'
+    if not os.path.exists(csv_dir):
+        return []
+
+    imported = []
+    for csv_file in sorted(os.listdir(csv_dir)):
+        if not csv_file.endswith('.csv') or os.path.exists(sweeping_file_path(cwd, sn, csv_file)):
+            continue
+        try:
+            df = apply_schema(pd.read_csv(f'{csv_dir}/{csv_file}'))
+            write_sweeping_file(cwd, sn, csv_file, df)
+            imported.append(csv_file)
+            print(f'Imported {csv_file} into the sweeping store for {sn}')
+        except Exception as e:
+            print(f'Error importing sweeping csv file: {csv_file}', e)
+    return imported
+
+# Export the sweeping rows of an SN between start_date and end_date to a single CSV file
+def export_sweeping_csv(cwd, sn, start_date, end_date, output_path):
+    dfs = [read_sweeping_file(f, start_date, end_date) for f in list_sweeping_files(cwd, sn, start_date, end_date)]
+    dfs = [df for df in dfs if not df.empty]
+    df = pd.concat(dfs) if dfs else pd.DataFrame()
+    df.to_csv(output_path, index=False, date_format=DATETIME_FORMAT)
+    return len(df)
@@ -0,0 +1,297 @@
+import os
+import numpy as np
+import pandas as pd
+from storage import read_sweeping_batches, sweeping_file_path
+from data_processing import query_files, QUERY_COLUMNS
+from file_index import load_file_index, prune_files
+from aggregates import column_moments, combine_moments
+from stats import CATEGORIES, STAT_COLUMNS, CORRELATION_COLUMNS, duration_histogram, fuel_statistics, nozgapopen_summary
+from worker_pool import submit_task
+from metrics import timed_stage, ROWS_QUERIED
+
+# Out-of-core statistics for date ranges too large to hold in memory. Each sweeping file is read in batches of
+# STREAM_BATCH_ROWS rows by a worker, which reduces them into mergeable accumulators; the parent merges the
+# accumulators of every file. Ranges of more than STREAM_THRESHOLD_ROWS rows are streamed rather than loaded
+STREAM_BATCH_ROWS = int(os.environ.get('STREAM_BATCH_ROWS', 100000))
+STREAM_THRESHOLD_ROWS = int(os.environ.get('STREAM_THRESHOLD_ROWS', 10000000))
+# Bins each pass of the exact median search splits the range holding the median into
+MEDIAN_SEARCH_BINS = 4096
+
+# Co-moments of two columns over the rows where both are valid, for the Pearson correlation
+def column_comoments(x, y):
+    valid = ~np.isnan(x) & ~np.isnan(y)
+    x, y = x[valid], y[valid]
+    if len(x) == 0:
+        return {'count': 0, 'mean_x': 0.0, 'mean_y': 0.0, 'm2_x': 0.0, 'm2_y': 0.0, 'c_xy': 0.0}
+    mean_x, mean_y = float(x.mean()), float(y.mean())
+    return {
+        'count': len(x),
+        'mean_x': mean_x,
+        'mean_y': mean_y,
+        'm2_x': float(((x - mean_x) ** 2).sum()),
+        'm2_y': float(((y - mean_y) ** 2).sum()),
+        'c_xy': float(((x - mean_x) * (y - mean_y)).sum())
+    }
+
+# Combine the co-moments of two sets of rows, as combine_moments does for one column
+def combine_comoments(a, b):
+    if a['count'] == 0:
+        return dict(b)
+    if b['count'] == 0:
+        return dict(a)
+    count = a['count'] + b['count']
+    delta_x = b['mean_x'] - a['mean_x']
+    delta_y = b['mean_y'] - a['mean_y']
+    weight = a['count'] * b['count'] / count
+    return {
+        'count': count,
+        'mean_x': a['mean_x'] + delta_x * b['count'] / count,
+        'mean_y': a['mean_y'] + delta_y * b['count'] / count,
+        'm2_x': a['m2_x'] + b['m2_x'] + delta_x ** 2 * weight,
+        'm2_y': a['m2_y'] + b['m2_y'] + delta_y ** 2 * weight,
+        'c_xy': a['c_xy'] + b['c_xy'] + delta_x * delta_y * weight
+    }
+
+# Values of a batch in each nozzle category, without nan
+def category_values(values, nozzle_open):
+    valid = ~np.isnan(values)
+    return {'Nozzle Open': values[valid & nozzle_open], 'Nozzle Closed': values[valid & ~nozzle_open]}
+
+# Rows, fuel totals, moments of the stat columns per nozzle category and correlation co-moments of one batch
+def batch_accumulator(df):
+    nozzle_open = df['NozGapOpen'].to_numpy() == 1.0
+    fuel = category_values(df['fuel_consumed'].to_numpy(dtype=np.float64), nozzle_open)
+    columns = {column: category_values(df[column].to_numpy(dtype=np.float64), nozzle_open) for column in STAT_COLUMNS}
+    return {
+        'rows': {'Nozzle Open': int(nozzle_open.sum()), 'Nozzle Closed': int((~nozzle_open).sum())},
+        'fuel': {category: float(values.sum()) for category, values in fuel.items()},
+        'columns': {column: {category: column_moments(values) for category, values in categories.items()}
+                    for column, categories in columns.items()},
+        'correlation': {(a, b): column_comoments(df[a].to_numpy(dtype=np.float64), df[b].to_numpy(dtype=np.float64))
+                        for i, a in enumerate(CORRELATION_COLUMNS) for b in CORRELATION_COLUMNS[:i + 1]}
+    }
+
+# Merge two accumulators of the same layout
+def combine_accumulators(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return {
+        'rows': {category: a['rows'][category] + b['rows'][category] for category in a['rows']},
+        'fuel': {category: a['fuel'][category] + b['fuel'][category] for category in a['fuel']},
+        'columns': {column: {category: combine_moments(a['columns'][column][category], b['columns'][column][category])
+                             for category in a['columns'][column]} for column in a['columns']},
+        'correlation': {pair: combine_comoments(a['correlation'][pair], b['correlation'][pair]) for pair in a['correlation']}
+    }
+
+# Bins of values in a search range: edges[i] <= value < edges[i + 1], with the top edge included when the range is closed.
+# Returns the bin of every value, or -1 for values outside the range
+def search_bins(values, search):
+    edges = np.linspace(search['lo'], search['hi'], MEDIAN_SEARCH_BINS + 1)
+    bins = np.searchsorted(edges, values, side='right') - 1
+    if search['closed']:
+        bins[values == search['hi']] = MEDIAN_SEARCH_BINS - 1
+    bins[(values < search['lo']) | (bins >= MEDIAN_SEARCH_BINS)] = -1
+    return bins
+
+# Read one sweeping file in batches in a worker and reduce it for one pass of a streamed query:
+#   - without a plan: the accumulator of its rows, its row count and the fuel consumed over them
+#   - with a plan: plot histogram counts on the plan's edges, and for each unresolved median either the counts
+#     of its search bins with the min and max of its range, or, once few values remain in its range, those values
+def stream_file(file_path, start_date, end_date, batch_rows, plan=None):
+    accumulator = None
+    rows, fuel_first, fuel_last = 0, None, None
+    histograms = {}
+    searches = {}
+    for df in read_sweeping_batches(file_path, start_date, end_date, QUERY_COLUMNS, batch_rows):
+        if plan is None:
+            accumulator = combine_accumulators(accumulator, batch_accumulator(df))
+            rows += len(df)
+            fuel = df['TotalFuelConsumption'].to_numpy(dtype=np.float64)
+            fuel_first = fuel[0] if fuel_first is None else fuel_first
+            fuel_last = fuel[-1]
+            continue
+
+        nozzle_open = df['NozGapOpen'].to_numpy() == 1.0
+        for column, edges in plan['edges'].items():
+            values = category_values(df[column].to_numpy(dtype=np.float64), nozzle_open)
+            counts = {category: np.histogram(values[category], bins=edges)[0] for category in values}
+            histograms[column] = {category: histograms[column][category] + counts[category] for category in counts} if column in histograms else counts
+
+        for target, search in plan['searches'].items():
+            values = df[search['column']].to_numpy(dtype=np.float64)
+            if search['category'] != 'All Data':
+                values = category_values(values, nozzle_open)[search['category']]
+            else:
+                values = values[~np.isnan(values)]
+            bins = search_bins(values, search)
+            found = values[bins >= 0]
+            if len(found) == 0:
+                continue
+            if search['collect']:
+                searches[target] = np.concatenate([searches[target], found]) if target in searches else found
+                continue
+            counts = np.bincount(bins[bins >= 0], minlength=MEDIAN_SEARCH_BINS)
+            found_min, found_max = float(found.min()), float(found.max())
+            if target in searches:
+                counts, found_min, found_max = searches[target][0] + counts, min(searches[target][1], found_min), max(searches[target][2], found_max)
+            searches[target] = (counts, found_min, found_max)
+
+    if plan is None:
+        fuel_consumed = float(fuel_last - fuel_first) if rows and not np.isnan(fuel_last - fuel_first) else 0
+        return accumulator, rows, fuel_consumed
+    return histograms, searches
+
+# Run one pass of a streamed query over every (file path, start date, end date) on the worker pool, returning the
+# results in file order
+def stream_pass(file_paths, batch_rows, plan=None):
+    futures = [submit_task(stream_file, file_path, file_start, file_end, batch_rows, plan)
+               for file_path, file_start, file_end in file_paths]
+    return [future.result() for future in futures]
+
+# Rank positions and interpolation fraction of the median of count values, as sorted_quantile takes them
+def median_ranks(count):
+    position = 0.5 * (count - 1)
+    lower = int(np.floor(position))
+    return lower, min(lower + 1, count - 1), position - lower
+
+# Find exact order statistics without holding the values: each pass counts the values of each target's range in
+# MEDIAN_SEARCH_BINS bins, and the range narrows to the bin holding the target's rank, until few enough values
+# remain in the range to collect and sort. targets maps a key to (column, category, rank, min, max)
+def stream_order_statistics(file_paths, batch_rows, targets, edges):
+    values = {}
+    searches = {}
+    for target, (column, category, rank, lo, hi) in targets.items():
+        if lo == hi:
+            values[target] = lo
+        else:
+            searches[target] = {'column': column, 'category': category, 'rank': rank, 'lo': lo, 'hi': hi, 'closed': True, 'collect': False}
+
+    # The plot histograms are counted in the first pass
+    histograms = None
+    while searches or histograms is None:
+        plan = {'edges': edges if histograms is None else {}, 'searches': searches}
+        results = stream_pass(file_paths, batch_rows, plan)
+        if histograms is None:
+            histograms = {column: {category: sum(r[0][column][category] for r in results if column in r[0])
+                                   for category in ['Nozzle Open', 'Nozzle Closed']} for column in edges}
+
+        next_searches = {}
+        for target, search in searches.items():
+            parts = [r[1][target] for r in results if target in r[1]]
+            if search['collect']:
+                values[target] = float(np.sort(np.concatenate(parts))[search['rank']])
+                continue
+            # A range holding a single value, such as a run of identical readings, cannot be split further
+            found_min, found_max = min(part[1] for part in parts), max(part[2] for part in parts)
+            if found_min == found_max:
+                values[target] = found_min
+                continue
+            counts = np.sum([part[0] for part in parts], axis=0)
+            cumulative = np.cumsum(counts)
+            bin_index = int(np.searchsorted(cumulative, search['rank'], side='right'))
+            edges_of_search = np.linspace(search['lo'], search['hi'], MEDIAN_SEARCH_BINS + 1)
+            lo, hi = float(edges_of_search[bin_index]), float(edges_of_search[bin_index + 1])
+            next_searches[target] = dict(search,
+                                         rank=search['rank'] - (int(cumulative[bin_index - 1]) if bin_index > 0 else 0),
+                                         lo=lo, hi=hi,
+                                         closed=search['closed'] and bin_index == MEDIAN_SEARCH_BINS - 1,
+                                         collect=int(counts[bin_index]) <= batch_rows)
+        searches = next_searches
+    return values, histograms
+
+# Pearson correlation matrix of the correlation columns from their co-moments, as DataFrame.corr() lays it out
+def correlation_matrix(correlation):
+    matrix = pd.DataFrame(np.nan, index=CORRELATION_COLUMNS, columns=CORRELATION_COLUMNS)
+    for (a, b), comoments in correlation.items():
+        divisor = np.sqrt(comoments['m2_x'] * comoments['m2_y'])
+        if comoments['count'] > 0 and divisor != 0:
+            matrix.loc[a, b] = matrix.loc[b, a] = comoments['c_xy'] / divisor
+    return matrix
+
+# Summary of a column in a category, in the layout of sorted_summary, from its moments and median
+def streamed_summary(moments, median):
+    count = moments['count']
+    return {
+        'count': count,
+        'sum': moments['mean'] * count,
+        'mean': moments['mean'] if count else float('nan'),
+        'std': float(np.sqrt(moments['m2'] / (count - 1))) if count > 1 else float('nan'),
+        'min': moments['min'] if count else float('nan'),
+        'max': moments['max'] if count else float('nan'),
+        'median': median
+    }
+
+# Compute the statistics and plot data of /get_data for an SN and date range by streaming the sweeping files in
+# batches, holding accumulators rather than rows. Returns None if there are no rows in the range
+@timed_stage('stream_statistics')
+def stream_statistics(cwd, sn, start_date, end_date, nozgap_event_durations, batch_rows=STREAM_BATCH_ROWS):
+    start_date = pd.to_datetime(start_date)
+    end_date = pd.to_datetime(end_date)
+    index, inside_files, partial_files = query_files(cwd, sn, start_date, end_date)
+    print(f'Streaming statistics for {sn}, between {start_date} and {end_date}, in batches of {batch_rows} rows...')
+
+    # Only the files that partly overlap the range filter their rows
+    files = sorted(inside_files + partial_files)
+    file_paths = [(sweeping_file_path(cwd, sn, f), start_date, end_date) if f in partial_files else (sweeping_file_path(cwd, sn, f), None, None)
+                  for f in files]
+    total_fuel_consumption = [index[f]['fuel_last'] - index[f]['fuel_first'] for f in inside_files]
+    num_of_files = len(inside_files)
+    accumulator = None
+    for f, (file_accumulator, rows, fuel_consumed) in zip(files, stream_pass(file_paths, batch_rows)):
+        accumulator = combine_accumulators(accumulator, file_accumulator)
+        if f in partial_files and rows > 0:
+            total_fuel_consumption.append(fuel_consumed)
+            num_of_files += 1
+    if accumulator is None or sum(accumulator['rows'].values()) == 0:
+        return None
+
+    # Every category is the merge of the nozzle open and closed rows
+    rows = dict(accumulator['rows'], **{'All Data': sum(accumulator['rows'].values())})
+    ROWS_QUERIED.inc(rows['All Data'], mode='stream')
+    fuel_totals = dict(accumulator['fuel'], **{'All Data': accumulator['fuel']['Nozzle Closed'] + accumulator['fuel']['Nozzle Open']})
+    moments = {column: dict(categories, **{'All Data': combine_moments(categories['Nozzle Open'], categories['Nozzle Closed'])})
+               for column, categories in accumulator['columns'].items()}
+
+    # Plot histograms share edges over the whole column, which only depend on its min and max
+    edges = {}
+    targets = {}
+    for column, (_, _, bins) in STAT_COLUMNS.items():
+        all_data = moments[column]['All Data']
+        edges[column] = np.histogram_bin_edges(np.array([all_data['min'], all_data['max']]), bins=bins) if all_data['count'] else np.linspace(0, 1, bins + 1)
+        for category in CATEGORIES:
+            category_moments = moments[column][category]
+            if category_moments['count'] > 0:
+                lower, upper, _ = median_ranks(category_moments['count'])
+                for rank in {lower, upper}:
+                    targets[(column, category, rank)] = (column, category, rank, category_moments['min'], category_moments['max'])
+    order_statistics, histograms = stream_order_statistics(file_paths, batch_rows, targets, edges)
+
+    summaries = {}
+    binned = {'categories': CATEGORIES, 'columns': {}}
+    for column in STAT_COLUMNS:
+        summaries[column] = {}
+        for category in CATEGORIES:
+            count = moments[column][category]['count']
+            median = float('nan')
+            if count > 0:
+                lower, upper, fraction = median_ranks(count)
+                lower_value, upper_value = order_statistics[(column, category, lower)], order_statistics[(column, category, upper)]
+                median = float(lower_value + (upper_value - lower_value) * fraction)
+            summaries[column][category] = streamed_summary(moments[column][category], median)
+        counts = dict(histograms[column], **{'All Data': histograms[column]['Nozzle Open'] + histograms[column]['Nozzle Closed']})
+        binned['columns'][column] = {'edges': edges[column], 'counts': {category: counts[category] for category in CATEGORIES}}
+    binned['correlation'] = correlation_matrix(accumulator['correlation'])
+    binned['durations'] = duration_histogram(nozgap_event_durations)
+
+    nozgapopen_stats_dict = nozgapopen_summary(nozgap_event_durations, rows['All Data']) if len(nozgap_event_durations) else {}
+    print('Statistics streamed')
+    return sum(total_fuel_consumption), num_of_files, nozgapopen_stats_dict, fuel_statistics(rows, fuel_totals, summaries), binned
+
+# Whether a query of an SN over a date range holds more rows than threshold_rows, from the row counts in its index,
+# and so should be streamed rather than loaded
+def should_stream(cwd, sn, start_date, end_date, threshold_rows=STREAM_THRESHOLD_ROWS):
+    index = load_file_index(cwd, sn)
+    inside_files, partial_files = prune_files(index, pd.to_datetime(start_date), pd.to_datetime(end_date))
+    return sum(index[f]['rows'] for f in inside_files + partial_files) > threshold_rows
@@ -1,8 +1,12 @@
 import os
 import sys
-from io import BytesIO
+import threading
 from zipfile import ZipFile
 import shutil
+from metrics import UPLOAD_BYTES
+
+# Size of the chunks uploads are streamed to disk and out of zips in
+UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 # Change the current working directory to the root of the project
 def change_cwd():
@@ -18,25 +22,22 @@ def change_cwd():
         print('Error changing working directory:', e)
         sys.exit(1)
 
-# Validate that log data exists within the target directory
+# Validate that the uploaded sources are log files that can be read, keeping only those
 def validate_files(files_to_process):
     try:
-        for file_path in files_to_process:
-            if not os.path.exists(file_path):
-                # If file does not exist, remove it from the list
-                print(f"File path {file_path} does not exist")
-                files_to_process.remove(file_path)
-                continue
-            elif not file_path.endswith('.log'):
-                # If file is not a log file, remove it from the list
-                print(f"File path {file_path} is not a .log file")
-                files_to_process.remove(file_path)
-                os.remove(file_path)
-                continue
-        return files_to_process
+        validated = []
+        for source in files_to_process:
+            name, path, member = source
+            if not name.endswith('.log'):
+                print(f"File {name} is not a .log file")
+            elif member is None and not os.path.exists(path):
+                print(f"File path {path} does not exist")
+            else:
+                validated.append(source)
+        return validated
     except Exception as e:
-        print("Please provide a target directory: python3 run.py --target_dir /path/to/target_dir ", e)
-        sys.exit(1)
+        print("Error validating uploaded files:", e)
+        return []
 
 
 def setup_sn_directories(cwd, sn_numbers):
@@ -58,6 +59,10 @@ def setup_sn_directories(cwd, sn_numbers):
                 os.makedirs(f'{cwd}/data/{sn}/sweeping_csvs')
                 print(f'Created data/{sn}/sweeping_csvs directory')
 
+            if not os.path.exists(f'{cwd}/data/{sn}/sweeping_parquet'):
+                os.makedirs(f'{cwd}/data/{sn}/sweeping_parquet')
+                print(f'Created data/{sn}/sweeping_parquet directory')
+
             if not os.path.exists(f'{cwd}/app/static/graphs/{sn}'):
                 os.makedirs(f'{cwd}/app/static/graphs/{sn}')
                 print(f'Created graphs/{sn} directory')
@@ -89,6 +94,10 @@ def setup(cwd):
             os.makedirs(f'{cwd}/uploads/videos')
             print('Created uploads/videos directory')
 
+        if not os.path.exists(f'{cwd}/exports'):
+            os.makedirs(f'{cwd}/exports')
+            print('Created exports directory')
+
         if not os.path.exists(f'{cwd}/app/static/graphs'):
             os.makedirs(f'{cwd}/app/static/graphs')
             print('Created static/graphs directory')
@@ -105,11 +114,11 @@ def setup(cwd):
         print('Error setting up directories:', e)
         sys.exit(1)
 
-# Determine which trucks the data, in the given target directory, was taken from
+# Determine which trucks the data, in the given uploaded sources, was taken from
 def get_sn_numbers(files):
     try:
         # Extract SN numbers from log file names
-        sn_numbers = list(set(f.split('/')[-1].split('_')[0] for f in files if f.endswith('.log')))
+        sn_numbers = list(set(name.split('_')[0] for name, _, _ in files if name.endswith('.log')))
         if len(sn_numbers) == 0:
             print('No SN numbers found in log files')
             return []
@@ -121,78 +130,151 @@ def get_sn_numbers(files):
         return []
 
 
-# Extract uploaded files based on the file type
-def extract_uploaded_files(cwd, uploaded_files, file_type):
+# Write a file through a temporary file that is renamed into place, so a failed write never leaves a partial file
+def write_atomically(path, write):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+# Locks serializing the writes to the stores of each SN, keyed by (cwd, sn)
+SN_WRITE_LOCKS = {}
+SN_WRITE_LOCKS_LOCK = threading.Lock()
+
+# Lock serializing the writes to the stores of an SN across jobs and request threads. It is reentrant, so a store
+# update can take it under a caller already holding it
+def sn_write_lock(cwd, sn):
+    with SN_WRITE_LOCKS_LOCK:
+        return SN_WRITE_LOCKS.setdefault((cwd, sn), threading.RLock())
+
+# Progress callback used when a caller does not track progress
+def no_progress(stage, fraction):
+    pass
+
+# Get the supported extensions and upload directory of a file type
+def upload_settings(file_type):
     if file_type == 'log':
-        supported_extensions = ['.log']
-        directory_name = 'uploads/files'
+        return ['.log'], 'uploads/files'
     elif file_type == 'video':
-        supported_extensions = ['.mp4', '.h264']
-        directory_name = 'uploads/videos'
+        return ['.mp4', '.h264'], 'uploads/videos'
     else:
         raise ValueError("Unsupported file type. Use 'log' or 'video'.")
 
-    # Create the upload directory if it does not exist
-    upload_dir = os.path.join(cwd, directory_name)
-    
+# Save uploaded files of the file type, and zips that may contain them, to the upload directory, streaming each
+# to disk in chunks
+def save_uploaded_files(cwd, uploaded_files, file_type, upload_dir=None):
+    supported_extensions, directory_name = upload_settings(file_type)
+    upload_dir = upload_dir or os.path.join(cwd, directory_name)
+    os.makedirs(upload_dir, exist_ok=True)
+
     for file in uploaded_files:
-        if any(file.filename.endswith(ext) for ext in supported_extensions):
-            file.save(os.path.join(upload_dir, file.filename))
-            print(f'File {file.filename} saved to {directory_name} directory')
-        elif file.filename.endswith('.zip'):
-            zip_file_stream = BytesIO(file.read())
-            with ZipFile(zip_file_stream, 'r') as zip_file:
-                zip_file.extractall(upload_dir)
-                print(f'Files extracted from {file.filename}')
+        if any(file.filename.endswith(ext) for ext in supported_extensions) or file.filename.endswith('.zip'):
+            file_path = os.path.join(upload_dir, os.path.basename(file.filename))
+            file.save(file_path, buffer_size=UPLOAD_CHUNK_SIZE)
+            UPLOAD_BYTES.inc(os.path.getsize(file_path), kind=file_type)
+            print(f'File {file.filename} saved to {upload_dir} directory')
         else:
             print(f'Unsupported file type: {file.filename}')
-            continue
+    return upload_dir
 
-    for item in os.listdir(upload_dir):
+# List the files of the file type saved to the upload directory, and those inside saved zips, as
+# (name, path, zip member) sources. Zip members are selected by name without extracting anything
+def upload_sources(upload_dir, file_type):
+    supported_extensions, _ = upload_settings(file_type)
+    sources = []
+    for item in sorted(os.listdir(upload_dir)):
         item_path = os.path.join(upload_dir, item)
         if item.endswith('.zip'):
-            os.remove(item_path)
-            print(f'Removed zip file {item}')
-        elif os.path.isdir(item_path):
-            for sub_item in os.listdir(item_path):
-                if any(sub_item.endswith(ext) for ext in supported_extensions):
-                    shutil.move(os.path.join(item_path, sub_item), upload_dir)
-                    print(f'Moved file {sub_item} to {directory_name} directory')
-            shutil.rmtree(item_path)
-            print(f'Removed directory {item}')
-        elif not any(item.endswith(ext) for ext in supported_extensions):
-            os.remove(item_path)
-            print(f'Removed file {item}')
-
-    # Get the paths of uploaded files
-    uploaded_file_paths = [os.path.join(upload_dir, f) for f in os.listdir(upload_dir) if any(f.endswith(ext) for ext in supported_extensions)]
+            with ZipFile(item_path, 'r') as zip_file:
+                for info in zip_file.infolist():
+                    name = os.path.basename(info.filename)
+                    if info.is_dir() or name.startswith('.') or '__MACOSX' in info.filename:
+                        continue
+                    if any(name.endswith(ext) for ext in supported_extensions):
+                        sources.append((name, item_path, info.filename))
+        elif os.path.isfile(item_path) and any(item.endswith(ext) for ext in supported_extensions):
+            sources.append((item, item_path, None))
+    return sources
 
-    return uploaded_file_paths
+# Write an uploaded source to its destination: saved files are moved, zip members are streamed out of the archive
+# in chunks. zip_files holds the archives already opened by the caller, keyed by path
+def copy_upload_source(source, destination, zip_files=None):
+    name, path, member = source
+    if member is None:
+        shutil.move(path, destination)
+        return destination
 
-# Clear uploaded files
-def clear_uploaded_files(cwd):
-    try:
-        for file in os.listdir(f'{cwd}/uploads/files'):
-            os.remove(f'{cwd}/uploads/files/{file}')
-        print('Uploaded files cleared')
-    except Exception as e:
-        print('Error clearing uploaded files:', e)
-        sys.exit(1)
+    zip_file = zip_files.get(path) if zip_files is not None else None
+    if zip_file is None:
+        zip_file = ZipFile(path, 'r')
+        if zip_files is not None:
+            zip_files[path] = zip_file
+
+    def write(tmp_path):
+        with zip_file.open(member) as src, open(tmp_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, UPLOAD_CHUNK_SIZE)
+    write_atomically(destination, write)
+    if zip_files is None:
+        zip_file.close()
+    return destination
+
+# Close the archives opened by copy_upload_source
+def close_zip_files(zip_files):
+    for zip_file in zip_files.values():
+        zip_file.close()
+    zip_files.clear()
 
-# Clear uploaded and processed videos
-def clear_uploaded_videos(cwd):
+# Extract the files of the file type from the zips saved to the upload directory and return the paths of all
+# the files of the file type in it
+def extract_saved_files(upload_dir, file_type):
+    zip_files = {}
     try:
-        for video in os.listdir(f'{cwd}/uploads/videos'):
-            os.remove(f'{cwd}/uploads/videos/{video}')
-        print('Uploaded videos cleared')
+        uploaded_file_paths = []
+        for source in upload_sources(upload_dir, file_type):
+            destination = os.path.join(upload_dir, source[0])
+            if source[2] is not None and not os.path.exists(destination):
+                copy_upload_source(source, destination, zip_files)
+                print(f'Extracted {source[0]} from {os.path.basename(source[1])}')
+            if destination not in uploaded_file_paths:
+                uploaded_file_paths.append(destination)
+    finally:
+        close_zip_files(zip_files)
+    return uploaded_file_paths
 
-        for video in os.listdir(f'{cwd}/app/static/videos'):
-            if video.endswith('_graph_video.mp4') or video.endswith('_10_fps.mp4'):
-                os.remove(f'{cwd}/app/static/videos/{video}')
-        print('Processed videos cleared')
+# Directory receiving the chunks of a resumable upload
+def chunked_upload_dir(cwd, upload_id):
+    if not upload_id.isalnum():
+        raise ValueError('Invalid upload id')
+    return os.path.join(cwd, 'uploads/chunked', upload_id)
 
-    except Exception as e:
-        print('Error clearing uploaded videos:', e)
-        sys.exit(1)
+# Append a chunk read from a stream to a file of a resumable upload. The chunk must start where the file
+# currently ends, so a client resumes an interrupted upload from the size it is told; returns the new size
+def append_upload_chunk(upload_dir, file_name, offset, stream):
+    os.makedirs(upload_dir, exist_ok=True)
+    file_path = os.path.join(upload_dir, os.path.basename(file_name))
+    size = os.path.getsize(file_path) if os.path.exists(file_path) else 0
+    if offset != size:
+        raise ValueError(f'Expected a chunk at offset {size}')
+    with open(file_path, 'ab') as f:
+        shutil.copyfileobj(stream, f, UPLOAD_CHUNK_SIZE)
+    new_size = os.path.getsize(file_path)
+    UPLOAD_BYTES.inc(new_size - size, kind='log')
+    return new_size
 
+# Sizes of the files received so far by a resumable upload
+def upload_chunk_sizes(upload_dir):
+    if not os.path.exists(upload_dir):
+        return {}
+    return {f: os.path.getsize(os.path.join(upload_dir, f)) for f in os.listdir(upload_dir)}
 
+# Remove the upload directory of a job
+def clear_upload_dir(upload_dir):
+    try:
+        shutil.rmtree(upload_dir, ignore_errors=True)
+        print(f'Cleared {upload_dir}')
+    except Exception as e:
+        print(f'Error clearing {upload_dir}:', e)
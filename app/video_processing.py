@@ -1,195 +1,270 @@
 import os
 import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-import cv2
-from moviepy.editor import VideoFileClip
+import matplotlib.dates as mdates
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import subprocess
-import shlex
-
-
-def convert_h264_to_mp4(input_path, output_path):
-    # Use FFmpeg to convert .h264 to .mp4 with optimized settings
-    command = f'ffmpeg -i {shlex.quote(input_path)} -c:v copy -c:a copy {shlex.quote(output_path)}'
-    subprocess.run(shlex.split(command), check=True)
-
-def change_fps(cwd, input_video_path):
-    output_dir = os.path.join(cwd, f'{cwd}/data/uploads/videos')
-    os.makedirs(output_dir, exist_ok=True)
-    output_video_path = os.path.join(output_dir, f'{os.path.basename(input_video_path)[:-4]}_10_fps.mp4')
-
-    # check if output video already exists
-    if os.path.exists(output_video_path):
-        return output_video_path
-
-    if input_video_path.endswith('.h264'):
-        # Convert .h264 to .mp4 if necessary
-        mp4_output_path = input_video_path[:-5] + '.mp4'
-        convert_h264_to_mp4(input_video_path, mp4_output_path)
-        input_video_path = mp4_output_path
-
-    # Load the video clip
-    try:
-        video_clip = VideoFileClip(input_video_path)
-    except Exception as e:
-        print(f"Error loading video file: {e}")
-        return
-    
-    # Print the current FPS
-    print(f"Current FPS: {video_clip.fps}")
-
-    # Change the FPS to the target FPS
-    new_video_clip = video_clip.set_fps(10)
-
-    # Write the new video clip to a file
-    new_video_clip.write_videofile(output_video_path, codec='libx264', fps=10, threads=4, preset='ultrafast')
-
-    # Close the video clips
-    video_clip.close()
-    new_video_clip.close()
-    return output_video_path
-
-
-def create_graph_video(cwd, video_path):
-    output_path = f'{cwd}/uploads/videos/{video_path.split("/")[-1][:-4]}_graph_video.mp4'
-    # check if already exists
-    if os.path.exists(output_path):
-        return output_path
-    csv_path = f'{cwd}/data/{video_path.split("/")[-1].split("_")[1]}/csv_files/{ "_".join(video_path.split("/")[-1].split("_")[-6:-1])}.csv'
-    
-    # Load CSV data into a pandas DataFrame
-    df = pd.read_csv(csv_path)
-
-    # Ensure 'datetime' is in datetime format
-    df['datetime'] = pd.to_datetime(df['datetime'])
-
+import threading
+from utils import no_progress
+from log_parser import apply_schema
+from channels import read_segments, segment_frame
+from metrics import timed_stage, stage_timer, FRAMES_ENCODED
+
+# Set backend for matplotlib to 'Agg' to render the graph video without a display
+plt.switch_backend('Agg')
+
+
+# Frame rate of the graph video, one frame per 10 Hz telemetry row
+GRAPH_VIDEO_FPS = 10
+# Colour and dash pattern (pixels on, pixels off) of the time cursor
+CURSOR_COLOR = np.array([255, 0, 0], dtype=np.uint8)
+CURSOR_DASH = (5, 2)
+GRAPH_COLUMNS = ['datetime', 'EngineSpeed', 'FanSpeed', 'EngineFuelRateTMSCS', 'NozGapOpen']
+# Encoder settings by preset name: codec, encoder speed preset and constant rate factor (lower is better quality)
+VIDEO_PRESETS = {
+    'fast': ('libx264', 'ultrafast', 28),
+    'balanced': ('libx264', 'veryfast', 23),
+    'quality': ('libx264', 'medium', 18),
+    'hevc': ('libx265', 'fast', 26),
+}
+VIDEO_PRESET = os.environ.get('VIDEO_PRESET', 'balanced')
+# Frames between progress updates while merging
+PROGRESS_INTERVAL_FRAMES = 100
+# Videos merged at once across every video job: from VIDEO_WORKERS if set, otherwise one per ENCODER_THREADS cores,
+# capped so each merge has VIDEO_MEMORY_PER_JOB bytes of the memory available at startup
+VIDEO_WORKERS = int(os.environ.get('VIDEO_WORKERS', 0))
+ENCODER_THREADS = int(os.environ.get('ENCODER_THREADS', 2))
+VIDEO_MEMORY_PER_JOB = int(os.environ.get('VIDEO_MEMORY_PER_JOB', 1024 ** 3))
+
+# pyplot is not thread safe, so graph backgrounds are rendered one at a time
+GRAPH_RENDER_LOCK = threading.Lock()
+
+
+# Rasterize the three static subplots once, returning the background image, the cursor column of every frame
+# in each subplot and the pixel rows the cursor spans in each subplot
+def render_graph_background(df):
     # Create a figure with three subplots (3 rows, 1 column)
     fig, axs = plt.subplots(3, 1, figsize=(14, 7))
 
-    # Precompute max values for scaling
-    engine_speed_max = df['EngineSpeed'].max()
-    fan_speed_max = df['FanSpeed'].max()
-    fuel_rate_max = df['EngineFuelRateTMSCS'].max()
-
-    # Plot Engine Speed
-    axs[0].plot(df['datetime'], df['EngineSpeed'], label='Engine Speed')
-    axs[0].plot(df['datetime'], df['NozGapOpen'] * engine_speed_max, label='NozGapOpen', linestyle='--')
-    axs[0].legend()
-    axs[0].set_xlabel('Time')
-    axs[0].set_ylabel('Engine Speed (rpm)')
-    axs[0].grid(True)
-
-    # Plot Fan Speed
-    axs[1].plot(df['datetime'], df['FanSpeed'], label='Fan Speed')
-    axs[1].plot(df['datetime'], df['NozGapOpen'] * fan_speed_max, label='NozGapOpen', linestyle='--')
-    axs[1].legend()
-    axs[1].set_xlabel('Time')
-    axs[1].set_ylabel('Fan Speed (rpm)')
-    axs[1].grid(True)
-
-    # Plot Fuel Rate
-    axs[2].plot(df['datetime'], df['EngineFuelRateTMSCS'], label='Fuel Rate')
-    axs[2].plot(df['datetime'], df['NozGapOpen'] * fuel_rate_max, label='NozGapOpen', linestyle='--')
-    axs[2].legend()
-    axs[2].set_xlabel('Time')
-    axs[2].set_ylabel('Fuel Rate (L/h)')
-    axs[2].grid(True)
+    for ax, column, label, ylabel in zip(axs, ['EngineSpeed', 'FanSpeed', 'EngineFuelRateTMSCS'],
+                                         ['Engine Speed', 'Fan Speed', 'Fuel Rate'],
+                                         ['Engine Speed (rpm)', 'Fan Speed (rpm)', 'Fuel Rate (L/h)']):
+        ax.plot(df['datetime'], df[column], label=label)
+        ax.plot(df['datetime'], df['NozGapOpen'] * df[column].max(), label='NozGapOpen', linestyle='--')
+        ax.legend()
+        ax.set_xlabel('Time')
+        ax.set_ylabel(ylabel)
+        ax.grid(True)
 
     # Adjust layout to prevent overlap
     plt.tight_layout()
+    fig.canvas.draw()
+    background = np.asarray(fig.canvas.buffer_rgba())[:, :, :3]
+    height, width = background.shape[:2]
+
+    # Map the time of every frame to a pixel column, and each subplot to the pixel rows it covers
+    x = mdates.date2num(df['datetime'])
+    columns, spans = [], []
+    for ax in axs:
+        display_x = ax.transData.transform(np.column_stack([x, np.zeros(len(x))]))[:, 0]
+        columns.append(np.clip(np.round(display_x).astype(np.int64), 0, width - 1))
+        spans.append((int(round(height - ax.bbox.y1)), int(round(height - ax.bbox.y0))))
+    plt.close(fig)
+
+    # Pad to even dimensions, as required by yuv420p encoding
+    padded = np.full((height + height % 2, width + width % 2, 3), 255, dtype=np.uint8)
+    padded[:height, :width] = background
+    return padded, columns, spans
+
+
+# ffmpeg output arguments of an encoder preset, optionally limiting the threads of the encoder
+def encoder_args(preset=VIDEO_PRESET, threads=None):
+    if preset not in VIDEO_PRESETS:
+        raise ValueError(f"Unknown video preset '{preset}'. Use one of: {', '.join(VIDEO_PRESETS)}")
+    codec, speed, crf = VIDEO_PRESETS[preset]
+    thread_args = ['-threads', str(threads)] if threads else []
+    return ['-c:v', codec, '-preset', speed, '-crf', str(crf), '-pix_fmt', 'yuv420p'] + thread_args + ['-f', 'mp4']
+
+
+# ffmpeg input arguments of raw RGB graph frames read from stdin
+def raw_frame_input_args(width, height):
+    return ['-f', 'rawvideo', '-pix_fmt', 'rgb24', '-s', f'{width}x{height}', '-r', str(GRAPH_VIDEO_FPS), '-i', '-']
+
+
+# Start an ffmpeg process that resamples the camera video to the graph frame rate, scales it to the graph height
+# and stacks it left of the raw graph frames read from its stdin, decoding and encoding each video once
+def start_merge_encoder(camera_path, width, height, output_path, preset=VIDEO_PRESET, threads=None):
+    filter_graph = (f'[0:v]fps={GRAPH_VIDEO_FPS},scale=-2:{height},setsar=1,format=yuv420p[sweep];'
+                    f'[1:v]format=yuv420p[graph];'
+                    f'[sweep][graph]hstack=inputs=2:shortest=1[merged]')
+    command = (['ffmpeg', '-y', '-loglevel', 'error', '-i', camera_path] + raw_frame_input_args(width, height)
+               + ['-filter_complex', filter_graph, '-map', '[merged]'] + encoder_args(preset, threads) + [output_path])
+    return subprocess.Popen(command, stdin=subprocess.PIPE)
+
+
+# Draw the cursor of a range of frames onto a copy of the background and pipe each frame to an ffmpeg encoder.
+# Only the cursor columns change between frames, so each frame restores the previous cursor from the background
+def write_graph_frames(encoder, background, columns, spans, frames, progress=no_progress):
+    frame = background.copy()
+    dash_on, dash_off = CURSOR_DASH
+    dashes = [np.arange(top, bottom)[(np.arange(bottom - top) % (dash_on + dash_off)) < dash_on] for top, bottom in spans]
+
+    previous = None
+    written = 0
+    for n, i in enumerate(frames):
+        if previous is not None:
+            for ax_columns, rows in zip(columns, dashes):
+                frame[rows, ax_columns[previous]] = background[rows, ax_columns[previous]]
+        for ax_columns, rows in zip(columns, dashes):
+            frame[rows, ax_columns[i]] = CURSOR_COLOR
+        try:
+            encoder.stdin.write(memoryview(frame))
+        except BrokenPipeError:
+            # The encoder stops reading once the shorter video of a merge ends
+            break
+        written += 1
+        previous = i
+        if n % PROGRESS_INTERVAL_FRAMES == 0:
+            progress('merge', n / len(frames))
+    FRAMES_ENCODED.inc(written)
 
-    # Initialize lines for the vertical marker on each subplot
-    vertical_lines = [ax.axvline(x=df['datetime'].iloc[0], color='red', linestyle='--', linewidth=1) for ax in axs]
-
-    # Define the update function for the animation
-    def update(frame):
-        datetime = df['datetime'].iloc[frame]
-        for line in vertical_lines:
-            line.set_xdata([datetime])
-        return vertical_lines
-
-    # Define writer parameters for saving the animation as MP4
-    Writer = animation.writers['ffmpeg']
-    writer = Writer(fps=10, metadata=dict(artist='Me'), bitrate=1800)  # Adjust bitrate as needed
-
-    # Create the animation
-    ani = animation.FuncAnimation(fig, update, frames=range(len(df)), blit=True)
-
-    # Save the animation as an MP4 file
-    
-    ani.save(output_path, writer=writer)
 
-    print(f'Animation saved to {output_path}')
+# Close the stdin of an ffmpeg encoder and wait for it to finish writing the output
+def finish_encoder(encoder, output_path):
+    try:
+        encoder.stdin.close()
+    except BrokenPipeError:
+        pass
+    if encoder.wait() != 0:
+        raise RuntimeError(f'ffmpeg failed encoding {output_path}')
     return output_path
 
 
-def merge_videos(cwd, video_path, sn):
-    # Open video files
-    graph_video_path = f'{cwd}/uploads/videos/{video_path.split("/")[-1][:-4]}_graph_video.mp4'
-    sweep_video_path = f'{cwd}/uploads/videos/{video_path.split("/")[-1][:-4]}_10_fps.mp4'
-    graph_video = cv2.VideoCapture(graph_video_path)
-    sweep_video = cv2.VideoCapture(sweep_video_path)
-
-    # Get video properties once
-    graph_fps = graph_video.get(cv2.CAP_PROP_FPS)
-    graph_width = int(graph_video.get(cv2.CAP_PROP_FRAME_WIDTH))
-    graph_height = int(graph_video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    sweep_width = int(sweep_video.get(cv2.CAP_PROP_FRAME_WIDTH))
-    sweep_height = int(sweep_video.get(cv2.CAP_PROP_FRAME_HEIGHT))
-    min_frames = min(int(graph_video.get(cv2.CAP_PROP_FRAME_COUNT)), int(sweep_video.get(cv2.CAP_PROP_FRAME_COUNT)))
-
-    # Determine the aspect ratio for resizing the frames
-    if sweep_height != 0:
-        aspect_ratio = graph_height / sweep_height
-    else:
-        aspect_ratio = 1  # Default to 1 if sweep_height is 0 to avoid division by zero
-
-    # Create VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    output_path = f'{cwd}/app/static/videos/{video_path.split("/")[-1].split("_")[1]}/{video_path.split("/")[-1]}'
-    out = cv2.VideoWriter(output_path, fourcc, graph_fps, (int(graph_width + sweep_width * aspect_ratio), graph_height))
-
-    # Pre-compute resized width
-    resized_sweep_width = int(sweep_width * aspect_ratio)
-
-    # Read, resize, and merge frames in a loop
-    for _ in range(min_frames):
-        ret_graph, frame_graph = graph_video.read()
-        ret_sweep, frame_sweep = sweep_video.read()
-
-        if not ret_graph or not ret_sweep:
-            break
-
-        # Resize sweep video to match the height of the graph video
-        frame_sweep_resized = cv2.resize(frame_sweep, (resized_sweep_width, graph_height), interpolation=cv2.INTER_AREA)
-        
-        # Concatenate frames horizontally
-        merged_frame = cv2.hconcat([frame_sweep_resized, frame_graph])
-
-        # Write the frame to the output video
-        out.write(merged_frame)
+# Path of the telemetry CSV of the session a video was recorded in
+def graph_csv_path(cwd, video_path):
+    return f'{cwd}/data/{video_path.split("/")[-1].split("_")[1]}/csv_files/{ "_".join(video_path.split("/")[-1].split("_")[-6:-1])}.csv'
+
+
+# Load the plotted columns of the telemetry of the session of a video, mapped from the channel store of its SN, or
+# read from its CSV if the session has no segment in the store
+def load_graph_data(cwd, video_path):
+    sn = video_path.split("/")[-1].split("_")[1]
+    session = "_".join(video_path.split("/")[-1].split("_")[-6:-1])
+    segments = read_segments(cwd, sn, {session: (None, None)}, GRAPH_COLUMNS)
+    if session in segments:
+        return segment_frame(segments[session], GRAPH_COLUMNS)
+    # Cast to the compact dtypes, parsing 'datetime' once with its format
+    return apply_schema(pd.read_csv(graph_csv_path(cwd, video_path), usecols=GRAPH_COLUMNS))
+
+
+# Load and render the graph background of the session of a video, reusing the one in session_graphs if another
+# video of the same session already rendered it
+def session_graph(cwd, video_path, session_graphs=None):
+    csv_path = graph_csv_path(cwd, video_path)
+    with GRAPH_RENDER_LOCK:
+        if session_graphs is not None and csv_path in session_graphs:
+            return session_graphs[csv_path]
+        with stage_timer('graph_background'):
+            df = load_graph_data(cwd, video_path)
+            graph = (render_graph_background(df), len(df))
+        if session_graphs is not None:
+            session_graphs[csv_path] = graph
+        return graph
+
+
+# Merge the camera video with its graph video in one streaming ffmpeg pass: the camera video is decoded once,
+# resampled, scaled and stacked with graph frames piped from memory, and encoded once, with no intermediate files
+def merge_videos(cwd, video_path, sn, preset=VIDEO_PRESET, progress=no_progress, threads=None, session_graphs=None):
+    output_path = f'{cwd}/app/static/videos/{sn}/{video_path.split("/")[-1]}'
+    tmp_path = f'{output_path}.tmp'
+
+    progress('graph background', 0.0)
+    (background, columns, spans), frame_count = session_graph(cwd, video_path, session_graphs)
+    progress('graph background', 1.0)
+
+    height, width = background.shape[:2]
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    try:
+        encoder = start_merge_encoder(video_path, width, height, tmp_path, preset, threads)
+        try:
+            write_graph_frames(encoder, background, columns, spans, range(frame_count), progress)
+        finally:
+            finish_encoder(encoder, tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    progress('merge', 1.0)
 
-    # Release video objects and writer
-    graph_video.release()
-    sweep_video.release()
-    out.release()
     print(f"Videos merged successfully! Merged video saved at: {output_path}")
     return output_path
 
-    
-
 
-def process_video(cwd, video_path):
+@timed_stage('process_video')
+def process_video(cwd, video_path, progress=no_progress, preset=VIDEO_PRESET, threads=None, session_graphs=None):
     try:
         sn = video_path.split("/")[-1].split("_")[1]
-        create_graph_video(cwd, video_path)
-        print("Created graph video")
-        change_fps(cwd, video_path)
-        print("Changed FPS")
-        output_path = merge_videos(cwd, video_path, sn)
+        output_path = merge_videos(cwd, video_path, sn, preset, progress, threads, session_graphs)
         print("Video merged successfully!")
         return output_path
     except Exception as e:
         print(f"Error processing video: {e}")
         return None
+
+
+# Bytes of memory available to new processes, or None where the platform does not report it
+def available_memory():
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+# Number of videos to merge at once across every video job, bounded by the CPU count and the available memory
+def max_video_workers():
+    workers = VIDEO_WORKERS
+    if workers <= 0:
+        workers = max(1, (os.cpu_count() or 1) // ENCODER_THREADS)
+        memory = available_memory()
+        if memory is not None:
+            workers = min(workers, max(1, memory // VIDEO_MEMORY_PER_JOB))
+    return max(1, workers)
+
+
+MAX_VIDEO_WORKERS = max_video_workers()
+# Slots held by each merge, so video jobs running at once share MAX_VIDEO_WORKERS encoders rather than each
+# starting that many
+VIDEO_SLOTS = threading.BoundedSemaphore(MAX_VIDEO_WORKERS)
+
+
+# Number of videos of one job to merge at once
+def video_workers(video_count):
+    return max(1, min(MAX_VIDEO_WORKERS, video_count))
+
+
+# Process a video once one of the encoder slots shared by every video job is free
+def process_video_in_slot(cwd, video_path, progress, preset, threads, session_graphs):
+    with VIDEO_SLOTS:
+        return process_video(cwd, video_path, progress, preset, threads, session_graphs)
+
+
+# Process multiple videos in parallel with bounded concurrency, yielding (video_path, output_path) as each
+# video finishes. Videos of the same session share one parsed CSV and rendered graph background, and each
+# encoder gets an equal share of the cores
+def process_videos(cwd, video_paths, progress=no_progress, preset=VIDEO_PRESET):
+    if not video_paths:
+        return
+    workers = video_workers(len(video_paths))
+    threads = max(1, (os.cpu_count() or 1) // MAX_VIDEO_WORKERS)
+    session_graphs = {}
+    print(f'Processing {len(video_paths)} videos, {workers} at a time')
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='video') as executor:
+        futures = {}
+        for video_path in video_paths:
+            name = os.path.basename(video_path)
+            video_progress = lambda stage, fraction, name=name: progress(f'{name} {stage}', fraction)
+            futures[executor.submit(process_video_in_slot, cwd, video_path, video_progress, preset, threads, session_graphs)] = video_path
+        for future in as_completed(futures):
+            yield futures[future], future.result()
@@ -0,0 +1,53 @@
+import atexit
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Process pool shared by the app for the lifetime of the server
+_pool = None
+
+# Tasks submitted to and completed by the worker pool, counted by submit_task
+_task_counts = {'submitted': 0, 'completed': 0}
+_task_counts_lock = threading.Lock()
+
+# Start the worker pool, if it is not already running
+def start_pool(max_workers=None):
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=max_workers)
+        atexit.register(shutdown_pool)
+        print('Worker pool started')
+    return _pool
+
+# Get the running worker pool, starting it on first use
+def get_pool():
+    return start_pool()
+
+# Count a finished, failed or cancelled task of the worker pool
+def _task_done(future):
+    with _task_counts_lock:
+        _task_counts['completed'] += 1
+
+# Submit fn(*args) to the worker pool, counting it until it finishes
+def submit_task(fn, *args):
+    with _task_counts_lock:
+        _task_counts['submitted'] += 1
+    try:
+        future = get_pool().submit(fn, *args)
+    except Exception:
+        _task_done(None)
+        raise
+    future.add_done_callback(_task_done)
+    return future
+
+# Number of tasks submitted to the worker pool that have not finished, queued or running
+def pending_tasks():
+    with _task_counts_lock:
+        return _task_counts['submitted'] - _task_counts['completed']
+
+# Shut the worker pool down
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+        print('Worker pool shut down')
@@ -0,0 +1,131 @@
+import os
+import sys
+import argparse
+import numpy as np
+from datetime import datetime, timedelta
+
+# Synthetic 10 Hz sweeper logs in the [column names] / [data] format read by log_parser.py, one file per session
+# named SN<number>_YYYY_MM_DD_HHMM.log. Sessions alternate between driving and sweeping segments; while sweeping,
+# the nozzle gap opens for exponentially distributed events sized to give the requested NozGapOpen duty cycle
+SAMPLE_INTERVAL_S = 0.1
+LOG_COLUMNS = ['time', 'EngineSpeed', 'FanSpeed', 'EngineFuelRateTMSCS', 'Nozzle1downTMSCS', 'Nozzle2downTMS', 'NozGapOpen', 'TotalFuelConsumption']
+# Mean length of a driving and of a sweeping segment, and of a NozGapOpen event (seconds)
+MEAN_DRIVING_S = 300
+MEAN_SWEEPING_S = 1200
+MEAN_GAP_OPEN_S = 20
+# Rows formatted and written at a time
+WRITE_CHUNK_ROWS = 100000
+
+# Alternate runs of False and True whose lengths in samples are drawn from exponentials with the given means,
+# starting with False, over n samples
+def alternating_runs(rng, n, mean_false_s, mean_true_s):
+    active = np.zeros(n, dtype=bool)
+    position, state = 0, False
+    while position < n:
+        mean_s = mean_true_s if state else mean_false_s
+        length = max(1, int(rng.exponential(mean_s) / SAMPLE_INTERVAL_S)) if mean_s > 0 else n
+        active[position:position + length] = state
+        position += length
+        state = not state
+    return active
+
+# Smooth noise around zero: an AR(1) process with the given standard deviation and correlation time (seconds),
+# stepped once a second and interpolated to the sample rate
+def smooth_noise(rng, n, std, correlation_s):
+    steps = int(n * SAMPLE_INTERVAL_S) + 2
+    phi = np.exp(-1 / correlation_s)
+    shocks = rng.normal(0, std * np.sqrt(1 - phi ** 2), steps)
+    noise = np.empty(steps)
+    noise[0] = rng.normal(0, std)
+    for i in range(1, steps):
+        noise[i] = phi * noise[i - 1] + shocks[i]
+    return np.interp(np.arange(n) * SAMPLE_INTERVAL_S, np.arange(steps), noise)
+
+# Signals of one session of n samples
+def session_signals(rng, n, duty_cycle, total_fuel):
+    nozzle1 = alternating_runs(rng, n, MEAN_DRIVING_S, MEAN_SWEEPING_S)
+    nozzle2 = nozzle1 & alternating_runs(rng, n, MEAN_SWEEPING_S / 2, MEAN_SWEEPING_S)
+    if duty_cycle >= 1:
+        gap_open = nozzle1.copy()
+    elif duty_cycle <= 0:
+        gap_open = np.zeros(n, dtype=bool)
+    else:
+        gap_open = nozzle1 & alternating_runs(rng, n, MEAN_GAP_OPEN_S * (1 - duty_cycle) / duty_cycle, MEAN_GAP_OPEN_S)
+
+    engine_speed = np.where(nozzle1, 1800, 1400) + smooth_noise(rng, n, 150, 30) + rng.normal(0, 20, n)
+    engine_speed = np.clip(engine_speed, 700, 2300).round()
+    fan_speed = np.where(nozzle1, 2600 + 400 * gap_open, 0) + np.where(nozzle1, smooth_noise(rng, n, 200, 60), 0)
+    fan_speed = np.clip(fan_speed, 0, 3500).round()
+    fuel_rate = 4 + engine_speed * 0.006 + fan_speed * 0.0015 + rng.normal(0, 0.8, n)
+    # Short spikes, as when the engine is loaded
+    spikes = alternating_runs(rng, n, 600, 3)
+    fuel_rate = np.clip(np.where(spikes, fuel_rate + 12, fuel_rate), 0, None).round(2)
+    total_fuel_consumption = (total_fuel + np.cumsum(fuel_rate * SAMPLE_INTERVAL_S / 3600)).round(3)
+    return {
+        'EngineSpeed': engine_speed,
+        'FanSpeed': fan_speed,
+        'EngineFuelRateTMSCS': fuel_rate,
+        'Nozzle1downTMSCS': nozzle1.astype(int),
+        'Nozzle2downTMS': nozzle2.astype(int),
+        'NozGapOpen': gap_open.astype(int),
+        'TotalFuelConsumption': total_fuel_consumption
+    }
+
+# Write one session log starting at start_time, returning its path and the fuel total at its end
+def write_session_log(output_dir, sn, start_time, hours, duty_cycle, total_fuel, rng):
+    # Sessions end before midnight, as the date of every row is taken from the file name
+    midnight = datetime.combine(start_time.date() + timedelta(days=1), datetime.min.time())
+    n = int(min(hours * 3600, (midnight - start_time).total_seconds() - 1) / SAMPLE_INTERVAL_S)
+    signals = session_signals(rng, n, duty_cycle, total_fuel)
+    # Time of day in tenths of a second, kept as integers so the clock never rounds up to 60 seconds
+    tenths = (start_time.hour * 3600 + start_time.minute * 60) * 10 + np.arange(n)
+
+    log_path = os.path.join(output_dir, f"{sn}_{start_time.strftime('%Y_%m_%d_%H%M')}.log")
+    with open(log_path, 'w') as f:
+        f.write('[header]\nversion 1\n[column names]\n')
+        f.write(' '.join(LOG_COLUMNS) + ' \n[data]\n')
+        for start in range(0, n, WRITE_CHUNK_ROWS):
+            rows = range(start, min(start + WRITE_CHUNK_ROWS, n))
+            f.write(''.join(
+                f"{tenths[i] // 36000:02d}:{tenths[i] % 36000 // 600:02d}:{tenths[i] % 600 // 10:02d}.{tenths[i] % 10}00 "
+                f"{signals['EngineSpeed'][i]:.1f} {signals['FanSpeed'][i]:.1f} {signals['EngineFuelRateTMSCS'][i]:.2f} "
+                f"{signals['Nozzle1downTMSCS'][i]} {signals['Nozzle2downTMS'][i]} {signals['NozGapOpen'][i]} "
+                f"{signals['TotalFuelConsumption'][i]:.3f} \n" for i in rows))
+    return log_path, float(signals['TotalFuelConsumption'][-1]) if n else total_fuel
+
+# Generate the logs of every truck, day and session, returning their paths
+def generate_logs(output_dir, trucks=2, days=1, sessions_per_day=1, session_hours=1.0, duty_cycle=0.4,
+                  start_date='2024-05-01', first_sn=213390, seed=0):
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    log_paths = []
+    for truck in range(trucks):
+        sn = f'SN{first_sn + truck}'
+        total_fuel = float(rng.uniform(1000, 50000))
+        for day in range(days):
+            date = datetime.strptime(start_date, '%Y-%m-%d') + timedelta(days=day)
+            for session in range(sessions_per_day):
+                # Sessions start from 06:00, an hour apart at the least
+                start_time = date + timedelta(hours=6 + session * (session_hours + 1), minutes=int(rng.integers(0, 30)))
+                if start_time.date() != date.date():
+                    break
+                log_path, total_fuel = write_session_log(output_dir, sn, start_time, session_hours, duty_cycle, total_fuel, rng)
+                log_paths.append(log_path)
+                print(f'Generated {log_path}')
+    return log_paths
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic 10 Hz sweeper logs')
+    parser.add_argument('output_dir')
+    parser.add_argument('--trucks', type=int, default=2)
+    parser.add_argument('--days', type=int, default=1)
+    parser.add_argument('--sessions-per-day', type=int, default=1)
+    parser.add_argument('--session-hours', type=float, default=1.0)
+    parser.add_argument('--duty-cycle', type=float, default=0.4, help='Fraction of sweeping time with the nozzle gap open')
+    parser.add_argument('--start-date', default='2024-05-01')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    if not 0 <= args.duty_cycle <= 1:
+        sys.exit('--duty-cycle must be between 0 and 1')
+    generate_logs(args.output_dir, args.trucks, args.days, args.sessions_per_day, args.session_hours, args.duty_cycle,
+                  args.start_date, seed=args.seed)
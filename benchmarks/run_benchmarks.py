@@ -0,0 +1,253 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+import statistics
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), 'app'))
+
+import pandas as pd
+from generate_logs import generate_logs
+from utils import setup, upload_sources
+from data_processing import process_data, create_df
+from events import read_event_durations
+from stats import calculate_statistics
+from plot_graphs import draw_plots
+from video_processing import process_video, VIDEO_PRESET
+from worker_pool import start_pool, shutdown_pool
+
+# Times each stage of the pipeline on generated logs in a scratch project directory, recording throughput and the
+# peak resident memory of the app and its workers, and compares the results with a stored baseline
+BASELINE_PATH = os.path.join(BENCHMARK_DIR, 'baseline.json')
+STAGES = ['process_data', 'create_df', 'calculate_statistics', 'draw_plots', 'process_video']
+# How often the memory of the process tree is sampled (seconds)
+RSS_SAMPLE_INTERVAL_S = 0.05
+# Relative slowdown or memory growth over the baseline reported as a regression
+DEFAULT_TOLERANCE = 0.2
+
+# Resident memory in bytes of a process and all of its descendants, read from /proc
+def process_tree_rss(pid):
+    rss = 0
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    rss = int(line.split()[1]) * 1024
+                    break
+        for task in os.listdir(f'/proc/{pid}/task'):
+            with open(f'/proc/{pid}/task/{task}/children') as f:
+                rss += sum(process_tree_rss(int(child)) for child in f.read().split())
+    except (FileNotFoundError, ProcessLookupError, PermissionError, ValueError):
+        pass
+    return rss
+
+# Sample the resident memory of this process and its workers in a background thread while a stage runs,
+# keeping the peak
+class PeakRSS:
+    def __init__(self):
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while True:
+            self.peak = max(self.peak, process_tree_rss(os.getpid()))
+            if self._stop.wait(RSS_SAMPLE_INTERVAL_S):
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, process_tree_rss(os.getpid()))
+        return False
+
+# Run a stage, returning its result and its time, rows and bytes per second and peak memory
+def run_stage(function, rows, size_bytes):
+    with PeakRSS() as rss:
+        start = time.perf_counter()
+        result = function()
+        seconds = time.perf_counter() - start
+    return result, {
+        'seconds': seconds,
+        'rows': rows() if callable(rows) else rows,
+        'rows_per_s': (rows() if callable(rows) else rows) / seconds if seconds > 0 else None,
+        'mb_per_s': ((size_bytes() if callable(size_bytes) else size_bytes) / 1e6) / seconds if seconds > 0 else None,
+        'peak_rss_mb': rss.peak / 1e6 if rss.peak else None
+    }
+
+# Number of data rows in a generated log
+def log_rows(log_path):
+    with open(log_path) as f:
+        for line in f:
+            if line.startswith('[data]'):
+                break
+        return sum(1 for line in f if line.strip())
+
+# Generate a test-pattern camera video of a session, or None if ffmpeg is not available
+def generate_video(video_dir, log_path, seconds, fps):
+    if shutil.which('ffmpeg') is None:
+        return None
+    os.makedirs(video_dir, exist_ok=True)
+    video_path = os.path.join(video_dir, f'cam_{os.path.splitext(os.path.basename(log_path))[0]}_1.mp4')
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error', '-f', 'lavfi', '-i', f'testsrc=duration={seconds}:size=1280x720:rate={fps}',
+                    '-c:v', 'libx264', '-preset', 'ultrafast', '-pix_fmt', 'yuv420p', video_path], check=True)
+    return video_path
+
+# Run every stage once in a fresh project directory and return the metrics of each
+def run_pipeline(work_dir, log_dir, args):
+    cwd = os.path.join(work_dir, 'project')
+    # Mirror the layout of the app, which setup expects
+    os.makedirs(os.path.join(cwd, 'app/templates'), exist_ok=True)
+    setup(cwd)
+    upload_dir = os.path.join(cwd, 'uploads/files/benchmark')
+    shutil.copytree(log_dir, upload_dir)
+    log_paths = sorted(os.path.join(log_dir, f) for f in os.listdir(log_dir))
+    sn = os.path.basename(log_paths[0]).split('_')[0]
+    start_date, end_date = '1970-01-01', '2100-01-01'
+    metrics = {}
+
+    results, metrics['process_data'] = run_stage(lambda: process_data(cwd, upload_sources(upload_dir, 'log')),
+                                                 sum(log_rows(p) for p in log_paths), sum(os.path.getsize(p) for p in log_paths))
+    failed = [r for r in results if r['status'] == 'failed']
+    if failed:
+        raise RuntimeError(f'Ingest failed: {failed}')
+
+    frame = {}
+    def query():
+        frame['df'], _, _ = create_df(cwd, sn, start_date, end_date)
+    _, metrics['create_df'] = run_stage(query, lambda: len(frame['df']), lambda: frame['df'].memory_usage(deep=True).sum())
+
+    durations = read_event_durations(cwd, sn, 'NozGapOpen', pd.to_datetime(start_date), pd.to_datetime(end_date))
+    df_bytes = frame['df'].memory_usage(deep=True).sum()
+    (_, _, _, binned), metrics['calculate_statistics'] = run_stage(lambda: calculate_statistics(frame['df'], durations), len(frame['df']), df_bytes)
+
+    # Plots are drawn into an empty graph cache, so every figure is rendered
+    graphs, metrics['draw_plots'] = run_stage(lambda: draw_plots(os.path.join(cwd, 'app/static/graphs', sn), binned), len(frame['df']), df_bytes)
+    metrics['draw_plots']['plots'] = len(graphs)
+
+    video_path = generate_video(os.path.join(work_dir, 'videos'), log_paths[0], args.video_seconds, args.video_fps)
+    if video_path is None:
+        print('ffmpeg not found, skipping process_video')
+    else:
+        output_path, metrics['process_video'] = run_stage(lambda: process_video(cwd, video_path, preset=args.video_preset),
+                                                          args.video_seconds * args.video_fps, os.path.getsize(video_path))
+        if output_path is None:
+            raise RuntimeError(f'Processing {video_path} failed')
+        # Rows of a video are its frames
+        metrics['process_video']['frames_per_s'] = metrics['process_video'].pop('rows_per_s')
+    del frame['df']
+    return metrics
+
+# Median of each metric over repeated runs, and the highest peak memory
+def summarize_runs(runs):
+    summary = {}
+    for stage in STAGES:
+        stage_runs = [run[stage] for run in runs if stage in run]
+        if stage_runs == []:
+            continue
+        summary[stage] = {}
+        for metric in stage_runs[0]:
+            values = [run[metric] for run in stage_runs if run.get(metric) is not None]
+            if values:
+                summary[stage][metric] = max(values) if metric == 'peak_rss_mb' else statistics.median(values)
+    return summary
+
+# Commit of the benchmarked tree, if it is a git checkout
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BENCHMARK_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# Compare the stage times and peak memory with a baseline, returning the regressions beyond the tolerance
+def compare_with_baseline(results, baseline, tolerance):
+    if baseline['config'] != results['config']:
+        print(f"Warning: the baseline was recorded with a different configuration: {baseline['config']}")
+    regressions = []
+    print(f"\n{'stage':<22}{'metric':<14}{'baseline':>12}{'current':>12}{'change':>10}")
+    for stage, metrics in results['stages'].items():
+        for metric in ['seconds', 'peak_rss_mb']:
+            base, current = baseline['stages'].get(stage, {}).get(metric), metrics.get(metric)
+            if not base or current is None:
+                continue
+            change = current / base - 1
+            flag = ' REGRESSION' if change > tolerance else ''
+            print(f'{stage:<22}{metric:<14}{base:>12.3f}{current:>12.3f}{change:>+10.1%}{flag}')
+            if flag:
+                regressions.append((stage, metric, base, current))
+    return regressions
+
+# Print the metrics of each stage
+def print_results(results):
+    print(f"\n{'stage':<22}{'seconds':>10}{'rows':>12}{'rows/s':>14}{'MB/s':>10}{'peak RSS MB':>14}")
+    for stage, metrics in results['stages'].items():
+        rate = metrics.get('rows_per_s', metrics.get('frames_per_s'))
+        print(f"{stage:<22}{metrics['seconds']:>10.3f}{metrics['rows']:>12.0f}{rate or 0:>14.0f}{metrics.get('mb_per_s') or 0:>10.1f}{metrics.get('peak_rss_mb') or 0:>14.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark each stage of the pipeline on generated logs')
+    parser.add_argument('--trucks', type=int, default=1, help='Trucks to generate; stages after ingest query the first')
+    parser.add_argument('--days', type=int, default=2)
+    parser.add_argument('--sessions-per-day', type=int, default=2)
+    parser.add_argument('--session-hours', type=float, default=1.0)
+    parser.add_argument('--duty-cycle', type=float, default=0.4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--video-seconds', type=int, default=30)
+    parser.add_argument('--video-fps', type=int, default=30)
+    parser.add_argument('--video-preset', default=VIDEO_PRESET)
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per stage; the median time is reported')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument('--output', help='Write the results as JSON to this file')
+    args = parser.parse_args()
+
+    config = {key: getattr(args, key) for key in ['trucks', 'days', 'sessions_per_day', 'session_hours', 'duty_cycle', 'seed',
+                                                  'video_seconds', 'video_fps', 'video_preset']}
+    work_dir = tempfile.mkdtemp(prefix='sweep_benchmark_')
+    try:
+        log_dir = os.path.join(work_dir, 'logs')
+        generate_logs(log_dir, args.trucks, args.days, args.sessions_per_day, args.session_hours, args.duty_cycle, seed=args.seed)
+        start_pool()
+        runs = []
+        for run in range(args.repeat):
+            print(f'Run {run + 1} of {args.repeat}')
+            run_dir = os.path.join(work_dir, f'run_{run}')
+            runs.append(run_pipeline(run_dir, log_dir, args))
+            shutil.rmtree(run_dir, ignore_errors=True)
+    finally:
+        shutdown_pool()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results = {
+        'config': config,
+        'environment': {'commit': git_commit(), 'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'stages': summarize_runs(runs)
+    }
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f'Saved baseline to {args.baseline}')
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+    else:
+        print(f'No baseline at {args.baseline}; run with --save-baseline to store one')